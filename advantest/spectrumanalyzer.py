@@ -1,51 +1,147 @@
 from __future__ import division
 from numpy import *
 from drivepy import visaconnection
+from concurrent.futures import Future
+import time
+
+# Mapping of data transfer format to the OSA format command. Binary transfer is sent as an IEEE-488.2 block of doubles
+DATA_FORMATS={"ASCII":"FMT0","BINARY":"FMT1"}
+BINARY_DTYPE=">f8"
+# Number of preallocated buffers cycled through by streamSpectra()
+STREAM_RING_SIZE=2
+SWEEP_TIMEOUT=20*60         # s
+SRQ_POLL_INTERVAL=0.1       # s
+STOP_SWEEP_COMMAND="MEA0"
 
 class SpectrumAnalyzer(object):
     """ Class for the Advantest optical spectrum analyzer which provides high level commands for reading spectrums"""
-    def __init__(self,addr="GPIB::10",timeout=60):
+    def __init__(self,addr="GPIB::10",timeout=60,dataFormat="ASCII"):
         self._osa=VisaConnection(addr,timeout)
         self._osa.write("*RST")
+        self._wavelengthData=None # wavelength axis is cached until the sweep configuration changes
+        self.setDataFormat(dataFormat)
     def setSpan(self,span):
         """ Sets the measurement span for OSA in nm"""
-        self._osa.write("SPA "+str(span)+"NM")
+        self._setAxisParameter("SPA "+str(span)+"NM")
     def setCenter(self,center):
         """ Sets the center wavelength for the OSA in nm"""
-        self._osa.write("CEN "+str(center)+"NM")
+        self._setAxisParameter("CEN "+str(center)+"NM")
     def setNumPoints(self,numPoints):
         """ Sets the number of sampling points """
-        self._osa.write("SPT "+str(numPoints))
+        self._setAxisParameter("SPT "+str(numPoints))
     def setResolution(self,res):
         """ Sets measurement resolution """
-        self._osa.write("RES "+str(res))
+        self._setAxisParameter("RES "+str(res))
     def setSweepMode(self,sweepIndex=2):
         """ Sets the sweep mode given the index """
         self._osa.write("SWE "+str(sweepIndex))
+    def setDataFormat(self,dataFormat):
+        """ Sets the format used to transfer spectrum data from the OSA ("ASCII"|"BINARY"). Binary is much faster for long sweeps """
+        if dataFormat not in DATA_FORMATS:
+            raise ValueError, "Unknown data format "+str(dataFormat)+". Valid formats are "+str(DATA_FORMATS.keys())
+        self.dataFormat=dataFormat
+    def _setAxisParameter(self,command):
+        """ Send a command which changes the wavelength axis, and invalidate the cached wavelength data """
+        self._wavelengthData=None
+        self._osa.write(command)
 
     def obtainSpectrum(self):
         """ Obtain a spectrum from the OSA. Based on Example VB-5 in the user manual for the Q8384 """
+        self._startSweep()
+        self._osa.wait(20*60) # Wait for the SRQ interrupt before proceeding (20min timeout)
+        return self._readSpectrum()
+
+    def obtainSpectrumAsync(self,timeout=SWEEP_TIMEOUT):
+        """ Queue a sweep on the worker thread for this OSA and return a concurrent.futures.Future immediately, which resolves to (wavelength,level)
+        once the OSA signals completion with an SRQ. The calling thread is free to drive other instruments while the OSA sweeps, but shouldn't talk
+        to the OSA itself. Calling cancel() on the future stops the sweep, or stops it from starting if it's still queued. """
+        future=Future()
+        self._osa.submit(self._sweep,future,timeout)
+        return future
+
+    def _sweep(self,future,timeout):
+        """ Start a sweep, poll the status byte until it has finished, and then download the spectrum into future. Starting and reading the sweep
+        in one job keeps it in order with the other jobs queued for the OSA. The future is left pending during the sweep so that it can be cancelled,
+        in which case the OSA is told to stop sweeping """
+        if future.cancelled():
+            return
+        t0=time.time()
+        try:
+            self._startSweep()
+            while not self._osa.serviceRequested():
+                if future.cancelled():
+                    self._osa.write(STOP_SWEEP_COMMAND)
+                    return
+                if time.time()-t0 > timeout:
+                    raise CommError, "Timeout waiting for SRQ from spectrum analyzer"
+                time.sleep(SRQ_POLL_INTERVAL)
+            if future.set_running_or_notify_cancel():
+                future.set_result(self._readSpectrum())
+        except Exception as e:
+            if future.running() or future.set_running_or_notify_cancel():
+                future.set_exception(e)
+
+    def streamSpectra(self,numSpectra=None,ringSize=STREAM_RING_SIZE):
+        """ Generator which keeps the OSA sweeping and yields (wavelength,level) for numSpectra sweeps (or indefinitely if None).
+        The next sweep is started as soon as the level data has been downloaded, so the OSA sweeps while the caller processes the spectrum.
+        The level data is written into a ring of ringSize preallocated arrays, so each yielded array is only valid until ringSize
+        further spectra have been yielded. Copy it if it needs to be kept for longer. """
+        ring=None
+        count=0
+        self._startSweep()
+        while numSpectra==None or count<numSpectra:
+            self._osa.wait(20*60)
+            if ring is None or self._wavelengthData is None:
+                # (re)allocate the ring when streaming starts or the axis was changed
+                wavelengthData,levelData=self._readSpectrum()
+                ring=empty((ringSize,len(wavelengthData)))
+                ring[count%ringSize]=levelData
+            else:
+                wavelengthData,levelData=self._readSpectrum(ring[count%ringSize])
+            count+=1
+            if numSpectra==None or count<numSpectra:
+                self._startSweep()
+            yield (wavelengthData,ring[(count-1)%ringSize])
+
+    def _startSweep(self):
+        """ Trigger a single sweep, with the OSA set to send an SRQ interrupt when it finishes """
         self._osa.write("MSK254") # Set mask byte
         self._osa.write("SRQ1")   # Tell OSA to send SRQ interrupt when it finishes measuring
         self._osa.write("MEA1")   # Take a single spectrum measurement
-        self._osa.wait(20*60) # Wait for the SRQ interrupt before proceeding (20min timeout)
-        self._osa.write("FMT0,HED0,SDL2") # set format:ASCII, header:OFF, delimiter: carriage return
-        levelData=self._osa.getFloatArray("OSD0") # get the level data
-        wavelengthData=self._osa.getFloatArray("OSD1") # get the wavelength data
-        return (array(wavelengthData),array(levelData))  # return lambda,I as numpy arrays
+
+    def _readSpectrum(self,out=None):
+        """ Download the spectrum of the last sweep, optionally writing the level data into the preallocated array out """
+        binary=self.dataFormat=="BINARY"
+        self._osa.write(DATA_FORMATS[self.dataFormat]+",HED0,SDL2") # set format, header:OFF, delimiter: carriage return
+        if self._wavelengthData is None:
+            self._wavelengthData=self._osa.getFloatArray("OSD1",binary) # get the wavelength data once per configuration
+            self._wavelengthData.flags.writeable=False # the same array is returned for every sweep, so it's read-only
+        levelData=self._osa.getFloatArray("OSD0",binary,len(self._wavelengthData),out) # get the level data
+        return (self._wavelengthData,levelData)  # return lambda,I as numpy arrays
 
 class VisaConnection(visaconnection.VisaConnection):
     """ Abstraction of the VISA connection for consistency between implementation of instrument classes """
     def __init__(self,addr,t):
         super(VisaConnection,self).__init__(addr,t)    
-    def getFloatArray(self,request):
-        """ retrieve an array of floats as specified by request string ("OSD0"|"OSD1") """
-        n=int(self.lib.ask("ODN?"))
-        self.write(request) # tell OSA to send wavelength or intensity depending on request string
-        data=self.lib.read_values()
+    def getFloatArray(self,request,binary=False,n=None,out=None):
+        """ retrieve an array of floats as specified by request string ("OSD0"|"OSD1"), using either ASCII or binary block transfer.
+        The number of points n is queried from the OSA unless it is already known, and the data is copied into out if given """
+        self.flush() # commands queued by an enclosing batch() must reach the OSA before it is queried
+        with self.locked() as lib:
+            if n==None:
+                n=int(lib.ask("ODN?"))
+            if binary:
+                data=self.getBinaryArray(request,BINARY_DTYPE) # decoded straight from the raw bytes
+            else:
+                self.write(request) # tell OSA to send wavelength or intensity depending on request string
+                self.flush()
+                data=lib.read_values()
         if len(data)!=n:
             raise CommError, "received different number of data points than expected from spectrum analyzer"
-        return array(data)
+        if out is not None:
+            out[:]=data
+            return out
+        return asarray(data,dtype=float)
 class CommError(Exception): pass
 
 
@@ -1,43 +1,54 @@
 ﻿from __future__ import division
-from drivepy.base.powermeter import BasePowerMeter, CommError, PowerMeterLibraryError
+from drivepy.base.powermeter import BasePowerMeter, RunningStatistics, CommError, PowerMeterLibraryError
 import drivepy.visaconnection as visaconnection
 import math
 DEFAULT_AVERAGING_TIME = 100    # ms
 AVERAGING_TIME_MAX_MODE = 20    # ms
+# Settings whose redundant writes are skipped by the connection
+CACHED_SETTINGS = ("SENS1:CHAN1:POW:ATIME",)
 
 class PowerMeter(BasePowerMeter):
     """ Creates a power meter object for the Agilent 8163A/B power meter via GPIB """
     def __init__(self, addr = "GPIB::20"):
         self._conn=VisaConnection(addr)
-        self._conn.write("*RST")
-        # make sure that the refernece is not used
-        self._conn.write("SENS1:CHAN1:POW:REF:STATE 0")
-        # clear the error queue
-        self._conn.write("*CLS")
-        # turn auto range on
-        self._conn.write("SENS1:CHAN1:POW:RANGE:AUTO 1")
-        # change the power unit to Watts
-        self._conn.write("SENS1:CHAN1:POW:UNIT W")
-        # set the default averaging time
-        self.tau = None
-        self._setTau(DEFAULT_AVERAGING_TIME)
-        # turn continuous measuring on
-        self._conn.write("INIT1:CHAN1:CONT 1")
+        self.lastStatistics = RunningStatistics()
+        with self._conn.batch():
+            self._conn.write("*RST")
+            # make sure that the refernece is not used
+            self._conn.write("SENS1:CHAN1:POW:REF:STATE 0")
+            # clear the error queue
+            self._conn.write("*CLS")
+            # turn auto range on
+            self._conn.write("SENS1:CHAN1:POW:RANGE:AUTO 1")
+            # change the power unit to Watts
+            self._conn.write("SENS1:CHAN1:POW:UNIT W")
+            # set the default averaging time
+            self._setTau(DEFAULT_AVERAGING_TIME)
+            # turn continuous measuring on
+            self._conn.write("INIT1:CHAN1:CONT 1")
 
     def readPower(self, tau=DEFAULT_AVERAGING_TIME, mode="mean"):
-        """ Read the power using specified averaging time and either max or averaging mode """
+        """ Read the power using specified averaging time and either max or averaging mode.
+        The statistics of the samples taken are left in self.lastStatistics, which is reset by the next reading """
+        self.lastStatistics.reset()
         if mode == 'mean' or tau <= AVERAGING_TIME_MAX_MODE:
             self._setTau(tau)
-            return self._readPower()
+            self.lastStatistics.update(self._readPower())
+            return self.lastStatistics.mean
         elif mode == "max":
             n = int(math.ceil(tau/AVERAGING_TIME_MAX_MODE))
             self._setTau(AVERAGING_TIME_MAX_MODE)
-            return max([self._readPower() for i in range(n)])
+            for i in range(n):
+                self.lastStatistics.update(self._readPower())
+            return self.lastStatistics.max
     
+    def readPowerAsync(self, tau=DEFAULT_AVERAGING_TIME, mode="mean"):
+        """ Queue readPower() on the worker thread for this power meter and return a concurrent.futures.Future for the result """
+        return self._conn.submit(self.readPower, tau, mode)
+
     def _setTau(self, tau):
-        if not tau == self.tau:
-            self._conn.write("SENS1:CHAN1:POW:ATIME %f"%(tau/1000))
-            self.tau = tau
+        # the connection skips the write if tau is unchanged
+        self._conn.write("SENS1:CHAN1:POW:ATIME %f"%(tau/1000))
     
     def _readPower(self):
         readStr=self._conn.readQuery("READ1:CHAN1:POW?")
@@ -47,5 +58,8 @@ class VisaConnection(visaconnection.VisaConnection):
     """ Abstraction of the VISA connection for consistency between implementation of instrument classes """
     def __init__(self,addr):
         super(VisaConnection,self).__init__(addr)  
+        self.cacheSettings(CACHED_SETTINGS)
     def __del__(self):
-        self.write(":INIT:CONT 1")
\ No newline at end of file
+        if self.isLastReference():
+            self.write(":INIT:CONT 1")
+        super(VisaConnection,self).__del__()
\ No newline at end of file
@@ -5,26 +5,42 @@ from drivepy import visaconnection
 # Mapping of index to resolution bandwidth in Hz
 RBW_DICT={0:30, 1:100, 2:300, 3:1e3, 4:3e3, 5:10e3, 6:30e3, 7:100e3, 8:300e3, 9:1e6, 13:10, 14:3e6}
 VBW_DICT={0:1, 1:10, 2:100, 3:1e3, 4:10e3, 5:100e3, 6:float("inf"), 7:1e6, 8:3, 9:30, 10:300, 11:3e3, 12:30e3, 13:300e3, 14:3e6}
+# Mapping of data transfer format to the trace format command. In binary mode each point is a big endian 16 bit integer in units of 0.01dBm
+DATA_FORMATS={"ASCII":"BIN 0","BINARY":"BIN 1"}
+BINARY_DTYPE=">i2"
+# Number of preallocated buffers cycled through by streamSpectra()
+STREAM_RING_SIZE=2
 
 class SpectrumAnalyzer(object):
     """ Class for the Anritsu spectrum analyzer which provides high level commands for reading spectrums"""
-    def __init__(self,addr="GPIB::2",timeout=60):
+    def __init__(self,addr="GPIB::2",timeout=60,dataFormat="ASCII"):
         self._sa=VisaConnection(addr,timeout)
         self._sa.write("*RST")
         self._numPoints = 501;
+        self._freqAxis = None   # frequency axis is cached until the span, center or number of points changes
+        self.setDataFormat(dataFormat)
 
     def setSpan(self,span):
         """ Sets the measurement span for SA in GHz"""
+        self._freqAxis = None
         self._sa.write("SP "+str(span)+"GHZ")
 
     def setCenter(self,center):
         """ Sets the center wavelength for the SA in GHz"""
+        self._freqAxis = None
         self._sa.write("CF "+str(center)+"GHz")
     
     def setNumPoints(self,numPoints):
         """ Sets the number of sampling points """
+        self._freqAxis = None
         self._numPoints = numPoints
 
+    def setDataFormat(self,dataFormat):
+        """ Sets the format used to transfer trace data from the SA ("ASCII"|"BINARY") """
+        if dataFormat not in DATA_FORMATS:
+            raise ValueError, "Unknown data format "+str(dataFormat)+". Valid formats are "+str(DATA_FORMATS.keys())
+        self.dataFormat = dataFormat
+
     def setAttenuator(self, autoMode = False, attn = 10):
         """ Set autoMode (True/False) and attn value in steps of 10dB"""
         if autoMode:
@@ -61,14 +77,51 @@ class SpectrumAnalyzer(object):
     def obtainSpectrum(self):
         """ Obtain a spectrum from the OSA. Based on Example VB-5 in the user manual for the Q8384 """
         self._sa.write("TS")                        # Start a sweep
-        self._sa.write("BIN 0")                     # Set format to ASCII
-        y = zeros(self._numPoints)                  # Create empty array to hold data
-        # Get each of the 501 data points
-        y = array([self.dbmToWatts(float(m)/100) for m in self._sa.readQuery("XMA? 0,501").split(",")])
-        x = linspace(self.getStartFreq(), self.getStopFreq(), self._numPoints)
-        return (x,y)
+        return self._readSpectrum()
+
+    def obtainSpectrumAsync(self):
+        """ Queue obtainSpectrum() on the worker thread for this SA and return a concurrent.futures.Future for the (x,y) result """
+        return self._sa.submit(self.obtainSpectrum)
+
+    def streamSpectra(self, numSpectra=None, ringSize=STREAM_RING_SIZE):
+        """ Generator which keeps the SA sweeping and yields (frequency,power) for numSpectra sweeps (or indefinitely if None).
+        The next sweep is started as soon as the trace has been downloaded, so the SA sweeps while the caller processes the spectrum.
+        The power data is written into a ring of ringSize preallocated arrays, so each yielded array is only valid until ringSize
+        further spectra have been yielded. Copy it if it needs to be kept for longer. """
+        ring = None
+        count = 0
+        self._sa.write("TS")
+        while numSpectra == None or count < numSpectra:
+            if ring is None or ring.shape[1] != self._numPoints:
+                ring = empty((ringSize, self._numPoints))
+            x, y = self._readSpectrum(ring[count % ringSize])
+            count += 1
+            if numSpectra == None or count < numSpectra:
+                self._sa.write("TS")
+            yield (x, y)
+
+    def _readSpectrum(self, out=None):
+        """ Download the trace of the last sweep, optionally writing the power data into the preallocated array out """
+        self._sa.write(DATA_FORMATS[self.dataFormat])
+        query = "XMA? 0,"+str(self._numPoints)
+        if self.dataFormat == "BINARY":
+            levels = self._sa.getRawArray(query, BINARY_DTYPE, self._numPoints)
+        else:
+            levels = fromstring(self._sa.readQuery(query), sep=",")
+        # Convert all the points from units of 0.01dBm to W in one step
+        if out is None:
+            y = self.dbmToWatts(levels/100)
+        else:
+            y = out
+            multiply(levels, 1e-3, y)   # not divide(), which floors the integer levels of binary traces on python 2
+            power(10, y, y)
+            y /= 1000
+        if self._freqAxis is None:
+            self._freqAxis = linspace(self.getStartFreq(), self.getStopFreq(), self._numPoints)
+        return (self._freqAxis,y)
 
     def dbmToWatts(self,dbm):
+        """ Convert power in dBm to W. dbm can be a scalar or numpy array """
         return 10**(dbm/10)/1000
 
     def getStartFreq(self):
@@ -80,16 +133,28 @@ class SpectrumAnalyzer(object):
 class VisaConnection(visaconnection.VisaConnection):
     """ Abstraction of the VISA connection for consistency between implementation of instrument classes """
     def __init__(self,addr,t):
-        super(VisaConnection,self).__init__(addr)
-        # TODO: set timeout
+        super(VisaConnection,self).__init__(addr,t)
     def getFloatArray(self,request):
         """ retrieve an array of floats as specified by request string ("OSD0"|"OSD1") """
-        n=int(self.lib.ask("ODN?"))
-        self.write(request) # tell OSA to send wavelength or intensity depending on request string
-        data=self.lib.read_values()
+        self.flush() # commands queued by an enclosing batch() must reach the instrument before it is queried
+        with self.locked() as lib:
+            n=int(lib.ask("ODN?"))
+            self.write(request) # tell OSA to send wavelength or intensity depending on request string
+            self.flush()
+            data=lib.read_values()
         if len(data)!=n:
             raise CommError, "received different number of data points than expected from spectrum analyzer"
         return array(data)
+    def getRawArray(self,request,dataType,n):
+        """ retrieve n values of dataType which the SA sends as raw binary (without block header) in response to request string """
+        self.flush() # commands queued by an enclosing batch() must reach the instrument before it is queried
+        with self.locked() as lib:
+            self.write(request)
+            self.flush()
+            raw=lib.read_raw()
+        if len(raw)<n*dtype(dataType).itemsize:
+            raise CommError, "received different number of data points than expected from spectrum analyzer"
+        return frombuffer(raw,dtype=dataType,count=n)
 class CommError(Exception): pass
 
 
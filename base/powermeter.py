@@ -1,4 +1,6 @@
 import time
+import numpy
+SKETCH_SIZE=1000    # number of samples retained for estimating percentiles
 
 class BasePowerMeter(object):
     def __init__(self, *args, **kwargs):
@@ -26,5 +28,62 @@ class BasePowerMeter(object):
         del self.t0
         return power
         
+class RunningStatistics(object):
+    """ Statistics of a stream of power samples accumulated in constant memory. Drivers feed samples one at a time or as blocks with update().
+    The count, mean, variance, min and max are exact, while percentiles are estimated from a bounded random (reservoir) sample of the stream """
+    def __init__(self, sketchSize=SKETCH_SIZE):
+        self._sketch = numpy.empty(sketchSize)
+        self.reset()
+
+    def reset(self):
+        """ discard all the samples, keeping the sketch buffer so that the object can be reused for the next reading """
+        self.count = 0
+        self.mean = 0.0
+        self.min = numpy.inf
+        self.max = -numpy.inf
+        self._m2 = 0.0
+
+    def update(self, samples):
+        """ add a single sample or an array of samples """
+        samples = numpy.asarray(samples, dtype=float).ravel()
+        n = len(samples)
+        if n == 0:
+            return
+        # Combine the mean and sum of squared deviations of the block with the running values (Chan et al.)
+        blockMean = samples.mean()
+        delta = blockMean - self.mean
+        total = self.count + n
+        self.mean += delta*n/total
+        self._m2 += ((samples - blockMean)**2).sum() + delta**2*self.count*n/total
+        self.min = min(self.min, samples.min())
+        self.max = max(self.max, samples.max())
+        self._updateSketch(samples)
+        self.count = total
+
+    def _updateSketch(self, samples):
+        """ reservoir sampling, so that every sample seen so far is retained with equal probability """
+        size = len(self._sketch)
+        numFill = max(0, min(size - self.count, len(samples)))
+        self._sketch[self.count:self.count+numFill] = samples[:numFill]
+        if numFill < len(samples):
+            indices = numpy.arange(self.count + numFill, self.count + len(samples))
+            slots = (numpy.random.random(len(indices))*(indices + 1)).astype(int)
+            keep = slots < size
+            self._sketch[slots[keep]] = samples[numFill:][keep]
+
+    @property
+    def variance(self):
+        return self._m2/(self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self):
+        return numpy.sqrt(self.variance)
+
+    def percentile(self, q):
+        """ estimate the q-th percentile (0-100) of the samples """
+        if self.count == 0:
+            raise ValueError("No samples have been added")
+        return numpy.percentile(self._sketch[:min(self.count, len(self._sketch))], q)
+
 class CommError(Exception): pass
 class PowerMeterLibraryError(Exception): pass
\ No newline at end of file
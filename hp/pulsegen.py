@@ -36,7 +36,9 @@ class VisaConnection(visaconnection.VisaConnection):
     def __init__(self,addr,t=5):
         super(VisaConnection,self).__init__(addr,t)  
     def __del__(self):
-        self.write(":OUTP OFF")
+        if self.isLastReference():
+            self.write(":OUTP OFF")
+        super(VisaConnection,self).__del__()
 
 
 
@@ -1,27 +1,61 @@
 from __future__ import division
 from drivepy import visaconnection
 from time import sleep
+from numpy import array, fromstring
 NPLC=10 # Default integration time
+BUFFER_MAX_POINTS=1024  # Size of the DMM reading buffer
+LINE_FREQUENCY=50       # Hz, for converting NPLC into integration time
+BURST_TIMEOUT=5         # s, allowed for a burst in addition to the integration time
+# Settings whose redundant writes are skipped by the connection
+CACHED_SETTINGS=(":SENS:VOLT:DC:NPLC",":SENS:VOLT:DC:RANG:AUTO")
 class DMM(object):
     """ Class for the source measure unit which provides high level commands for setting and reading the current """
     def __init__(self,addr="GPIB::1",autoZero=True,disableScreen=False):
         self._dmm=VisaConnection(addr)
-        self._dmm.write("*RST")
-        self._dmm.write(":SYST:BEEP:STAT OFF")
-        self._dmm.write(":CONF:VOLT:DC")
-        if disableScreen:
-            self._dmm.write("DISP:ENAB 0")
-        if not autoZero:
-            self._dmm.write(":SYST:AZER:STAT 0") # Turn off auto-zero to improve speed
-        self._dmm.write(":SENS:VOLT:DC:NPLC "+str(NPLC))
-        self._dmm.write(":SENS:VOLT:DC:RANG:UPP 0")
-        self._dmm.write(":SENS:VOLT:DC:AVER:STAT 0")
+        with self._dmm.batch():
+            self._dmm.write("*RST")
+            self._dmm.write(":SYST:BEEP:STAT OFF")
+            self._dmm.write(":CONF:VOLT:DC")
+            if disableScreen:
+                self._dmm.write("DISP:ENAB 0")
+            if not autoZero:
+                self._dmm.write(":SYST:AZER:STAT 0") # Turn off auto-zero to improve speed
+            self._dmm.write(":SENS:VOLT:DC:NPLC "+str(NPLC))
+            self._dmm.write(":SENS:VOLT:DC:RANG:UPP 0")
+            self._dmm.write(":SENS:VOLT:DC:AVER:STAT 0")
 
     def measure(self):
         """ Returns measurement for configured measurement type"""
         readStr=self._dmm.readQuery(":READ?")
         return float(readStr)
 
+    def measureBurst(self,n,nplc=NPLC):
+        """ Take n readings with integration time nplc back to back into the DMM buffer, and return them as a numpy array fetched in a single transfer """
+        if n<1 or n>BUFFER_MAX_POINTS:
+            raise ValueError, "Number of burst readings must be between 1 and "+str(BUFFER_MAX_POINTS)
+        self._dmm.write(":SENS:VOLT:DC:NPLC "+str(nplc))
+        if n==1:
+            readings=array([self.measure()])
+        else:
+            with self._dmm.batch():
+                self._dmm.write(":TRIG:SOUR IMM")
+                self._dmm.write(":TRIG:COUN 1")
+                self._dmm.write(":SAMP:COUN "+str(n))
+                self._dmm.write(":TRAC:CLE")
+                self._dmm.write(":TRAC:POIN "+str(n))
+                self._dmm.write(":TRAC:FEED SENS")
+                self._dmm.write(":TRAC:FEED:CONT NEXT")
+                self._dmm.write(":INIT")
+            # Wait for the burst to complete and read all the readings back from the buffer
+            self._dmm.readQuery("*OPC?",timeout=BURST_TIMEOUT+2*n*nplc/LINE_FREQUENCY)
+            readings=fromstring(self._dmm.readQuery(":TRAC:DATA?"),sep=",")
+            with self._dmm.batch():
+                self._dmm.write(":TRAC:FEED:CONT NEVER")
+                self._dmm.write(":SAMP:COUN 1")
+        # Restore the default integration time used by measure()
+        self._dmm.write(":SENS:VOLT:DC:NPLC "+str(NPLC))
+        return readings
+
     def setAuto(self):
         self._dmm.write(":SENS:VOLT:DC:RANG:AUTO 1")
 
@@ -29,9 +63,12 @@ class VisaConnection(visaconnection.VisaConnection):
     """ Abstraction of the VISA connection for consistency between implementation of instrument classes """
     def __init__(self,addr,t=None):
         super(VisaConnection,self).__init__(addr,t)  
+        self.cacheSettings(CACHED_SETTINGS)
     def __del__(self):
-        self.write(":INIT:CONT 1")
-        #self.write(":SYST:LOC") not working for some reason
+        if self.isLastReference():
+            self.write(":INIT:CONT 1")
+            #self.write(":SYST:LOC") not working for some reason
+        super(VisaConnection,self).__del__()
 
 
 
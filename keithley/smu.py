@@ -1,31 +1,90 @@
 ﻿from __future__ import division
 from drivepy import visaconnection
 from time import sleep
+from numpy import asarray, fromstring, linspace, logspace, log10
 NPLC=1 # Default integration time
+SOURCE_LIST_CHUNK=100       # Number of source list points sent per command
+BUFFER_MAX_POINTS=2500      # Size of the SMU reading buffer
+SWEEP_POINT_TIMEOUT=0.1     # Time allowed per sweep point (s) in addition to the source delay
+SWEEP_BASE_TIMEOUT=5        # Time allowed for a sweep (s) in addition to the time for its points
+# Settings written by setCurrent() whose redundant writes are skipped by the connection
+CACHED_SETTINGS=(":SOUR:FUNC",":SOUR:CURR:MODE",":SOUR:CURR:LEV",":SENS:FUNC",":SENS:VOLT:PROT",":SENS:VOLT:RANG")
 class SMU(object):
     """ Class for the source measure unit which provides high level commands for setting and reading the current """
     def __init__(self,addr="GPIB::25",autoZero=True,disableScreen=False,defaultCurrent=50e-3, currRange=0.1):
         self._smu=VisaConnection(addr,defaultCurrent=defaultCurrent)
-        self._smu.write("*RST")
-        self._smu.write(":FORM:ELEM:SENS VOLT,CURR")
-        if disableScreen:
-            self._smu.write("DISP:ENAB 0")
-        self.setCurrent(0)
-        self.setBeepState(1)
-        self.setOutputState(1)
-        self.setBeepState(0)
-        if not autoZero:
-            self._smu.write(":SYST:AZER:STAT 0") # Turn off auto-zero to improve speed
-        self._smu.write(":SENS:CURR:NPLC "+str(NPLC))
-        self.setCurrRange(currRange)
+        with self._smu.batch():
+            self._smu.write("*RST")
+            self._smu.write(":FORM:ELEM:SENS VOLT,CURR")
+            if disableScreen:
+                self._smu.write("DISP:ENAB 0")
+            self.setCurrent(0)
+            self.setBeepState(1)
+            self.setOutputState(1)
+            self.setBeepState(0)
+            if not autoZero:
+                self._smu.write(":SYST:AZER:STAT 0") # Turn off auto-zero to improve speed
+            self._smu.write(":SENS:CURR:NPLC "+str(NPLC))
+            self.setCurrRange(currRange)
     def setCurrent(self,setCurr,Vcomp=3.5):
         """ Sets the current and returns a voltage from SMU"""
-        # Set source mode
-        self._smu.write(":SOUR:FUNC CURR; :SOUR:CURR:MODE FIX")
-        # Set current and range. Would be nice to set the range automatically based on supplied current
-        self._smu.write(":SOUR:CURR:LEV "+str(setCurr)) 
-        # Setup voltage measure function
-        self._smu.write(':SENS:FUNC "VOLT";' + ":SENS:VOLT:PROT "+str(Vcomp)+"; :SENS:VOLT:RANG 10")
+        with self._smu.batch():
+            # Set source mode
+            self._smu.write(":SOUR:FUNC CURR; :SOUR:CURR:MODE FIX")
+            # Set current and range. Would be nice to set the range automatically based on supplied current
+            self._smu.write(":SOUR:CURR:LEV "+str(setCurr)) 
+            # Setup voltage measure function
+            self._smu.write(':SENS:FUNC "VOLT";' + ":SENS:VOLT:PROT "+str(Vcomp)+"; :SENS:VOLT:RANG 10")
+
+    def sweepCurrent(self,currents,Vcomp=3.5,delay=0):
+        """ Run a hardware timed sweep through the list of currents using the source list and trigger model of the SMU, 
+        storing the readings in the SMU buffer. Returns (voltages,currents) as numpy arrays fetched in one bulk read. The source delay is restored afterwards """
+        assert self.state, "The SMU needs to be turned ON to make an ouput measurement"
+        currents=asarray(currents,dtype=float)
+        n=len(currents)
+        if n<1 or n>BUFFER_MAX_POINTS:
+            raise ValueError, "Number of sweep points must be between 1 and "+str(BUFFER_MAX_POINTS)
+        sourceDelay,autoDelay=self._smu.readQuery(":SOUR:DEL?;:SOUR:DEL:AUTO?").strip().split(";")
+        with self._smu.batch():
+            self._smu.write(":SOUR:FUNC CURR; :SOUR:CURR:MODE LIST")
+            self._smu.write(':SENS:FUNC "VOLT";' + ":SENS:VOLT:PROT "+str(Vcomp)+"; :SENS:VOLT:RANG 10")
+            # Load the source list in chunks to keep each message a reasonable length. List commands are never skipped by the settings cache
+            for i in range(0,n,SOURCE_LIST_CHUNK):
+                values=",".join(repr(c) for c in currents[i:i+SOURCE_LIST_CHUNK])
+                if i==0:
+                    self._smu.write(":SOUR:LIST:CURR "+values)
+                else:
+                    self._smu.write(":SOUR:LIST:CURR:APP "+values)
+            self._smu.write(":SOUR:DEL "+str(delay))
+            self._smu.write(":TRIG:COUN "+str(n))
+            self._smu.write(":TRAC:CLE")
+            self._smu.write(":TRAC:POIN "+str(n))
+            self._smu.write(":TRAC:FEED SENS")
+            self._smu.write(":TRAC:FEED:CONT NEXT")
+            self._smu.write(":INIT")
+        try:
+            # Wait for the sweep to complete and then read back all the voltage,current pairs
+            self._smu.readQuery("*OPC?",timeout=SWEEP_BASE_TIMEOUT+n*(SWEEP_POINT_TIMEOUT+delay))
+            data=fromstring(self._smu.readQuery(":TRAC:DATA?"),sep=",")
+        finally:
+            # Return the SMU to single point fixed mode with the caller's source delay
+            with self._smu.batch():
+                self._smu.write(":TRAC:FEED:CONT NEVER")
+                self._smu.write(":TRIG:COUN 1")
+                self._smu.write(":SOUR:CURR:MODE FIX")
+                self._smu.write(":SOUR:DEL "+sourceDelay)
+                if int(autoDelay):
+                    self._smu.write(":SOUR:DEL:AUTO ON")
+            self._smu.invalidateSettings(":SOUR:CURR:LEV")
+        return (data[0::2],data[1::2])
+
+    def sweepCurrentLinear(self,start,stop,numPoints,Vcomp=3.5,delay=0):
+        """ Hardware timed sweep of numPoints linearly spaced currents from start to stop. See sweepCurrent() """
+        return self.sweepCurrent(linspace(start,stop,numPoints),Vcomp,delay)
+
+    def sweepCurrentLog(self,start,stop,numPoints,Vcomp=3.5,delay=0):
+        """ Hardware timed sweep of numPoints logarithmically spaced currents from start to stop (both >0). See sweepCurrent() """
+        return self.sweepCurrent(logspace(log10(start),log10(stop),numPoints),Vcomp,delay)
 
     def setCurrRange(self,range):
         self._smu.write(":SOUR:CURR:RANGE " + str(range))
@@ -35,6 +94,9 @@ class SMU(object):
         assert self.state, "The SMU needs to be turned ON to make an ouput measurement"
         readStr=self._smu.readQuery(":READ?").split(',')
         return (float(readStr[0]),float(readStr[1]))
+    def measureAsync(self):
+        """ Queue measure() on the worker thread for this SMU and return a concurrent.futures.Future for the (voltage,current) result """
+        return self._smu.submit(self.measure)
     def autoZeroOnce(self):
         """ This is a workaround to autozero the SMU. ':SYS:AZER:STAT ONCE' would be better but not working. 
         This autoZero command should be called more than every 10 minutes """
@@ -58,7 +120,8 @@ class SMU(object):
             self._smu.write(":OUTP OFF")
         else:
             raise TypeError,"Type error setting state of SMU. Examples of correct state are ('ON','OFF',True,0)"
-        # wait for the output to finish switching.
+        # wait for the output to finish switching, sending the command first if it's being batched
+        self._smu.flush()
         sleep(10e-3)
         # set the state so we can keep track of it
         self.state=state
@@ -70,11 +133,14 @@ class VisaConnection(visaconnection.VisaConnection):
     def __init__(self,addr,defaultCurrent):
         super(VisaConnection,self).__init__(addr)  
         self.defaultCurrent=defaultCurrent
+        self.cacheSettings(CACHED_SETTINGS)
     def __del__(self):
-        self.write(":OUTP OFF")
-        self.write(":SOUR:CURR:RANGE 100e-3;:SOUR:CURR:LEV "+str(self.defaultCurrent))
-        self.write("DISP:ENAB 1")
-        self.write(":SYST:LOC")        
+        if self.isLastReference():
+            self.write(":OUTP OFF")
+            self.write(":SOUR:CURR:RANGE 100e-3;:SOUR:CURR:LEV "+str(self.defaultCurrent))
+            self.write("DISP:ENAB 1")
+            self.write(":SYST:LOC")        
+        super(VisaConnection,self).__del__()
 
 
 
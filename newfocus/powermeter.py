@@ -1,7 +1,7 @@
 from __future__ import division
 from drivepy.base.powermeter import BasePowerMeter
 from drivepy.keithley.dmm import DMM
-from numpy import zeros, mean, max
+from numpy import mean, max
 import time
 SENSITIVITY=1.489e-4    # 0.15mW/V
 INSERTION_LOSS=.01  # assume 1% tap off from main fiber into power meter
@@ -23,10 +23,7 @@ class PowerMeter(BasePowerMeter):
 
     def _bestOfN(self,n):
         """ Hack to take best n readings in case of moving target """
-        v=zeros((n,1))
-        for idx in range(n):
-            v[idx]=self.dmm.measure()
-        return max(v)
+        return max(self.dmm.measureBurst(n))
 
     def _voltageToPower(self,V):
         return max(V*SENSITIVITY/INSERTION_LOSS,0)
\ No newline at end of file
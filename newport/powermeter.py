@@ -1,34 +1,69 @@
 ﻿from __future__ import division
-from drivepy.base.powermeter import BasePowerMeter, CommError, PowerMeterLibraryError
-import ctypes,time,string,numpy, os
+from drivepy.base.powermeter import BasePowerMeter, RunningStatistics, CommError, PowerMeterLibraryError
+from drivepy import transport
+import ctypes,time,string,numpy, os, json, threading
+from collections import deque
 READ_BUFFER_SIZE=64
 DLL_NAME=os.path.join(os.path.dirname(os.path.realpath(__file__)),"usbdll.dll")
 SEP_STRING="\r\n"
 END_OF_DATA_STR = "End of Data\r\n"
 END_OF_HEADER_STR = "End of Header\r\n"
 MAX_RANGE=4
+DATA_STORE_HEADER_SIZE=1024     # bytes allowed for the header of a data store dump
+DATA_STORE_BYTES_PER_SAMPLE=16  # bytes allowed for each sample line of a data store dump, e.g. "1.234567E-06\r\n"
 READ_TIMEOUT=10
+RANGE_HEADROOM=0.99             # fraction of the maximum power of a range above which a higher range is used
+RANGE_SETTLE_TIMEOUT=1.0        # s, maximum time to wait for the reading to settle after changing range
+RANGE_SETTLE_POLL=10e-3         # s
+RANGE_SETTLE_TOLERANCE=0.01     # relative change between successive readings for the reading to be considered settled
+RANGING_LOG_LENGTH=100          # number of ranging decisions remembered in PowerMeter.rangingLog
+FILL_SLEEP_FRACTION=0.9         # fraction of the expected data store fill time to sleep before polling the sample count
+POLL_INTERVAL_MIN=1e-3          # s, initial interval between polls of the sample count, doubled after each poll
+POLL_INTERVAL_MAX=0.1           # s
+STREAM_BUFFER_SIZE=10000        # size of the data store ring buffer used by streamPower()
+STREAM_CHUNK_SIZE=100           # default number of samples yielded at a time by streamPower()
+STREAM_STALL_MARGIN=100         # number of sample periods without a new sample after which streamPower() gives up, if longer than READ_TIMEOUT
+RANGE_CACHE_FILE=os.path.join(os.path.expanduser("~"),".drivepy","newport_ranges.json")  # maximum power of each range per detector, wavelength and units
+
+# The USB library is initialized once per process and shared by the connections to all devices on the bus
+_usbSession=None
+_usbSessionLock=threading.Lock()
 
 class PowerMeter(BasePowerMeter):
     """ Creates a power meter object, from which we can take power meter readings using readPower() 
     or send commands/queries using sendCommand(command)."""
-    def __init__(self,pid=0xcec7,*setupArgs):
+    def __init__(self,pid=0xcec7,*setupArgs,**connectionArgs):
         """ initializes the power meter object. pid is the product id for the power meter from the file
-        NewportPwrMtr.inf e.g. in C:\Program Files\Newport\Newport USB Driver\Bin"""
+        NewportPwrMtr.inf e.g. in C:\Program Files\Newport\Newport USB Driver\Bin
+        If several meters are connected then the one to use is selected with the deviceId or serial keyword arguments (see USBConnection)"""
         self.pid=pid
-        self.connection=USBConnection(pid)
+        self.connectionArgs=connectionArgs
+        self.rangingLog=deque(maxlen=RANGING_LOG_LENGTH)    # (time,oldRange,newRange,power) for each range change made by readPower
+        self.pollCount=0        # total number of data store count polls
+        self.lastPollCount=0    # number of polls made by the last readPowerN()
+        self.lastStatistics=RunningStatistics()
+        self.connection=USBConnection(pid,**connectionArgs)
         self._setupMeter(*setupArgs)
     def reset(self):
-        """ resets the connection in case it has frozen """
+        """ resets the connection in case it has frozen. The USB library is only reinitialized if no other meter is sharing the USB session,
+        since that would invalidate their connections, and otherwise only the connection to this meter is reopened """
         del self.connection
-        self.connection=USBConnection(self.pid)
+        self.connection=USBConnection(self.pid,**self.connectionArgs)
 
     def _buildRangeDic(self):
-        """ Builds a dictionary giving the maximum power values for all range """
+        """ Builds a dictionary giving the maximum power values for all range. The dictionary is cached on disk for each detector 
+        serial number, wavelength and units, so the ranges are only probed the first time a detector is used at a given wavelength and units """
+        key=self.getDetectorSerial()+"@"+str(self.wavelength)+"/"+str(self.units)
+        cache=_loadRangeCache()
+        if key in cache:
+            self.rangeDic=dict((int(r),maxPower) for r,maxPower in cache[key].items())
+            return
         self.rangeDic={}
         for r in range(MAX_RANGE+1):
             self.setRange(r)
             self.rangeDic[r]=self.getMaxPower()
+        cache[key]=self.rangeDic
+        _saveRangeCache(cache)
 
     def _setupMeter(self,wavelength=1300,autoRange=0,range=1,filterType=1,analogFilter=4,digitalFilter=10000,units=2):
         """ routine to setup the power meter to a predetermined state"""
@@ -51,8 +86,7 @@ class PowerMeter(BasePowerMeter):
     def readPowerWithStatus(self):
         """ routine to read a single power measurement and return as float. 
         This is much faster than readPowerAuto() but requires range to be set correctly, and doesn't do any averaging."""
-        self.connection.write("PM:PWS?")
-        result=self.connection.read().strip().split(", ")
+        result=self.connection.query("PM:PWS?").split(", ")
         power=float(result[0])
         statusCode=int(result[1],16)
         mask=[1920, 112, 8, 4, 2, 0]
@@ -70,87 +104,125 @@ class PowerMeter(BasePowerMeter):
             self.connection.write("pm:ds:clear")
             self.connection.write("pm:ds:size "+str(int(n)))
             self.connection.write("pm:ds:enable 1")
-            # Wait for the samples to fill up
-            timeout=False
+            # Sleep for most of the time the samples should take to fill up, and then poll with exponential backoff
             t0=time.time()
-            while not timeout:
+            fillTime=n*self.samplePeriod
+            time.sleep(FILL_SLEEP_FRACTION*fillTime)
+            pollInterval=POLL_INTERVAL_MIN
+            self.lastPollCount=0
+            while True:
                 numValues=int(self.connection.readFloat("PM:DS:Count?"))
+                self.pollCount+=1
+                self.lastPollCount+=1
                 delay=time.time()-t0
-                timeout=delay > READ_TIMEOUT
                 if numValues >= n:
                     break
-                elif self.readPowerRaw()>self.rangeDic[self.range]:
+                elif delay > READ_TIMEOUT:
+                    raise CommError, "Expected "+str(n)+" samples from power meter, but only received "+str(numValues)
+                elif delay > fillTime and self.readPowerRaw()>self.rangeDic[self.range]:
                     # sometimes "PM:DS:Count?" doesn't work when saturating, but a normal read does
                     raise SaturatingError
-            if timeout: raise CommError, "Expected "+str(n)+" samples from power meter, but only received "+str(numValues)
-            # Write the get command
-            self.connection.write("pm:ds:get? +"+str(int(n)))
-            # Prepare some variables
-            responseBuffer=""
-            lastReadStr=""
-            endOfData=False
-            # Read READ_BUFFER_SIZE bytes from the device until END_OF_DATA_STR is found or a read error occurs
-            while not endOfData:
-                readStr=self.connection.read()
-                # Append the current read string
-                responseBuffer=responseBuffer+readStr
-                # See if END_OF_DATA_STR was found allowing for possibility that some of it is in last reading
-                endOfData=string.find(lastReadStr+readStr,END_OF_DATA_STR)>=0
-                lastReadStr=readStr
-            # Find the indices where the data starts and ends
-            dataStartIndex=string.find(responseBuffer,END_OF_HEADER_STR)+len(END_OF_HEADER_STR)
-            dataEndIndex=string.find(responseBuffer,END_OF_DATA_STR)
-            assert dataStartIndex!= -1 and dataEndIndex!=-1, "End of Header or End of Data message not found when reading from power meter"
-            # Convert from newline separated string sequence to numpy array of floats and return
-            dataSplit=responseBuffer[dataStartIndex:dataEndIndex].splitlines()
-            return numpy.array([float(val) for val in dataSplit])
+                time.sleep(pollInterval)
+                pollInterval=min(2*pollInterval,POLL_INTERVAL_MAX)
+            return self._readDataStore("pm:ds:get? +"+str(int(n)),n)
+
+    def _readDataStore(self,request,n):
+        """ Send the data store request (e.g. "pm:ds:get? +100") and return the n samples in the response as a numpy array.
+        The response is read directly into the receive buffer of the connection, grown to fit n samples, and the numeric block between the header 
+        and end of data markers is converted by numpy in a single call """
+        c=self.connection
+        numBytes=0
+        dataEndIndex=-1
+        with c.lock:
+            c.setReadBufferSize(DATA_STORE_HEADER_SIZE+n*DATA_STORE_BYTES_PER_SAMPLE)
+            c.write(request)
+            # Read from the device until END_OF_DATA_STR is found or a read error occurs
+            while dataEndIndex<0:
+                if c.readBufferSize-numBytes<READ_BUFFER_SIZE:
+                    c.setReadBufferSize(2*c.readBufferSize)
+                end=numBytes+c.readInto(c.readBuffer,numBytes)
+                # Only search the new bytes, allowing for the possibility that some of END_OF_DATA_STR is in the last reading
+                dataEndIndex=c.readBuffer.find(END_OF_DATA_STR,max(0,numBytes-len(END_OF_DATA_STR)),end)
+                numBytes=end
+            dataStartIndex=c.readBuffer.find(END_OF_HEADER_STR,0,dataEndIndex)
+            assert dataStartIndex!= -1, "End of Header message not found when reading from power meter"
+            dataStartIndex+=len(END_OF_HEADER_STR)
+            # Convert from newline separated string sequence to numpy array of floats. fromstring stops at the first unparsable value, so check the length
+            values=numpy.fromstring(str(c.readBuffer[dataStartIndex:dataEndIndex]),sep=" ")
+        if len(values)!=n:
+            raise CommError, "Expected "+str(n)+" samples from power meter data store, but received "+str(len(values))
+        return values
 
     def readPower(self, tau=200, mode="mean"):
         """ Reads the power using custom auto-range functionality and averaged over specified time interval tau in ms.
         A timeout can be specified in seconds for the auto-range and re-measure, where we give up on trying to find a more accurate reading. 
-        If the timeout is invoked, it means the power is fluctuating too much with time, and so tau should be increased."""    
+        If the timeout is invoked, it means the power is fluctuating too much with time, and so tau should be increased.
+        The statistics of the samples of the returned reading are left in self.lastStatistics, which is reset by the next reading"""    
         n=int(numpy.ceil(tau))
-        # Read an array of samples length tau ms
-        try:
-            powerSamples=self.readPowerN(n)
-        except SaturatingError:
-            powerSamples=numpy.inf
-        except CommError as e:
-            # If the length of array is wrong then clear the command queue and try again, if still wrong then let exception propagate
-            queueStr=self.connection.clearComQueue()
+        while True:
+            # Read an array of samples length tau ms
             try:
                 powerSamples=self.readPowerN(n)
+            except SaturatingError:
+                # The power can't be estimated from a saturated reading, so step up one range and remeasure
+                if self.range==MAX_RANGE:
+                    raise CommError, "The measured power was too large. Please enable the attenutator and restart the program"
+                self._changeRange(self.range+1,numpy.inf)
+                continue
             except CommError as e:
-                raise
-        # Calculate the maximum from the samples
-        maxPower=numpy.max(powerSamples)
-        meanPower=numpy.mean(powerSamples)
-        # Increase the range if power larger than 99% the measurement limit and return remeasurement
-        if maxPower > 0.99*self.rangeDic[self.range]:
-            if self.range < MAX_RANGE:
-                self.setRange(self.range+1)
-                time.sleep(1)
-                return self.readPower(tau,mode)
-            elif maxPower <= self.rangeDic[self.range]:
-                # If max range and between 99%-100% of maximum power then return average
-                if mode=="mean":
-                    return meanPower
-                elif mode=="max":
-                    return maxPower
-            else:
-                raise CommError, "The measured power was too large. Please enable the attenutator and restart the program"
-        # Reduce the range if power smaller than 99% of the measurement limit of the next lowest range and no timeout has occured
-        elif self.range > 0 and maxPower < 0.99*self.rangeDic[self.range-1] and self.t0 and (time.time()-self.t0) < self.timeout:
-            self.setRange(self.range-1)
-            time.sleep(1)
-            return self.readPower(tau,mode)
-        # Otherwise return the mean of the n samples
-        else:
-            if mode=="mean":
-                return meanPower
-            elif mode=="max":
-                return maxPower
-        
+                # If the length of array is wrong then clear the command queue and try again, if still wrong then let exception propagate
+                queueStr=self.connection.clearComQueue()
+                powerSamples=self.readPowerN(n)
+            # Calculate the statistics of the samples
+            self.lastStatistics.reset()
+            self.lastStatistics.update(powerSamples)
+            maxPower=self.lastStatistics.max
+            # Remeasure if the power is outside of the current range
+            newRange=self._selectRange(maxPower)
+            if newRange==self.range:
+                break
+            self._changeRange(newRange,maxPower)
+        if maxPower > self.rangeDic[self.range]:
+            raise CommError, "The measured power was too large. Please enable the attenutator and restart the program"
+        if mode=="mean":
+            return self.lastStatistics.mean
+        elif mode=="max":
+            return maxPower
+
+    def _selectRange(self,power):
+        """ Predict the best range for the measured (unsaturated) power directly from rangeDic, so that several ranges can be skipped at once.
+        The range is only reduced if the auto-range timeout of readPowerAuto() hasn't yet expired """
+        if power > RANGE_HEADROOM*self.rangeDic[self.range]:
+            # Use the lowest higher range which can measure the power, or the maximum range if none can
+            for r in range(self.range+1,MAX_RANGE+1):
+                if power <= RANGE_HEADROOM*self.rangeDic[r]:
+                    return r
+            return MAX_RANGE
+        t0=getattr(self,"t0",None)
+        if self.range > 0 and t0 and (time.time()-t0) < self.timeout:
+            # Use the lowest range which can measure the power
+            for r in range(self.range):
+                if power < RANGE_HEADROOM*self.rangeDic[r]:
+                    return r
+        return self.range
+
+    def _changeRange(self,newRange,power):
+        """ Change to newRange, recording the decision in rangingLog, and wait until the reading has settled """
+        self.rangingLog.append((time.time(),self.range,newRange,power))
+        self.setRange(newRange)
+        t0=time.time()
+        lastPower=None
+        while time.time()-t0 < RANGE_SETTLE_TIMEOUT:
+            power,status=self.readPowerWithStatus()
+            if status["saturated"]:
+                # no point waiting since the new range is still too small
+                break
+            if not status["ranging"] and lastPower!=None and abs(power-lastPower) <= RANGE_SETTLE_TOLERANCE*abs(lastPower):
+                break
+            lastPower=power
+            time.sleep(RANGE_SETTLE_POLL)
+
+
     def setRange(self,range):
         """ Set the range of the ADC given integer between 0 and MAX_RANGE """
         self.range=range
@@ -173,10 +245,31 @@ class PowerMeter(BasePowerMeter):
         raise e
 
     def setWavelength(self,wavelength):
+        """ Set the wavelength, updating the range dictionary if the wavelength changed after it was built """
         self.connection.write("PM:Lambda "+str(wavelength))
+        changed=getattr(self,"wavelength",None)!=wavelength
+        self.wavelength=wavelength
+        if changed:
+            self._updateRangeDic()
+
+    def _updateRangeDic(self):
+        """ Rebuild the range dictionary, if it has been built, after a setting it depends on has changed """
+        if hasattr(self,"rangeDic"):
+            range=self.range
+            self._buildRangeDic()
+            self.setRange(range)
+
+    def getDetectorSerial(self):
+        """ Return the serial number of the attached detector """
+        return self.connection.query("PM:DETSN?")
 
     def setUnits(self,units):
+        """ Set the units of the readings, updating the range dictionary (in the new units) if they changed after it was built """
         self.connection.write("PM:UNITS "+str(units))
+        changed=getattr(self,"units",None)!=units
+        self.units=units
+        if changed:
+            self._updateRangeDic()
 
     def setFilterType(self,filterType):
         """ Sets the filter type: 0->none, 1->analog, 2->digital, 3-> analog+digital """
@@ -195,11 +288,64 @@ class PowerMeter(BasePowerMeter):
         # NOTE!interval=1 should lead to 1ms interval, but from trial and error it appears that interval=10 gives a 1ms interval!
         self.connection.write("pm:ds:interval "+str(interval))
         self.connection.write("pm:ds:buffer "+str(int(circular)))
+        self.dsInterval=interval
+        self.samplePeriod=interval/10/1000     # s
+
+    def streamPower(self,chunkSize=STREAM_CHUNK_SIZE,bufferSize=STREAM_BUFFER_SIZE):
+        """ Generator for gap-free continuous power logging. The data store is run as a ring buffer of bufferSize samples which is never stopped,
+        and only the samples acquired since the last chunk are fetched. Yields (timestamps,samples) numpy arrays of at least chunkSize samples,
+        where timestamps (s since the epoch) are calculated from the sample index and the data store interval.
+        The range must be set appropriately beforehand, since ranging would interrupt the stream.
+        PM:DS:Count? is taken as the total number of samples since the data store was enabled, with sample k stored at index k%bufferSize+1.
+        CommError is raised if samples were overwritten before they could be read, in which case bufferSize should be increased.
+        This behaviour of the count in ring buffer mode hasn't been confirmed on hardware, so rather than returning samples from the wrong part
+        of the ring, CommError is raised if the count decreases (i.e. it wraps around with the ring), or if it doesn't change for the longer 
+        of READ_TIMEOUT and STREAM_STALL_MARGIN sample periods (e.g. because it stops at bufferSize) """
+        chunkSize=min(chunkSize,bufferSize)
+        self.initBuffer(self.dsInterval,circular=True)
+        self.connection.write("pm:ds:clear")
+        self.connection.write("pm:ds:size "+str(int(bufferSize)))
+        self.connection.write("pm:ds:enable 1")
+        t0=time.time()
+        stallTimeout=max(READ_TIMEOUT,STREAM_STALL_MARGIN*self.samplePeriod)
+        numRead=0
+        lastCount=0
+        lastCountTime=t0
+        try:
+            while True:
+                count=int(self.connection.readFloat("PM:DS:Count?"))
+                self.pollCount+=1
+                if count<lastCount:
+                    raise CommError, "Power meter data store count went back from "+str(lastCount)+" to "+str(count)+" samples, so it can't be used to stream from the ring buffer"
+                elif count!=lastCount:
+                    lastCount=count
+                    lastCountTime=time.time()
+                elif time.time()-lastCountTime > stallTimeout:
+                    raise CommError, "Power meter data store count stopped at "+str(count)+" samples"
+                numNew=count-numRead
+                if numNew < chunkSize:
+                    # sleep until the rest of the chunk should have been acquired
+                    time.sleep((chunkSize-numNew)*self.samplePeriod)
+                    continue
+                if numNew > bufferSize:
+                    raise CommError, "Power meter data store overrun: "+str(numNew-bufferSize)+" samples were lost. Increase bufferSize"
+                # Fetch the new samples, in two parts if they wrap around the end of the ring
+                start=numRead%bufferSize
+                if start+numNew <= bufferSize:
+                    samples=self._readDataStore("pm:ds:get? "+str(start+1)+"-"+str(start+numNew),numNew)
+                else:
+                    samples=numpy.concatenate((self._readDataStore("pm:ds:get? "+str(start+1)+"-"+str(bufferSize),bufferSize-start),
+                                               self._readDataStore("pm:ds:get? 1-"+str(start+numNew-bufferSize),start+numNew-bufferSize)))
+                timestamps=t0+(numRead+numpy.arange(len(samples)))*self.samplePeriod
+                numRead+=len(samples)
+                yield (timestamps,samples)
+        finally:
+            self.connection.write("pm:ds:enable 0")
+            self.initBuffer(self.dsInterval)
 
     def readErrors(self):
         """ Return tuple with error code and descriptive string """
-        self.connection.write("ERRSTR?")
-        result=self.connection.read().split(",")
+        result=self.connection.query("ERRSTR?").split(",")
         return (int(result[0]),result[1].strip())
 
     def sendCommand(self,command):
@@ -214,57 +360,79 @@ class PowerMeter(BasePowerMeter):
 class USBConnection(object):
     """ Abstraction of the low level connection to USB bus so that destructor can be used without circular
     references as per http://eli.thegreenplace.net/2009/06/12/safely-using-destructors-in-python/.
-    This class is essentially a wrapper for the Newport USB Driver library usbdll.dll"""
-    def __init__(self,pid):
+    This class is essentially a wrapper for the Newport USB Driver library usbdll.dll. 
+    Several devices can be used at once (e.g. from separate threads), in which case the device is selected by its deviceId, 
+    or by a serial number contained in its description string (see getDeviceList())"""
+    def __init__(self,pid,deviceId=None,serial=None):
         """ Open the USB connection and get the device ID for future communication """
         self.readBufferSize=READ_BUFFER_SIZE
+        self.readBuffer=bytearray(READ_BUFFER_SIZE)    # receive buffer reused for every read, grown by setReadBufferSize()
+        self._session=None
+        self._session=_acquireUSBSession(pid)
+        self.lib=self._session.lib
         try:
-            self.lib=ctypes.WinDLL(DLL_NAME)
-        except Exception,e:
-            raise PowerMeterLibraryError,"Could not load the power meter library " + DLL_NAME + ". \n" + e.args[0]
-        # Open the usb device specified by pid
-        s=self.lib.newp_usb_open_devices(pid,False,ctypes.byref(ctypes.c_int(0)))
-        if s<0:
-            raise CommError, "Connection to pid=" + str(pid) + " could not be initialized and returned " + str(s)
-        # Retrieve the device ID assigned above
-        readBuffer=ctypes.create_string_buffer(1024)
-        s=self.lib.newp_usb_get_device_info(readBuffer)
-        if s<0:
-            raise CommError, "Connection to pid=" + str(pid) + " successful, but get_device_info failed and returned " + str(s)
-        deviceInfoList=readBuffer.value.split(',')
-        if len(deviceInfoList)>2:
-            raise CommError, "More than one Newport instrument detected on the USB bus which is not supported"
-        self.id=int(deviceInfoList[0])
+            self.id=deviceId=self._session.selectDevice(pid,deviceId,serial)
+        except CommError:
+            # Release the session straight away rather than when the traceback is cleared
+            self.__del__()
+            raise
+        # Lock used to keep write/read sequences for this device together when it's shared between threads
+        self.lock=self._session.locks[deviceId]
     def __del__(self):
-        """ Destructor method unitializes the USB connection """
-        self.lib.newp_usb_uninit_system()
+        """ Destructor method releases the USB session, which is uninitialized when no devices are using it """
+        if self._session is not None:
+            _releaseUSBSession(self._session)
+            self._session=None
     def write(self,writeString):
         """ Writes a single command to the USB device"""
-        s=self.lib.newp_usb_send_ascii(self.id, writeString+SEP_STRING, len(writeString+SEP_STRING))
+        with self.lock:
+            s=self.lib.newp_usb_send_ascii(self.id, writeString+SEP_STRING, len(writeString+SEP_STRING))
         if s<0:
             raise CommError, "Writing of command '" + writeString + "' was not succesful and returned " + str(s)
     
+    def setReadBufferSize(self,size):
+        """ Grow the receive buffer, keeping its contents, so that responses of up to size bytes are read with a single library call """
+        with self.lock:
+            if size>self.readBufferSize:
+                self.readBuffer.extend(bytearray(size-self.readBufferSize))
+                self.readBufferSize=size
+
     def read(self):
         """ Reads the response from power meter """
-        readBuffer=ctypes.create_string_buffer(self.readBufferSize)
+        with self.lock:
+            numBytesRead=self.readInto(self.readBuffer)
+            return str(self.readBuffer[:numBytesRead])
+
+    def readInto(self,buffer,offset=0):
+        """ Reads the response from power meter directly into the bytearray buffer starting at offset, and returns the number of bytes read """
+        size=len(buffer)-offset
+        cBuffer=(ctypes.c_char*size).from_buffer(buffer,offset)
         numBytesRead=ctypes.c_int(0)
-        s=self.lib.newp_usb_get_ascii(self.id,readBuffer,self.readBufferSize,ctypes.byref(numBytesRead))
+        with self.lock:
+            s=self.lib.newp_usb_get_ascii(self.id,cBuffer,size,ctypes.byref(numBytesRead))
         if s<0:
             raise CommError, "Reading from power meter was not succesful and returned " + str(s)
-        return readBuffer.value
+        return numBytesRead.value
 
        
+    def query(self,queryString):
+        """ Writes the query command in queryString, then reads the response and returns it stripped of whitespace """
+        with self.lock:
+            self.write(queryString)
+            return self.read().strip()
+
     def readFloat(self,queryString):
         """ Writes the query command in queryString, then reads the response and returns it """
-        self.write(queryString)
-        returnString=self.read()
-        try:
-            return float(returnString.strip())
-        except ValueError:
-            self.clearComQueue()
+        with self.lock:
             self.write(queryString)
             returnString=self.read()
-            return float(returnString.strip())
+            try:
+                return float(returnString.strip())
+            except ValueError:
+                self.clearComQueue()
+                self.write(queryString)
+                returnString=self.read()
+                return float(returnString.strip())
 
 
     def clearComQueue(self):
@@ -277,4 +445,102 @@ class USBConnection(object):
                 break
         return commStr
 
+class _USBSession(object):
+    """ The Newport USB library, initialized once and shared by the connections to all devices on the bus """
+    def __init__(self):
+        try:
+            self.lib=transport.loadLibrary(DLL_NAME,stdcall=True)
+        except Exception,e:
+            raise PowerMeterLibraryError,"Could not load the power meter library " + DLL_NAME + ". \n" + e.args[0]
+        self.pids=set()
+        self.devices={}     # description string for each device ID
+        self.devicePids={}  # product id for each device ID
+        self.locks={}       # lock for each device ID
+        self.refCount=0
+    def openDevices(self,pid):
+        """ Open all the devices with product id pid and add them to the device list. The library lists the devices of all the product ids
+        opened so far, so the new device IDs are the ones with product id pid """
+        s=self.lib.newp_usb_open_devices(pid,False,ctypes.byref(ctypes.c_int(0)))
+        if s<0:
+            raise CommError, "Connection to pid=" + str(pid) + " could not be initialized and returned " + str(s)
+        # Retrieve the device IDs assigned above, given as "id,description;" for each device
+        readBuffer=ctypes.create_string_buffer(1024)
+        s=self.lib.newp_usb_get_device_info(readBuffer)
+        if s<0:
+            raise CommError, "Connection to pid=" + str(pid) + " successful, but get_device_info failed and returned " + str(s)
+        for deviceInfo in readBuffer.value.split(";"):
+            if deviceInfo.strip():
+                deviceId,_,description=deviceInfo.partition(",")
+                self.devices[int(deviceId)]=description.strip()
+                self.devicePids.setdefault(int(deviceId),pid)
+                self.locks.setdefault(int(deviceId),threading.RLock())
+        self.pids.add(pid)
+    def getDevices(self,pid):
+        """ Return a dictionary of the description string for each device ID with product id pid """
+        return dict((i,description) for i,description in self.devices.items() if self.devicePids[i]==pid)
+    def selectDevice(self,pid,deviceId=None,serial=None):
+        """ Return the ID of the device with product id pid and the given deviceId, or serial number in its description, or of the only device
+        with product id pid if neither is given """
+        devices=self.getDevices(pid)
+        if deviceId==None and serial!=None:
+            matches=[i for i,description in devices.items() if serial in description]
+            if len(matches)!=1:
+                raise CommError, "Expected one Newport instrument with serial number " + str(serial) + " but found " + str(len(matches))
+            return matches[0]
+        elif deviceId==None:
+            if len(devices)>1:
+                raise CommError, "More than one Newport instrument detected on the USB bus; specify deviceId or serial from " + str(devices)
+            return devices.keys()[0]
+        elif deviceId not in devices:
+            raise CommError, "Newport instrument with device ID " + str(deviceId) + " not found in " + str(devices)
+        return deviceId
+    def close(self):
+        self.lib.newp_usb_uninit_system()
+
+def _acquireUSBSession(pid):
+    """ Return the shared USB session with the devices of product id pid opened, initializing the library if necessary """
+    global _usbSession
+    with _usbSessionLock:
+        session=_usbSession if _usbSession is not None else _USBSession()
+        if pid not in session.pids:
+            session.openDevices(pid)
+        _usbSession=session
+        session.refCount+=1
+        return session
+
+def _releaseUSBSession(session):
+    """ Release one reference to the USB session, uninitializing the library when no connections are using it """
+    global _usbSession
+    with _usbSessionLock:
+        session.refCount-=1
+        if session.refCount==0:
+            _usbSession=None
+            session.close()
+
+def getDeviceList(pid=0xcec7):
+    """ Return a dictionary of description strings (including the serial number) for each device ID on the bus with product id pid """
+    session=_acquireUSBSession(pid)
+    try:
+        return session.getDevices(pid)
+    finally:
+        _releaseUSBSession(session)
+
+def _loadRangeCache():
+    """ Return the dictionary of cached range tables, or an empty dictionary if there is no valid cache file """
+    try:
+        with open(RANGE_CACHE_FILE) as f:
+            return json.load(f)
+    except (IOError,ValueError):
+        return {}
+
+def _saveRangeCache(cache):
+    """ Save the dictionary of range tables. Failure isn't fatal since the ranges can always be probed again """
+    try:
+        if not os.path.isdir(os.path.dirname(RANGE_CACHE_FILE)):
+            os.makedirs(os.path.dirname(RANGE_CACHE_FILE))
+        with open(RANGE_CACHE_FILE,"w") as f:
+            json.dump(cache,f,indent=1)
+    except (IOError,OSError):
+        pass
+
 class SaturatingError(Exception): pass
\ No newline at end of file
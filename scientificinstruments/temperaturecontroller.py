@@ -20,6 +20,20 @@ class TemperatureController(QObject):
         self.emit(SIGNAL("tempDataReady"),temperature)
         return temperature
 
+    def getTemperatureAsync(self):
+        """ Read the temperature on the worker thread for this controller and return a concurrent.futures.Future for the result.
+        The tempDataReady signal is queued to the thread this controller belongs to, so connected slots don't run on the worker """
+        return self.tempController.submit(self._getTemperatureFromWorker)
+
+    def _getTemperatureFromWorker(self):
+        temperature=float(self._readSafe("T")[1:])
+        QMetaObject.invokeMethod(self,"_emitTemperature",Qt.QueuedConnection,Q_ARG(float,temperature))
+        return temperature
+
+    @pyqtSlot(float)
+    def _emitTemperature(self,temperature):
+        self.emit(SIGNAL("tempDataReady"),temperature)
+
     @pyqtSlot()
     def getSetTemperature(self):
         #return float(self.tempController.read("S")[1:])
@@ -0,0 +1,11 @@
+""" Tests which run the drivers against the simulated transport, so they don't need any instruments or vendor libraries.
+Run them from the directory containing the drivepy package with:
+    python -m unittest discover -s drivepy/tests -t . """
+from drivepy import transport
+
+def useSimulator(latency=0,throughput=None):
+    """ Select a new SimulatorTransport as the transport backend and return it """
+    sim=transport.SimulatorTransport(latency,throughput)
+    transport.registerBackend("test",sim)
+    transport.setBackend("test")
+    return sim
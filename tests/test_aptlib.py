@@ -0,0 +1,205 @@
+from __future__ import division
+import threading,time,unittest
+from drivepy.tests import useSimulator
+from drivepy.thorlabs.aptlib import aptlib
+from drivepy.thorlabs.aptlib import aptconsts as c
+
+def encodeMessage(messageID,dataPacket=None,param1=0,param2=0,sourceID=c.GENERIC_USB_ID):
+    """ Return a raw message sent by a controller to the host """
+    if dataPacket is None:
+        return c.HEADER_STRUCT_WITHOUT_DATA.pack(messageID,param1,param2,c.HOST_CONTROLLER_ID,sourceID)
+    dataPacketStr=c.getPacketCodec(messageID).pack(*dataPacket)
+    return c.HEADER_STRUCT_WITH_DATA.pack(messageID,len(dataPacketStr),c.HOST_CONTROLLER_ID|0x80,sourceID)+dataPacketStr
+
+class SimulatedController(object):
+    """ Responder for a two channel APT controller, which pushes a status update for each channel every statusInterval seconds once started """
+    model=""
+    def __init__(self,statusInterval=0.2):
+        self.statusInterval=statusInterval
+        self.device=None
+        self.stopUpdates=threading.Event()
+        self.updateThread=None
+    def __call__(self,data):
+        messageID=c.HEADER_STRUCT_WITHOUT_DATA.unpack(data[:c.NUM_HEADER_BYTES])[0]
+        if messageID==c.MGMSG_HW_REQ_INFO:
+            return encodeMessage(c.MGMSG_HW_GET_INFO,(83000001,self.model,1,1,"simulated",1,0,2))
+        elif messageID==c.MGMSG_HW_START_UPDATEMSGS:
+            self.stopUpdates=threading.Event()
+            self.updateThread=threading.Thread(target=self.pushStatusUpdates,args=(self.stopUpdates,))
+            self.updateThread.daemon=True
+            self.updateThread.start()
+        elif messageID==c.MGMSG_HW_STOP_UPDATEMSGS:
+            self.stopUpdates.set()
+        else:
+            return self.respond(messageID,data)
+    def respond(self,messageID,data):
+        return None
+    def close(self):
+        """ Stop pushing status updates """
+        self.stopUpdates.set()
+        if self.updateThread is not None:
+            self.updateThread.join()
+    def pushStatusUpdates(self,stop):
+        while not stop.is_set():
+            for channelID in (c.CHANNEL_1,c.CHANNEL_2):
+                self.device.push(self.statusUpdate(channelID))
+            stop.wait(self.statusInterval)
+    def later(self,delay,function):
+        timer=threading.Timer(delay,function)
+        timer.daemon=True
+        timer.start()
+
+class SimulatedMotorController(SimulatedController):
+    """ Stepper motor controller, which completes each move after moveTime seconds (for each channel if it's a dictionary).
+    The start and completion of each move is recorded in the moves list """
+    model="BSC202"
+    def __init__(self,moveTime=0.05,statusInterval=0.2):
+        super(SimulatedMotorController,self).__init__(statusInterval)
+        self.moveTime=moveTime
+        self.position={c.CHANNEL_1:0,c.CHANNEL_2:0}
+        self.velParams={c.CHANNEL_1:(0,4500,1000000),c.CHANNEL_2:(0,4500,1000000)}    # (minVelocity,acceleration,maxVelocity) in encoder units
+        self.moves=[]
+    def respond(self,messageID,data):
+        if messageID==c.MGMSG_MOT_MOVE_ABSOLUTE:
+            channelID,position=c.getPacketCodec(messageID).unpack(data[c.NUM_HEADER_BYTES:])
+            self.moves.append(("started",channelID,position))
+            moveTime=self.moveTime[channelID] if isinstance(self.moveTime,dict) else self.moveTime
+            self.later(moveTime,lambda: self.completeMove(channelID,position))
+        elif messageID==c.MGMSG_MOT_REQ_POSCOUNTER:
+            channelID=ord(data[2])
+            return encodeMessage(c.MGMSG_MOT_GET_POSCOUNTER,(channelID,self.position[channelID]))
+        elif messageID==c.MGMSG_MOT_SET_VELPARAMS:
+            dataPacket=c.getPacketCodec(messageID).unpack(data[c.NUM_HEADER_BYTES:])
+            self.velParams[dataPacket[0]]=dataPacket[1:]
+        elif messageID==c.MGMSG_MOT_REQ_VELPARAMS:
+            channelID=ord(data[2])
+            return encodeMessage(c.MGMSG_MOT_GET_VELPARAMS,(channelID,)+tuple(self.velParams[channelID]))
+    def completeMove(self,channelID,position):
+        self.position[channelID]=position
+        self.moves.append(("completed",channelID,position))
+        self.device.push(encodeMessage(c.MGMSG_MOT_MOVE_COMPLETED,(channelID,position,0,0)))
+    def statusUpdate(self,channelID):
+        return encodeMessage(c.MGMSG_MOT_GET_STATUSUPDATE,(channelID,self.position[channelID],self.position[channelID],0))
+
+class SimulatedPiezoController(SimulatedController):
+    """ Piezo controller with 20um of travel, which moves instantly and takes zeroTime seconds to zero a channel """
+    model="BPC202"
+    def __init__(self,zeroTime=0.15,statusInterval=0.02):
+        super(SimulatedPiezoController,self).__init__(statusInterval)
+        self.zeroTime=zeroTime
+        self.zeroing=set()
+        self.position={c.CHANNEL_1:0,c.CHANNEL_2:0}
+    def respond(self,messageID,data):
+        if messageID==c.MGMSG_PZ_REQ_MAXTRAVEL:
+            return encodeMessage(c.MGMSG_PZ_GET_MAXTRAVEL,(ord(data[2]),200))
+        elif messageID==c.MGMSG_PZ_SET_OUTPUTPOS:
+            channelID,position=c.getPacketCodec(messageID).unpack(data[c.NUM_HEADER_BYTES:])
+            self.position[channelID]=position
+        elif messageID==c.MGMSG_PZ_REQ_OUTPUTPOS:
+            channelID=ord(data[2])
+            return encodeMessage(c.MGMSG_PZ_GET_OUTPUTPOS,(channelID,self.position[channelID]))
+        elif messageID==c.MGMSG_PZ_REQ_PZSTATUSBITS:
+            channelID=ord(data[2])
+            return encodeMessage(c.MGMSG_PZ_GET_PZSTATUSBITS,(channelID,self.statusBits(channelID)))
+        elif messageID==c.MGMSG_PZ_SET_ZERO:
+            channelID=ord(data[2])
+            self.zeroing.add(channelID)
+            self.later(self.zeroTime,lambda: self.zeroing.discard(channelID))
+    def statusBits(self,channelID):
+        return (1<<5) if channelID in self.zeroing else 0
+    def statusUpdate(self,channelID):
+        return encodeMessage(c.MGMSG_PZ_GET_PZSTATUSUPDATE,(channelID,0,self.position[channelID],self.statusBits(channelID)))
+
+class AptMotorTest(unittest.TestCase):
+    def setUp(self):
+        self.sim=useSimulator()
+        self.controller=SimulatedMotorController()
+        self.controller.device=self.sim.addFtdiDevice("83000001","APT Stepper Motor Controller",self.controller)
+        self.motor=aptlib.AptMotor()
+    def tearDown(self):
+        self.controller.close()
+        del self.motor
+    def testWaitingInFutureCallbackRaises(self):
+        errors=[]
+        called=threading.Event()
+        def callback(future):
+            try:
+                self.motor.GetPosition(0)
+            except RuntimeError as e:
+                errors.append(e)
+            finally:
+                called.set()
+        future=self.motor.MoveAbsoluteEncAsync(0,1.0)
+        future.add_done_callback(callback)
+        aptlib.waitForResponses([future])
+        called.wait(1)
+        self.assertEqual(len(errors),1)
+        self.assertAlmostEqual(self.motor.GetPosition(0),1.0,3)
+    def testPositionFromStatusUpdateAfterMove(self):
+        self.motor.startUpdates()
+        self.assertEqual(self.motor.GetPosition(0),0)
+        # The move completes before the next status update, so the position must come from a later update
+        self.motor.MoveAbsoluteEnc(0,1.0)
+        self.assertAlmostEqual(self.motor.GetPosition(0),1.0,3)
+        self.motor.stopUpdates()
+    def testUnsupportedControllerDoesNotStartUpdates(self):
+        self.motor.controllerType="BSC102"
+        numWritten=len(self.controller.device.written)
+        self.assertRaises(NotImplementedError,self.motor.startUpdates)
+        self.assertEqual(len(self.controller.device.written),numWritten)
+        self.assertFalse(self.motor.updatesEnabled)
+
+class TrajectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.sim=useSimulator()
+        self.controller=SimulatedMotorController(moveTime={c.CHANNEL_1:0.06,c.CHANNEL_2:0.01})
+        self.controller.device=self.sim.addFtdiDevice("83000001","APT Stepper Motor Controller",self.controller)
+        self.motor=aptlib.AptMotor()
+    def tearDown(self):
+        self.controller.close()
+        del self.motor
+    def testUnsynchronizedAxisLeadsByAtMostOneWaypoint(self):
+        reached=[]
+        trajectory=aptlib.Trajectory([(self.motor,0),(self.motor,1)])
+        trajectory.run([(x,x) if x!=3 else (x,None) for x in range(1,7)],synchronize=False,onWaypoint=reached.append)
+        self.assertEqual(reached,range(6))
+        # Number of waypoints reached by each channel, where waypoint index is at x=index+1
+        reachedCount={c.CHANNEL_1:0,c.CHANNEL_2:0}
+        started=[]
+        for event,channelID,position in self.controller.moves:
+            index=int(round(self.motor._encToPosition(position)))-1
+            if event=="started":
+                other=c.CHANNEL_2 if channelID==c.CHANNEL_1 else c.CHANNEL_1
+                # A channel may only start moving to waypoint index once the other channel has reached waypoint index-2
+                self.assertLessEqual(index,reachedCount[other]+1)
+                started.append((channelID,index))
+            else:
+                reachedCount[channelID]=index+1
+        self.assertEqual(sorted(started),[(c.CHANNEL_1,index) for index in range(6)]+[(c.CHANNEL_2,index) for index in (0,1,3,4,5)])
+    def testVelocityKeepsCurrentAcceleration(self):
+        self.controller.velParams[c.CHANNEL_2]=(0,9000,1000000)
+        aptlib.Trajectory([(self.motor,0),(self.motor,1)],velocity=2.0).run([(1,1)])
+        self.assertEqual(self.controller.velParams[c.CHANNEL_1],(0,4500,int(self.motor._velocityToEnc(2.0))))
+        self.assertEqual(self.controller.velParams[c.CHANNEL_2],(0,9000,int(self.motor._velocityToEnc(2.0))))
+        self.assertAlmostEqual(self.motor.GetVelParams(1)[1],self.motor._encToAcceleration(9000))
+
+class AptPiezoTest(unittest.TestCase):
+    def setUp(self):
+        self.sim=useSimulator()
+        self.controller=SimulatedPiezoController()
+        self.controller.device=self.sim.addFtdiDevice("81000001","APT Piezo",self.controller)
+        self.piezo=aptlib.AptPiezo()
+    def tearDown(self):
+        self.controller.close()
+        del self.piezo
+    def testZeroWaitsForStatusUpdateAfterCommand(self):
+        self.piezo.startUpdates()
+        self.assertFalse(self.piezo.isZeroing(0))
+        t0=time.time()
+        self.piezo.zero(0)
+        self.assertGreaterEqual(time.time()-t0,self.controller.zeroTime)
+        self.assertFalse(self.piezo.isZeroing(0))
+        self.piezo.stopUpdates()
+
+if __name__=="__main__":
+    unittest.main()
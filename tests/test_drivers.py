@@ -0,0 +1,132 @@
+""" Smoke tests which create each driver against the simulated transport and exercise its basic commands """
+from __future__ import division
+import os,shutil,tempfile,unittest
+import numpy
+from drivepy.tests import useSimulator
+from drivepy.tests.test_aptlib import SimulatedMotorController,SimulatedPiezoController
+from drivepy.tests.test_powermeters import SimulatedNewportMeter
+from drivepy.tests.test_spectrumanalyzers import SimulatedOSA,SimulatedSA
+import drivepy.advantest.spectrumanalyzer as advantest
+import drivepy.agilent.powermeter as agilent
+import drivepy.anritsu.spectrumanalyzer as anritsu
+import drivepy.keithley.dmm as dmm
+import drivepy.keithley.smu as smu
+import drivepy.newfocus.powermeter as newfocus
+import drivepy.newport.powermeter as newport
+import drivepy.thorlabs.fw102c.filterwheel as filterwheel
+from drivepy.thorlabs.aptlib import aptlib
+try:
+    import drivepy.hp.pulsegen as pulsegen
+    import drivepy.scientificinstruments.temperaturecontroller as temperaturecontroller
+except ImportError:
+    # These drivers need PyQt4
+    pulsegen=temperaturecontroller=None
+
+class SimulatedFilterWheel(object):
+    """ Responder for the FW102C filter wheel, which stores each "name=value" setting and returns it for "name?" """
+    def __init__(self):
+        self.settings={"pos":"1","pcount":"6","trig":"0","speed":"0","sensors":"0"}
+    def __call__(self,command):
+        command=command.strip()
+        if command.endswith("?"):
+            return self.settings.get(command[:-1])
+        name,_,value=command.partition("=")
+        if name in self.settings:
+            self.settings[name]=value
+
+class DriverSmokeTest(unittest.TestCase):
+    def setUp(self):
+        self.sim=useSimulator()
+    def testAdvantestSpectrumAnalyzer(self):
+        responder=SimulatedOSA()
+        self.sim.addVisaInstrument("GPIB::10",responder)
+        osa=advantest.SpectrumAnalyzer("GPIB::10")
+        wavelength,level=osa.obtainSpectrum()
+        numpy.testing.assert_array_equal(level,responder.level)
+        del osa
+    def testAnritsuSpectrumAnalyzer(self):
+        self.sim.addVisaInstrument("GPIB::2",SimulatedSA())
+        sa=anritsu.SpectrumAnalyzer("GPIB::2")
+        frequency,power=sa.obtainSpectrum()
+        self.assertEqual(len(frequency),len(power))
+        del sa
+    def testKeithleySMU(self):
+        self.sim.addVisaInstrument("GPIB::25",{":READ?":"1.25,0.01"})
+        instrument=smu.SMU("GPIB::25")
+        instrument.setCurrent(10e-3)
+        self.assertEqual(instrument.measure(),(1.25,0.01))
+        instrument.setOutputState(0)
+        del instrument
+    def testKeithleyDMM(self):
+        self.sim.addVisaInstrument("GPIB::1",{":READ?":"0.5","*OPC?":"1",":TRAC:DATA?":"0.1,0.2,0.3"})
+        instrument=dmm.DMM("GPIB::1")
+        self.assertEqual(instrument.measure(),0.5)
+        numpy.testing.assert_array_equal(instrument.measureBurst(3),[0.1,0.2,0.3])
+        del instrument
+    def testAgilentPowerMeter(self):
+        self.sim.addVisaInstrument("GPIB::20",{"READ1:CHAN1:POW?":"1e-3"})
+        meter=agilent.PowerMeter("GPIB::20")
+        self.assertEqual(meter.readPower(),1e-3)
+        del meter
+    def testNewportPowerMeter(self):
+        self.sim.addNewportDevice(1,"1936-R SN1234",SimulatedNewportMeter())
+        cacheDir=tempfile.mkdtemp()
+        rangeCacheFile=newport.RANGE_CACHE_FILE
+        newport.RANGE_CACHE_FILE=os.path.join(cacheDir,"newport_ranges.json")
+        try:
+            meter=newport.PowerMeter()
+            self.assertAlmostEqual(meter.readPower(tau=10),1e-5)
+            del meter
+        finally:
+            newport.RANGE_CACHE_FILE=rangeCacheFile
+            shutil.rmtree(cacheDir)
+    def testNewfocusPowerMeter(self):
+        self.sim.addVisaInstrument("GPIB::1",{"*OPC?":"1",":TRAC:DATA?":"0.1,0.3,0.2"})
+        meter=newfocus.PowerMeter("GPIB::1")
+        # readPower() itself refers to undefined names, so drive the DMM readings through its helpers
+        self.assertAlmostEqual(meter._voltageToPower(meter._bestOfN(3)),0.3*newfocus.SENSITIVITY/newfocus.INSERTION_LOSS)
+        del meter
+    def testFilterWheel(self):
+        responder=SimulatedFilterWheel()
+        self.sim.addUartDevice(3,responder)
+        wheel=filterwheel.FilterWheel(None)
+        self.assertEqual(responder.settings["speed"],"1")
+        wheel.setPosition(4)
+        self.assertEqual(wheel.getPosition(),4)
+        self.assertEqual(wheel.getPositionCount(),6)
+        self.assertRaises(filterwheel.InvalidValueError,wheel.setPosition,7)
+        del wheel
+    def testAptMotor(self):
+        controller=SimulatedMotorController()
+        controller.device=self.sim.addFtdiDevice("83000001","APT Stepper Motor Controller",controller)
+        motor=aptlib.AptMotor()
+        motor.setPosition(1,2.5)
+        self.assertAlmostEqual(motor.getPosition(1),2.5,3)
+        del motor
+    def testAptPiezo(self):
+        controller=SimulatedPiezoController()
+        controller.device=self.sim.addFtdiDevice("81000001","APT Piezo",controller)
+        piezo=aptlib.AptPiezo()
+        self.assertAlmostEqual(piezo.maxExtension,20)
+        piezo.setPosition(0,10)
+        self.assertAlmostEqual(piezo.getPosition(0),10,2)
+        piezo.zero(0)
+        self.assertFalse(piezo.isZeroing(0))
+        del piezo
+    @unittest.skipIf(pulsegen is None,"PyQt4 is not installed")
+    def testHPPulseGenerator(self):
+        instrument=self.sim.addVisaInstrument("GPIB::14",{})
+        generator=pulsegen.PulseGenerator("GPIB::14")
+        generator.setOutputState(True)
+        self.assertIn(":OUTP ON",instrument.written)
+        del generator
+    @unittest.skipIf(temperaturecontroller is None,"PyQt4 is not installed")
+    def testTemperatureController(self):
+        self.sim.addVisaInstrument("GPIB::15",{"T":"T295.5","S":"S300.0"})
+        controller=temperaturecontroller.TemperatureController("GPIB::15")
+        self.assertEqual(controller.getTemperature(),295.5)
+        controller.setTemperature(300)
+        del controller
+
+if __name__=="__main__":
+    unittest.main()
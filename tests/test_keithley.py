@@ -0,0 +1,62 @@
+from __future__ import division
+import unittest
+import numpy
+from drivepy.tests import useSimulator
+import drivepy.keithley.dmm as dmm
+import drivepy.keithley.smu as smu
+
+class SMUBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.sim=useSimulator()
+        self.instrument=self.sim.addVisaInstrument("GPIB::25",{})
+        self.sleep=smu.sleep
+        smu.sleep=self.recordSleep
+        self.sentBeforeSleep=[]
+    def tearDown(self):
+        smu.sleep=self.sleep
+    def recordSleep(self,t):
+        self.sentBeforeSleep.append("".join(self.instrument.written))
+    def testSetupIsBatched(self):
+        instrument=smu.SMU("GPIB::25")
+        # the commands before the output is switched on are sent together, and the rest when the batch exits
+        self.assertEqual(self.sim.transactionCount,2)
+        self.assertIn(":OUTP ON",self.sentBeforeSleep[0])
+        del instrument
+
+class SMUSweepTest(unittest.TestCase):
+    def setUp(self):
+        self.sim=useSimulator()
+        self.instrument=self.sim.addVisaInstrument("GPIB::25",{"*OPC?":"1",":SOUR:DEL?;:SOUR:DEL:AUTO?":"0.005;1",":TRAC:DATA?":self.readBuffer})
+        self.smu=smu.SMU("GPIB::25")
+    def tearDown(self):
+        del self.smu
+    def readBuffer(self,command):
+        return ",".join(repr(current*100)+","+repr(current) for current in self.currents)
+    def testRepeatedSweepReloadsSourceList(self):
+        self.currents=numpy.linspace(0,1e-3,150)
+        for i in range(2):
+            voltages,currents=self.smu.sweepCurrent(self.currents)
+            numpy.testing.assert_allclose(currents,self.currents)
+        loads=[command for message in self.instrument.written for command in message.split(";") if command.startswith(":SOUR:LIST:CURR")]
+        self.assertEqual([command.split()[0] for command in loads],[":SOUR:LIST:CURR",":SOUR:LIST:CURR:APP"]*2)
+    def testSourceDelayIsRestored(self):
+        self.currents=[1e-3]
+        self.smu.sweepCurrent(self.currents,delay=0.1)
+        self.assertTrue(self.instrument.written[-1].endswith(":SOUR:DEL 0.005;:SOUR:DEL:AUTO ON"))
+
+class DMMSettingsTest(unittest.TestCase):
+    def setUp(self):
+        self.sim=useSimulator()
+        self.instrument=self.sim.addVisaInstrument("GPIB::1",{})
+        self.dmm=dmm.DMM("GPIB::1")
+    def tearDown(self):
+        del self.dmm
+    def testRepeatedSetAutoIsSkipped(self):
+        self.dmm.setAuto()
+        numWritten=len(self.instrument.written)
+        self.dmm.setAuto()
+        self.assertEqual(len(self.instrument.written),numWritten)
+        self.assertEqual(self.instrument.written[-1],":SENS:VOLT:DC:RANG:AUTO 1")
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+from __future__ import division
+import json,os,shutil,tempfile,time,unittest,warnings
+import numpy
+from drivepy.tests import useSimulator
+import drivepy.agilent.powermeter as agilent
+import drivepy.newport.powermeter as newport
+
+class SimulatedNewportMeter(object):
+    """ Responder for the Newport 1936/2936 meter, measuring a constant power with a data store that fills at 1 sample/ms """
+    def __init__(self,serial="1234",power=1e-5):
+        self.serial=serial
+        self.power=power
+        self.range=0
+        self.units=2
+        self.size=1
+        self.circular=False
+        self.enabled=None
+        self.corrupt=False      # replace a sample in data store dumps with an unparsable value
+        self.countStops=False   # stop counting ring buffer samples once the buffer is full
+        self.countWraps=False   # count ring buffer samples modulo the buffer size
+    def __call__(self,data):
+        command=data.strip().lower()
+        header,_,value=command.partition(" ")
+        if header=="pm:detsn?":
+            return self.serial
+        elif header=="pm:ran":
+            self.range=int(value)
+        elif header=="pm:units":
+            self.units=int(value)
+        elif header=="pm:max:power?":
+            # W, or dBm when the units are 3
+            return repr(10*self.range-30 if self.units==3 else 10**(self.range-6))
+        elif header=="pm:p?":
+            return repr(self.power)
+        elif header=="pm:pws?":
+            return repr(self.power)+", 0"
+        elif header=="pm:ds:size":
+            self.size=int(value)
+        elif header=="pm:ds:buffer":
+            self.circular=bool(int(value))
+        elif header=="pm:ds:enable":
+            self.enabled=time.time() if int(value) else None
+        elif header=="pm:ds:count?":
+            # the count doesn't work when saturating
+            return str(self.count()) if self.power<=10**(self.range-6) else "0"
+        elif header=="pm:ds:get?":
+            if value.startswith("+"):
+                numSamples=int(value[1:])
+            else:
+                first,last=[int(index) for index in value.split("-")]
+                numSamples=last-first+1
+            samples=["%.6E"%self.power]*numSamples
+            if self.corrupt:
+                samples[numSamples//2]="ERROR"
+            return "Header\r\nEnd of Header\r\n"+"".join(sample+"\r\n" for sample in samples)+"End of Data"
+    def count(self):
+        """ Number of samples acquired since the data store was enabled, which fill a linear data store instantly """
+        if not self.circular:
+            return self.size if self.enabled else 0
+        count=int((time.time()-self.enabled)/1e-3) if self.enabled else 0
+        if self.countWraps:
+            return count%self.size
+        return min(count,self.size) if self.countStops else count
+
+class AgilentTest(unittest.TestCase):
+    def setUp(self):
+        self.sim=useSimulator()
+        self.readings=iter([1e-3,2e-3,3e-3,4e-3,5e-3,6e-3])
+        self.sim.addVisaInstrument("GPIB::20",{"READ1:CHAN1:POW?":lambda command: repr(next(self.readings))})
+        self.meter=agilent.PowerMeter("GPIB::20")
+    def tearDown(self):
+        del self.meter
+    def testStatisticsAreReusedAndReset(self):
+        statistics=self.meter.lastStatistics
+        self.assertEqual(self.meter.readPower(),1e-3)
+        self.assertEqual(self.meter.readPower(tau=60,mode="max"),4e-3)
+        self.assertIs(self.meter.lastStatistics,statistics)
+        self.assertEqual((statistics.count,statistics.min),(3,2e-3))
+
+class NewportTest(unittest.TestCase):
+    def setUp(self):
+        self.sim=useSimulator()
+        self.responder=SimulatedNewportMeter()
+        self.sim.addNewportDevice(1,"1936-R SN1234",self.responder)
+        self.cacheDir=tempfile.mkdtemp()
+        self.rangeCacheFile=newport.RANGE_CACHE_FILE
+        newport.RANGE_CACHE_FILE=os.path.join(self.cacheDir,"newport_ranges.json")
+        self.meter=newport.PowerMeter()
+    def tearDown(self):
+        del self.meter
+        newport.RANGE_CACHE_FILE=self.rangeCacheFile
+        shutil.rmtree(self.cacheDir)
+    def testReadPower(self):
+        self.assertAlmostEqual(self.meter.readPower(tau=50),1e-5)
+        self.assertEqual(self.meter.lastStatistics.count,50)
+    def testSaturatedReadingStepsUpOneRange(self):
+        self.responder.power=5e-6
+        self.meter.setRange(0)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            self.assertAlmostEqual(self.meter.readPower(tau=10),5e-6)
+        self.assertEqual(caught,[])
+        self.assertEqual(self.meter.range,1)
+        self.assertEqual([(oldRange,newRange) for _,oldRange,newRange,_ in self.meter.rangingLog],[(0,1)])
+    def testRangeCacheDependsOnUnits(self):
+        self.meter.setUnits(3)
+        self.assertEqual(self.meter.rangeDic[1],-20)
+        with open(newport.RANGE_CACHE_FILE) as f:
+            self.assertEqual(sorted(json.load(f)),["1234@1300/2","1234@1300/3"])
+        self.meter.setUnits(2)
+        self.assertEqual(self.meter.rangeDic[1],1e-5)
+    def testStreamPower(self):
+        stream=self.meter.streamPower(chunkSize=20,bufferSize=100)
+        timestamps,samples=next(stream)
+        self.assertGreaterEqual(len(samples),20)
+        self.assertEqual(len(timestamps),len(samples))
+        numpy.testing.assert_allclose(samples,1e-5)
+        stream.close()
+    def testStalledStreamRaises(self):
+        self.responder.countStops=True
+        readTimeout=newport.READ_TIMEOUT
+        newport.READ_TIMEOUT=0.2
+        try:
+            stream=self.meter.streamPower(chunkSize=40,bufferSize=100)
+            self.assertEqual(len(next(stream)[1]),40)
+            t0=time.time()
+            self.assertRaises(newport.CommError,list,stream)
+            self.assertGreaterEqual(time.time()-t0,0.2)
+        finally:
+            newport.READ_TIMEOUT=readTimeout
+    def testWrappingStreamCountRaises(self):
+        self.responder.countWraps=True
+        stream=self.meter.streamPower(chunkSize=40,bufferSize=100)
+        self.assertRaisesRegexp(newport.CommError,"went back",list,stream)
+    def testDataStoreReadUsesReceiveBuffer(self):
+        numpy.testing.assert_allclose(self.meter.readPowerN(500),1e-5)
+        self.assertEqual(self.meter.connection.readBufferSize,newport.DATA_STORE_HEADER_SIZE+500*newport.DATA_STORE_BYTES_PER_SAMPLE)
+        self.assertEqual(len(self.meter.connection.readBuffer),self.meter.connection.readBufferSize)
+        self.assertEqual(self.meter.getDetectorSerial(),"1234")
+    def testTruncatedDataStoreRaises(self):
+        self.responder.corrupt=True
+        self.assertRaises(newport.CommError,self.meter.readPowerN,50)
+
+class NewportSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.sim=useSimulator()
+        self.sim.addNewportDevice(1,"1936-R SN1234",SimulatedNewportMeter("1234"))
+        self.sim.addNewportDevice(2,"2936-R SN5678",SimulatedNewportMeter("5678"),pid=0xcec8)
+    def testDevicesAreFilteredByPid(self):
+        first=newport.USBConnection(0xcec7)
+        second=newport.USBConnection(0xcec8)
+        self.assertEqual((first.id,second.id),(1,2))
+        self.assertEqual(newport.getDeviceList(0xcec8),{2:"2936-R SN5678"})
+        self.assertRaises(newport.CommError,newport.USBConnection,0xcec7,serial="5678")
+        self.assertEqual(first.query("PM:DETSN?"),"1234")
+        del first,second
+        self.assertIs(newport._usbSession,None)
+
+if __name__=="__main__":
+    unittest.main()
@@ -0,0 +1,119 @@
+from __future__ import division
+import threading,unittest
+import numpy
+from drivepy.tests import useSimulator
+import drivepy.advantest.spectrumanalyzer as advantest
+import drivepy.anritsu.spectrumanalyzer as anritsu
+
+class SimulatedOSA(object):
+    """ Responder for the Advantest OSA, which returns the same spectrum in ASCII (FMT0) or IEEE-488.2 binary block (FMT1) format """
+    def __init__(self,numPoints=501):
+        self.wavelength=numpy.linspace(1500,1600,numPoints)
+        self.level=numpy.random.RandomState(0).uniform(-80,0,numPoints)
+        self.binary=False
+    def __call__(self,command):
+        if command.startswith("FMT"):
+            self.binary=command.startswith("FMT1")
+        elif command=="MEA1":
+            self.sweepThread=threading.current_thread()
+        elif command=="ODN?":
+            return str(len(self.wavelength))
+        elif command in ("OSD0","OSD1"):
+            data=self.level if command=="OSD0" else self.wavelength
+            if self.binary:
+                raw=data.astype(">f8").tostring()
+                length=str(len(raw))
+                return "#"+str(len(length))+length+raw
+            return "\r".join(repr(value) for value in data)
+
+class SimulatedSA(object):
+    """ Responder for the Anritsu SA, which returns the same trace in units of 0.01dBm as ASCII (BIN 0) or raw big endian 16 bit integers (BIN 1).
+    The commands of a semicolon joined message (as sent by batch()) are executed in turn """
+    def __init__(self):
+        self.level=numpy.random.RandomState(0).randint(-8000,0,501)
+        self.binary=False
+    def __call__(self,message):
+        replies=[reply for reply in (self.execute(command.lstrip(":")) for command in message.split(";")) if reply is not None]
+        return replies[-1] if replies else None
+    def execute(self,command):
+        if command.startswith("BIN "):
+            self.binary=command=="BIN 1"
+        elif command.startswith("XMA?"):
+            start,numPoints=[int(value) for value in command[5:].split(",")]
+            level=self.level[start:start+numPoints]
+            return level.astype(">i2").tostring() if self.binary else ",".join(str(value) for value in level)
+        elif command=="STF?":
+            return "STF 1000000000"
+        elif command=="SOF?":
+            return "SOF 2000000000"
+
+class AdvantestTest(unittest.TestCase):
+    def setUp(self):
+        self.sim=useSimulator()
+        self.responder=SimulatedOSA()
+        self.instrument=self.sim.addVisaInstrument("GPIB::10",self.responder)
+        self.osa=advantest.SpectrumAnalyzer("GPIB::10")
+    def tearDown(self):
+        del self.osa
+    def testDefaultFormatIsAscii(self):
+        self.assertEqual(self.osa.dataFormat,"ASCII")
+    def testBinaryMatchesAscii(self):
+        asciiWavelength,asciiLevel=self.osa.obtainSpectrum()
+        self.osa.setDataFormat("BINARY")
+        self.osa.setNumPoints(len(asciiLevel))   # read the wavelength axis again
+        binaryWavelength,binaryLevel=self.osa.obtainSpectrum()
+        self.assertIn("FMT1,HED0,SDL2",self.instrument.written)
+        numpy.testing.assert_array_equal(binaryWavelength,asciiWavelength)
+        numpy.testing.assert_array_equal(binaryLevel,asciiLevel)
+        numpy.testing.assert_array_equal(binaryLevel,self.responder.level)
+    def testAsyncSweepIsStartedByWorker(self):
+        future=self.osa.obtainSpectrumAsync()
+        wavelength,level=future.result(5)
+        numpy.testing.assert_array_equal(level,self.responder.level)
+        self.assertIsNot(self.responder.sweepThread,threading.current_thread())
+    def testCachedWavelengthIsReadOnly(self):
+        wavelength,level=self.osa.obtainSpectrum()
+        self.assertRaises(ValueError,wavelength.__setitem__,0,0)
+        self.assertIs(self.osa.obtainSpectrum()[0],wavelength)
+    def testSpectrumInsideBatch(self):
+        for dataFormat in ("ASCII","BINARY"):
+            self.osa.setDataFormat(dataFormat)
+            with self.osa._osa.batch():
+                wavelength,level=self.osa.obtainSpectrum()
+            numpy.testing.assert_array_equal(level,self.responder.level)
+
+class AnritsuTest(unittest.TestCase):
+    def setUp(self):
+        self.sim=useSimulator()
+        self.responder=SimulatedSA()
+        self.instrument=self.sim.addVisaInstrument("GPIB::2",self.responder)
+        self.sa=anritsu.SpectrumAnalyzer("GPIB::2")
+    def tearDown(self):
+        del self.sa
+    def testDefaultFormatIsAscii(self):
+        self.assertEqual(self.sa.dataFormat,"ASCII")
+    def testBinaryMatchesAscii(self):
+        asciiFrequency,asciiPower=self.sa.obtainSpectrum()
+        self.sa.setDataFormat("BINARY")
+        binaryFrequency,binaryPower=self.sa.obtainSpectrum()
+        self.assertIn("BIN 1",self.instrument.written)
+        numpy.testing.assert_array_equal(binaryFrequency,asciiFrequency)
+        numpy.testing.assert_allclose(binaryPower,asciiPower,rtol=1e-12)
+        numpy.testing.assert_allclose(asciiPower,10**(self.responder.level/1000)/1000,rtol=1e-12)
+    def testSpectrumInsideBatch(self):
+        for dataFormat in ("ASCII","BINARY"):
+            self.sa.setDataFormat(dataFormat)
+            frequency,power=self.sa.obtainSpectrum()
+            with self.sa._sa.batch():
+                batchFrequency,batchPower=self.sa.obtainSpectrum()
+            numpy.testing.assert_array_equal(batchPower,power)
+    def testStreamedSpectraMatchObtainSpectrum(self):
+        for dataFormat in ("ASCII","BINARY"):
+            self.sa.setDataFormat(dataFormat)
+            frequency,power=self.sa.obtainSpectrum()
+            for streamedFrequency,streamedPower in self.sa.streamSpectra(3):
+                numpy.testing.assert_array_equal(streamedFrequency,frequency)
+                numpy.testing.assert_allclose(streamedPower,power,rtol=1e-12)
+
+if __name__=="__main__":
+    unittest.main()
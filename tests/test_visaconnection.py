@@ -0,0 +1,93 @@
+from __future__ import division
+import threading,unittest
+from drivepy.tests import useSimulator
+from drivepy.visaconnection import VisaConnection
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.sim=useSimulator()
+        self.instrument=self.sim.addVisaInstrument("GPIB::1",{"*OPC?":"1"})
+        self.conn=VisaConnection("GPIB::1")
+    def tearDown(self):
+        self.conn.close()
+    def testCommandsAreSentInOneTransaction(self):
+        with self.conn.batch():
+            for i in range(10):
+                self.conn.write(":SOUR:CURR:LEV "+str(i))
+            self.assertEqual(self.sim.transactionCount,0)
+        self.assertEqual(self.sim.transactionCount,1)
+        self.assertEqual(self.instrument.written,[";".join(":SOUR:CURR:LEV "+str(i) for i in range(10))])
+    def testMessagesAreSplitAtInputBufferSize(self):
+        self.conn.inputBufferSize=40
+        with self.conn.batch():
+            for i in range(10):
+                self.conn.write(":SOUR:CURR:LEV "+str(i))
+        self.assertEqual(self.sim.transactionCount,5)
+        self.assertTrue(all(len(message)<=40 for message in self.instrument.written))
+    def testQueryFlushesBatch(self):
+        with self.conn.batch():
+            self.conn.write("*CLS")
+            self.conn.readQuery("*OPC?")
+            self.assertEqual(self.instrument.written,["*CLS","*OPC?"])
+    def testOnlyCommandsAfterSemicolonAreMadeAbsolute(self):
+        with self.conn.batch():
+            self.conn.write("FMT1,HED0")
+        with self.conn.batch():
+            self.conn.write("SOUR:DEL 0")
+            self.conn.write("SOUR:CURR:LEV 0")
+        self.assertEqual(self.instrument.written,["FMT1,HED0","SOUR:DEL 0;:SOUR:CURR:LEV 0"])
+    def testBatchIsPerThread(self):
+        other=VisaConnection("GPIB::1")
+        with self.conn.batch():
+            self.conn.write("*CLS")
+            thread=threading.Thread(target=other.write,args=(":SYST:BEEP:STAT OFF",))
+            thread.start()
+            thread.join()
+            # the other thread's command isn't held back by, or swept into, this thread's batch
+            self.assertEqual(self.instrument.written,[":SYST:BEEP:STAT OFF"])
+        self.assertEqual(self.instrument.written,[":SYST:BEEP:STAT OFF","*CLS"])
+        other.close()
+
+class SettingsCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.sim=useSimulator()
+        self.instrument=self.sim.addVisaInstrument("GPIB::2",{})
+        self.conn=VisaConnection("GPIB::2")
+        self.conn.cacheSettings([":SENS:CURR:RANG:UPP",":SENS:CURR:RANG:AUTO",":SOUR:CURR:LEV"])
+    def tearDown(self):
+        self.conn.close()
+    def testOnlyCachedSettingsAreSkipped(self):
+        for i in range(2):
+            self.conn.write(":SOUR:CURRENT:LEVEL 1e-3")
+            self.conn.write(":SOUR:DEL 0")
+        self.assertEqual(self.instrument.written,[":SOUR:CURRENT:LEVEL 1e-3",":SOUR:DEL 0",":SOUR:DEL 0"])
+    def testOutputAndListCommandsCantBeCached(self):
+        self.assertRaises(ValueError,self.conn.cacheSettings,[":OUTP"])
+        self.assertRaises(ValueError,self.conn.cacheSettings,[":SOUR:LIST:CURR"])
+    def testCoupledSettingsAreForgotten(self):
+        self.conn.write(":SENS:CURR:RANG:AUTO OFF")
+        self.conn.write(":SENS:CURR:RANG:UPP 1e-3")
+        self.conn.write(":SENS:CURR:RANG:AUTO OFF")
+        self.assertEqual(len(self.instrument.written),3)
+    def testCoupledSettingsAreForgottenInBatch(self):
+        with self.conn.batch():
+            self.conn.write(":SENS:CURR:RANG:UPP 1e-3")
+            self.conn.write(":SENS:CURR:RANG:AUTO ON")
+        self.conn.write(":SENS:CURR:RANG:UPP 1e-3")
+        self.assertEqual(len(self.instrument.written),2)
+    def testCacheIsOnlyUpdatedAfterWrite(self):
+        def fail(writeString):
+            raise IOError,"Timeout"
+        write,self.conn.lib.write=self.conn.lib.write,fail
+        self.assertRaises(IOError,self.conn.write,":SOUR:CURR:LEV 1e-3")
+        self.conn.lib.write=write
+        self.conn.write(":SOUR:CURR:LEV 1e-3")
+        self.assertEqual(self.instrument.written,[":SOUR:CURR:LEV 1e-3"])
+    def testResetClearsCache(self):
+        self.conn.write(":SOUR:CURR:LEV 1e-3")
+        self.conn.write("*RST")
+        self.conn.write(":SOUR:CURR:LEV 1e-3")
+        self.assertEqual(len(self.instrument.written),3)
+
+if __name__=="__main__":
+    unittest.main()
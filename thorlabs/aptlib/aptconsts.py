@@ -1,106 +1,89 @@
 from __future__ import division
 from string import upper
+from struct import Struct
 
 # Header structure with and without data packet attached
 NUM_HEADER_BYTES=6  # number of bytes to read for message headers
 HEADER_FORMAT_WITHOUT_DATA = '<HBBBB'
 HEADER_FORMAT_WITH_DATA = '<HHBB'
-# Packet Structures (list of bytes required for each value in the packet)
-def getPacketStruct(msgID):
-    """ given msgID return a format string which can be used by struct.pack and struct.unpack to convert the message data packet to and from hex.
-   Note: all messages with data packets should be accounted for here, but there are almost certainly data entry errors, so some may be missing or incorrect. Few of them have been tested """
+# Packet Structures (list of bytes required for each value in the packet) for all messages with data packets.
+# Note: all messages with data packets should be accounted for here, but there are almost certainly data entry errors, so some may be missing or incorrect. 
+# Few of them have been tested. Where a messageID is listed more than once, the first structure is used
+PACKET_FORMATS=[
     # 1 word
-    if msgID in [0x07D1,0x07D3,0x07E8,0x07EA,0x0875]:
-        return '<H'
+    ('<H',[0x07D1,0x07D3,0x07E8,0x07EA,0x0875]),
     # 2 words
-    elif msgID in [0x042C,0x04B3,0x04B5,0x04FB,0x04FD,0x0643,0x0645,0x0646,0x0648,0x0652,0x0654,0x07D0,0x0651,0x0609,0x0611,0x07E7]:
-        return '<HH'
+    ('<HH',[0x042C,0x04B3,0x04B5,0x04FB,0x04FD,0x0643,0x0645,0x0646,0x0648,0x0652,0x0654,0x07D0,0x0651,0x0609,0x0611,0x07E7]),
     # 3 words
-    elif msgID in [0x0655,0x0657,0x0700,0x0702,0x04B9,0x0680,0x0682,0x0683,0x0685,0x07DE]:
-        return '<HHH'
+    ('<HHH',[0x0655,0x0657,0x0700,0x0702,0x04B9,0x0680,0x0682,0x0683,0x0685,0x07DE]),
     # 5 words
-    elif msgID in [0x0426,0x0428,0x07D4,0x07D6,0x0670,0x0672]:
-        return '<HHHHH'
+    ('<HHHHH',[0x0426,0x0428,0x07D4,0x07D6,0x0670,0x0672]),
     # 6 words
-    elif msgID in [0x04E0,0x04E2,0x0618,0x0620]:
-        return '<HHHHHH'
+    ('<HHHHHH',[0x04E0,0x04E2,0x0618,0x0620]),
     # 7 words
-    elif msgID in [0x07DA,0x07DC,0x04DA,0x04DC,0x04E0,0x04E2]:
-        return '<HHHHHHH'
+    ('<HHHHHHH',[0x07DA,0x07DC,0x04DA,0x04DC,0x04E0,0x04E2]),
     # 9 words
-    elif msgID in [0x04E9,0x04EB]:
-        return '<HHHHHHHHH'
+    ('<HHHHHHHHH',[0x04E9,0x04EB]),
     # 1 word + 1 long
-    elif msgID in [0x0410,0x0412,0x0409,0x040B,0x0453]:
-        return "<Hl"
+    ("<Hl",[0x0410,0x0412,0x0409,0x040B,0x0453]),
     # 1 word + 3 longs
-    elif msgID in [0x043A,0x043C,0x0445,0x0447,0x0450,0x0452,0x0448,0x0413,0x0415]:
-        return "<Hlll"
-    elif msgID in [0x0481,0x0466,0x0464]:
-        return "<HllI"
-    elif msgID in [0x04E6,0x04E8]:
-        return "<HllllH"
-    elif msgID in [0x0703,0x0705,0x04C3,0x04C5]:
-        return "<HHHllllHlH"
-    elif msgID in [0x04A0,0x04A2,0x042A]:
-        return "<HlllH"
-    elif msgID in [0x065C,0x063F]:
-        return "<HI"
-    elif msgID in [0x0440,0x0442]:
-        return "<HHHll"
-    elif msgID in [0x0416,0x0418]:
-        return "<HHllllH"
-    elif msgID in [0x0423,0x0425]:
-        return "<HHHllH"
-    elif msgID in [0x04B0,0x04B2]:
-        return "<HHlHlHlHl"
-    elif msgID in [0x04B6,0x04B8]:
-        return "<HHllHH"
-    elif msgID in [0x04E3,0x04E5]:
-        return "<HHIHH"
-    elif msgID in [0x04D7,0x04D9]:
-        return "<HHHIHHHHHIHH"
-    elif msgID in [0x04F0,0x04F2]:
-        return "<HH16sIIlllllHHHHIIII"
-    elif msgID in [0x0606,0x0608]:
-        return "<f"
-    elif msgID in [0x0621,0x0623]:
-        return "<"+("H"*32)
-    elif msgID in [0x0626,0x0628]:
-        return "<Hhh"
-    elif msgID in [0x0630,0x0632]:
-        return "<HhhhHH"
-    elif msgID in [0x0633,0x0635]:
-        return "<Hh"
-    elif msgID in [0x0636,0x0638]:
-        return "<l"
-    elif msgID in [0x07EB,0x07ED]:
-        return "<hh4x"
-    elif msgID==0x0661:
-        return "<HhhI"
-    elif msgID==0x0081:
-        return "<HH64s"
-    elif msgID==0x0006:
-        return '<l8sHI48s12xHHH'
-    elif msgID==0x0227:
-        return "<I"
-    elif msgID==0x0491:
-        return "<HlHHI"
-    elif msgID ==0x0614:
-        return "<HHfHHH"
-    elif msgID ==0x063A:
-        return "<fHH"
-    elif msgID ==0x0665:
-        return "<HHHfHHHIhhh"
-    elif msgID ==0x0821:
-        return "<HHI"
-    elif msgID ==0x0881:
-        return "<hhHhhI"
-    elif msgID in [0x0800,0x0802,0x0870,0x0872]:
-        raise Exception, "Message " + hex(msgID) + " has a variable data packet structure due to the use of submessages, which hasn't been implemented yet"
-    else:
+    ("<Hlll",[0x043A,0x043C,0x0445,0x0447,0x0450,0x0452,0x0448,0x0413,0x0415]),
+    ("<HllI",[0x0481,0x0466,0x0464]),
+    ("<HllllH",[0x04E6,0x04E8]),
+    ("<HHHllllHlH",[0x0703,0x0705,0x04C3,0x04C5]),
+    ("<HlllH",[0x04A0,0x04A2,0x042A]),
+    ("<HI",[0x065C,0x063F]),
+    ("<HHHll",[0x0440,0x0442]),
+    ("<HHllllH",[0x0416,0x0418]),
+    ("<HHHllH",[0x0423,0x0425]),
+    ("<HHlHlHlHl",[0x04B0,0x04B2]),
+    ("<HHllHH",[0x04B6,0x04B8]),
+    ("<HHIHH",[0x04E3,0x04E5]),
+    ("<HHHIHHHHHIHH",[0x04D7,0x04D9]),
+    ("<HH16sIIlllllHHHHIIII",[0x04F0,0x04F2]),
+    ("<f",[0x0606,0x0608]),
+    ("<"+("H"*32),[0x0621,0x0623]),
+    ("<Hhh",[0x0626,0x0628]),
+    ("<HhhhHH",[0x0630,0x0632]),
+    ("<Hh",[0x0633,0x0635]),
+    ("<l",[0x0636,0x0638]),
+    ("<hh4x",[0x07EB,0x07ED]),
+    ("<HhhI",[0x0661]),
+    ("<HH64s",[0x0081]),
+    ('<l8sHI48s12xHHH',[0x0006]),
+    ("<I",[0x0227]),
+    ("<HlHHI",[0x0491]),
+    ("<HHfHHH",[0x0614]),
+    ("<fHH",[0x063A]),
+    ("<HHHfHHHIhhh",[0x0665]),
+    ("<HHI",[0x0821]),
+    ("<hhHhhI",[0x0881]),
+]
+# Messages which have a variable data packet structure due to the use of submessages
+VARIABLE_PACKET_MESSAGES=[0x0800,0x0802,0x0870,0x0872]
+
+# Precompiled codecs for the headers and for the data packet of each messageID, built once at import
+HEADER_STRUCT_WITHOUT_DATA=Struct(HEADER_FORMAT_WITHOUT_DATA)
+HEADER_STRUCT_WITH_DATA=Struct(HEADER_FORMAT_WITH_DATA)
+PACKET_STRUCTS={}
+for _format,_msgIDs in PACKET_FORMATS:
+    _struct=Struct(_format)
+    for _msgID in _msgIDs:
+        PACKET_STRUCTS.setdefault(_msgID,_struct)
+
+def getPacketCodec(msgID):
+    """ given msgID return the precompiled struct.Struct which converts the message data packet to and from hex """
+    try:
+        return PACKET_STRUCTS[msgID]
+    except KeyError:
+        if msgID in VARIABLE_PACKET_MESSAGES:
+            raise Exception, "Message " + hex(msgID) + " has a variable data packet structure due to the use of submessages, which hasn't been implemented yet"
         raise Exception, "Message " + hex(msgID) + " does not have a packet structure specified. Please check the documentation for this messageID"
-  
+
+def getPacketStruct(msgID):
+    """ given msgID return a format string which can be used by struct.pack and struct.unpack to convert the message data packet to and from hex """
+    return getPacketCodec(msgID).format
+
 # Message codes for all the standard APT messages (only a small fraction of these are actually implemented)
 MGMSG_MOD_IDENTIFY = 0x0223
 MGMSG_MOD_SET_CHANENABLESTATE = 0x0210
@@ -359,7 +342,10 @@ MGMSG_QUAD_SET_EEPROMPARAMS = 0x0875
 READ_TIMEOUT=500  
 WRITE_TIMEOUT=5000  
 QUERY_TIMEOUT=30000
+REPLY_TIMEOUT=5000      # default time to wait for the reply to a query
 PURGE_DELAY=50      
+MESSAGE_QUEUE_LENGTH=100    # number of unread messages kept for each messageID and source
+KEEPALIVE_INTERVAL=1000     # interval between the server alive messages which keep status updates coming
 # Device IDs
 HOST_CONTROLLER_ID = 0x01
 RACK_CONTROLLER_ID = 0x11
@@ -387,17 +373,35 @@ ALL_CHANNELS=[CHANNEL_1,CHANNEL_2]
 CHAN_ENABLE_STATE_ENABLED=0x01
 CHAN_ENABLE_STATE_DISABLED=0x02
 
+def getControllerFamily(controllerType):
+    """ De-inflect the model of a controller (e.g. BSC202) into the name of its family (e.g. BSC20X) """
+    controller=upper(controllerType)
+    if controller[0:-1] in ["BBD10","BBD20","BSC00","BSC10","BSC20","BPC20","BPC30"]: controller=controller[0:-1]+"X"
+    return controller
+
+# Server alive message which must be sent to keep the status update messages coming, for each controller family which is known to send them
+STATUS_ACK_MESSAGES={
+    "TDC001":MGMSG_MOT_ACK_DCSTATUSUPDATE,
+    "TBD001":MGMSG_MOT_ACK_DCSTATUSUPDATE,
+    "BBD10X":MGMSG_MOT_ACK_DCSTATUSUPDATE,
+    "BBD20X":MGMSG_MOT_ACK_DCSTATUSUPDATE,
+    "TST001":MGMSG_MOT_ACK_DCSTATUSUPDATE,
+    "BSC20X":MGMSG_MOT_ACK_DCSTATUSUPDATE,
+    "TPZ001":MGMSG_PZ_ACK_PZSTATUSUPDATE,
+    "BPC20X":MGMSG_PZ_ACK_PZSTATUSUPDATE,
+    "BPC30X":MGMSG_PZ_ACK_PZSTATUSUPDATE,
+    "MPZ601":MGMSG_PZ_ACK_PZSTATUSUPDATE,
+}
+
 """ ------------ Constants and methods for motor controllers ------------------"""
 def getMotorScalingFactors(controllerType,stageType):
     """ Get the conversion factor between encoder units and real (position/velocity/acceleration) units (e.g. mm,mm/s,mm/s/s for linear drive, 
     deg, deg/s, deg/s/s for angular) given the controller type and stage type as strings.  This data comes from section 8 of the introduction (p. 14 onwards) 
     from the 'Thorlabs APT Controllers Host-Controller Communications Protocol Issue 9'    
     """
-    # convert the controller/motor strings to uppercase for versatility
-    controller=upper(controllerType)
+    # convert the controller/motor strings to uppercase for versatility, and de-inflect into family names from specific models
+    controller=getControllerFamily(controllerType)
     stage=upper(stageType)   
-    # De-inflect into family names from specific models
-    if controller[0:-1] in ["BBD10","BBD20","BSC00","BSC10","BSC20"]: controller=controller[0:-1]+"X"
     if stage[0:-2] in ["Z8","Z6"]: stage=stage[0:-2]+"XX"
     # define a dictionary for encCnt based
     if controller=="TDC001":
@@ -1,8 +1,10 @@
 from __future__ import division
 import aptconsts as c
-import ftd2xx
-import time
-from struct import pack,unpack,error
+from drivepy import transport
+import time,threading
+from collections import deque
+from struct import error
+from concurrent.futures import Future, TimeoutError, wait, FIRST_COMPLETED
 
 # In debug mode we print out all messages which are sent (in hex)
 DEBUG_MODE=False
@@ -10,6 +12,10 @@ DEBUG_MODE=False
 class MessageReceiptError(Exception): pass
 class DeviceNotFoundError(Exception): pass
 
+# Flag set on the reader threads, which run the callbacks of the futures returned by queryAsync(). Only the reader thread can receive the
+# messages being waited for, so waiting on it would always time out
+_readerThread=threading.local()
+
 class AptDevice(object):
     """ Wrapper around the Apt protocol via the ftd2xx driver for USB communication with the FT232BM USB peripheral chip in the APT controllers.
    Below is a list of messages defined for all APT devices. Only a small portion of them necessary have been implemented so far taken from the spec
@@ -18,6 +24,8 @@ class AptDevice(object):
    http://www.ftdichip.com/Support/Documents/ProgramGuides/D2XX_Programmer's_Guide(FT_000071).pdf"""
 
     def __init__(self,hwser=None):
+        self.updatesEnabled=False
+        ftd2xx=transport.getFtdiModule()
         # Find out how many ftd2xx devices are connected to the USB bus
         numDevices=ftd2xx.createDeviceInfoList()
         # Check each device to see if either the serial number matches (if given) or the description string is recognized as valid for the class type
@@ -52,7 +60,9 @@ class AptDevice(object):
         self.delay()
         device.resetDevice()
         device.setFlowControl(ftd2xx.defines.FLOW_RTS_CTS)
-        device.setTimeouts(c.WRITE_TIMEOUT,c.READ_TIMEOUT)
+        device.setTimeouts(c.READ_TIMEOUT,c.WRITE_TIMEOUT)
+        # All messages from the device are received by a background thread from now on
+        self.link=_AptLink(device)
         # Check first 2 digits of serial number to see if it's normal type or card/slot type, and build self.channelAddresses as list of (chanID,destAddress) tuples
         self.channelAddresses=[]
         if device.serial[0:2] in c.BAY_TYPE_SERIAL_PREFIXES:
@@ -80,87 +90,105 @@ class AptDevice(object):
         print("Connected to %s device with serial number %d. Notes about device: %s"%(model.replace('\x00', ''),serNum,notes.replace('\x00', '')))
         
     def __del__(self):
-        self.device.close()
+        if hasattr(self,"link"):
+            self.link.close()
+        else:
+            self.device.close()
 
     def writeMessage(self,messageID,param1=0,param2=0,destID=c.GENERIC_USB_ID,sourceID=c.HOST_CONTROLLER_ID,dataPacket=None):
         """ Send message to device given messageID, parameters 1 & 2, destination and sourceID ID, and optional data packet, 
         where dataPacket is an array of numeric values. The method converts all the values to hex according to the protocol
         specification for the message, and sends this to the device."""
+        message=self.encodeMessage(messageID,param1,param2,destID,sourceID,dataPacket)
+        if DEBUG_MODE: self.disp(message,"TX:  ")
+        numBytesWritten=self.link.write(message)
+        # The latest status update of the channel may not reflect this message, so getStatusUpdate() waits for the next one
+        self.link.markStale(destID,param1 if dataPacket==None else dataPacket[0])
+
+    def encodeMessage(self,messageID,param1=0,param2=0,destID=c.GENERIC_USB_ID,sourceID=c.HOST_CONTROLLER_ID,dataPacket=None):
+        """ Return the raw message sent by writeMessage() for the given arguments """
         if dataPacket!=None:
             # If a data packet is included then header consists of concatenation of: messageID (2 bytes),number of bytes in dataPacket (2 bytes), destination byte with MSB=1 (i.e. or'd with 0x80), sourceID byte
             try:
-                dataPacketStr=pack(c.getPacketStruct(messageID) , *dataPacket)
+                dataPacketStr=c.getPacketCodec(messageID).pack(*dataPacket)
             except error as e:
-                raise error, "Error packing message " +hex(messageID)+"; probably the packet structure is recorded incorrectly in c.getPacketStruct()"
-            message=pack(c.HEADER_FORMAT_WITH_DATA , messageID , len(dataPacketStr) , destID|0x80 , sourceID) + dataPacketStr
+                raise error, "Error packing message " +hex(messageID)+"; probably the packet structure is recorded incorrectly in c.PACKET_FORMATS"
+            message=c.HEADER_STRUCT_WITH_DATA.pack(messageID , len(dataPacketStr) , destID|0x80 , sourceID) + dataPacketStr
         else:
             # If no data packet then header consists of concatenation of: messageID (2 bytes),param 1 byte, param2 bytes,destination byte, sourceID byte
-            message=pack(c.HEADER_FORMAT_WITHOUT_DATA,messageID,param1,param2,destID,sourceID)
-        if DEBUG_MODE: self.disp(message,"TX:  ")
-        numBytesWritten=self.device.write(message)
+            message=c.HEADER_STRUCT_WITHOUT_DATA.pack(messageID,param1,param2,destID,sourceID)
+        return message
     
-    def query(self,txMessageID,rxMessageID,param1=0,param2=0,destID=c.GENERIC_USB_ID,sourceID=c.HOST_CONTROLLER_ID,dataPacket=None,waitTime=None):
+    def query(self,txMessageID,rxMessageID,param1=0,param2=0,destID=c.GENERIC_USB_ID,sourceID=c.HOST_CONTROLLER_ID,dataPacket=None,waitTime=None,channelID=None):
         """ Sends the REQ query message given by txMessageID, and then retrieves the GET response message given by rxMessageID from the device.
         param1,param2,destID,and sourceID for the REQ message can also be specified if non-default values are required.
         The return value is a 7 element tuple with the first 6 values the messageID,param1,param2,destID,sourceID from the GET message header
         and the final value of the tuple is another tuple containing the values of the data packet, or None if there was no data packet.
-        A wait parameter can also be optionally specified (in seconds) which introduces a waiting period between writing and reading """
-        self.writeMessage(txMessageID,param1,param2,destID,sourceID,dataPacket)
-        if waitTime!=None:
-            # Keep reading the response until the query timeout is exceeded if wait flag specified
-            t0=time.time()
-            while True:
-                try:
-                    response=self.readMessage()
-                    break
-                except MessageReceiptError:
-                    if time.time()-t0 > waitTime/1000: raise
-        else:
-            # Otherwise just wait for the ordinary read timeout
-            response=self.readMessage()
-        # Check that the received message is the one which was expected
-        if response[0]!=rxMessageID:
-            raise MessageReceiptError, "Error querying apt device when sending messageID " + hex(txMessageID) + ".... Expected to receive messageID " + hex(rxMessageID) + " but got " + hex(response[0])
-        return response             
-
-    def readMessage(self):
-        """ Read a single message from the device and return tuple of messageID, parameters 1 & 2, destination and sourceID ID, and data packet 
+        Only a response from destID (and from channelID if given) is accepted, so queries to different channels and bays can be outstanding at once.
+        A wait parameter can also be optionally specified (in ms) which overrides the default time to wait for the response """
+        future=self.queryAsync(txMessageID,rxMessageID,param1,param2,destID,sourceID,dataPacket,channelID)
+        return waitForResponses([future],(waitTime if waitTime!=None else c.REPLY_TIMEOUT)/1000)[0]
+
+    def queryAsync(self,txMessageID,rxMessageID,param1=0,param2=0,destID=c.GENERIC_USB_ID,sourceID=c.HOST_CONTROLLER_ID,dataPacket=None,channelID=None):
+        """ Sends the message given by txMessageID as for query(), but returns a concurrent.futures.Future immediately, which resolves to the response 
+        message given by rxMessageID when it is received. This allows e.g. moves to be started on several channels and controllers and waited for together.
+        Callbacks added to the future run on the reader thread, so they must be quick and must not call query(), waitForResponses() or any other method 
+        which waits for a message (these raise RuntimeError if they are called from the reader thread) """
+        # Forget stale responses (e.g. a move completed message from an earlier stop) so they aren't taken as the response to this message
+        self.link.discardMessages(rxMessageID,destID,channelID)
+        # The response is expected before the message is sent, so that it can't arrive before anyone is waiting for it
+        future=self.link.expectMessage(rxMessageID,destID,channelID)
+        future.request=txMessageID
+        try:
+            self.writeMessage(txMessageID,param1,param2,destID,sourceID,dataPacket)
+        except:
+            future.cancel()
+            raise
+        return future
+
+    def readMessage(self,timeout=c.READ_TIMEOUT/1000):
+        """ Return the oldest unread message received from the device as a tuple of messageID, parameters 1 & 2, destination and sourceID ID, and data packet 
         (if included), where dataPacket is a tuple of all the message dependent parameters decoded from hex, 
-        as specified in the protocol documentation. Normally the user doesn't need to call this method as it's automatically called by query()"""
-        # Read 6 byte header from device
-        headerRaw=self.device.read(c.NUM_HEADER_BYTES)
-        if headerRaw=="": raise MessageReceiptError, "Timeout reading from the device"
-        # Check if a data packet is attached (i.e. get the 5th byte and check if the MSB is set)
-        isDataPacket=unpack("B",headerRaw[4])[0]>>7
-        # Read data packet if it exists, and interpret the message accordingly
-        if isDataPacket:
-            header=unpack(c.HEADER_FORMAT_WITH_DATA,headerRaw)
-            messageID=header[0]
-            dataPacketLength=header[1]
-            param1=None
-            param2=None
-            destID=header[2]
-            sourceID=header[3]
-            destID=destID&0x7F
-            dataPacketRaw=self.device.read(dataPacketLength)
-            if DEBUG_MODE: self.disp(headerRaw+dataPacketRaw,"RX:  ")
-            try:
-                dataPacket=unpack(c.getPacketStruct(messageID),dataPacketRaw)
-            except error as e:
-                # If an error occurs, it's likely due to a problem with the manual inputted data for packet structure in aptconsts
-                raise
-        else:
-            if DEBUG_MODE: self.disp(headerRaw,"RX:  ")
-            header=unpack(c.HEADER_FORMAT_WITHOUT_DATA,headerRaw)
-            messageID=header[0]
-            param1=header[1]
-            param2=header[2]
-            destID=header[3]
-            sourceID=header[4]
-            dataPacket=None
-        # Return tuple containing all the message parameters
-        return (messageID,param1,param2,destID,sourceID,dataPacket)
+        as specified in the protocol documentation. Normally the user doesn't need to call this method as responses are retrieved by query()"""
+        return self.link.waitForMessage(timeout=timeout)
     
+    def startUpdates(self):
+        """ Ask the controller to push status update messages, and keep them coming by sending server alive messages from a background thread.
+        The latest status of each channel is then available locally from getStatusUpdate() instead of querying the device.
+        Only the controllers listed in c.STATUS_ACK_MESSAGES are supported """
+        destAddresses=sorted(set(destAddress for channelID,destAddress in self.channelAddresses))
+        keepAliveMessages=[self.encodeMessage(self.statusAckMessage(),destID=destAddress) for destAddress in destAddresses]
+        self.link.statusMessageIDs=set(self.statusUpdateMessages())
+        for destAddress in destAddresses:
+            self.writeMessage(c.MGMSG_HW_START_UPDATEMSGS,destID=destAddress)
+        self.link.startKeepAlive(keepAliveMessages)
+        self.updatesEnabled=True
+
+    def stopUpdates(self):
+        """ Stop the status update messages started by startUpdates() """
+        self.updatesEnabled=False
+        self.link.stopKeepAlive()
+        for destAddress in sorted(set(destAddress for channelID,destAddress in self.channelAddresses)):
+            self.writeMessage(c.MGMSG_HW_STOP_UPDATEMSGS,destID=destAddress)
+
+    def getStatusUpdate(self,channel=0,wait=False,timeout=c.REPLY_TIMEOUT/1000):
+        """ Return the data packet of the latest status update message received for the channel (waiting for the first one if necessary), 
+        or of the next one to be received if wait is True. Requires startUpdates(). Status updates received before the last message sent to the channel,
+        or before the last message received from it (e.g. move completed), are out of date so the next update is waited for instead """
+        channelID,destAddress=self.channelAddresses[channel]
+        return self.link.waitForStatus(destAddress,channelID,wait,timeout)[-1]
+
+    def statusUpdateMessages(self):
+        """ Return the list of messageIDs of the status update messages sent by the device """
+        return []
+
+    def statusAckMessage(self):
+        """ Return the messageID of the server alive message which keeps the status update messages coming, as given for the controller in c.STATUS_ACK_MESSAGES """
+        try:
+            return c.STATUS_ACK_MESSAGES[c.getControllerFamily(self.controllerType)]
+        except KeyError:
+            raise NotImplementedError, "Status updates are not supported for the " + self.controllerType + " controller. Add it to STATUS_ACK_MESSAGES in aptconsts if it sends them"
+
     def delay(self,delayTime=c.PURGE_DELAY):
         """ Sleep for specified time given in ms """
         time.sleep(delayTime/1000)
@@ -192,6 +220,255 @@ class AptDevice(object):
         channelID,destAddress=self.channelAddresses[channel]
         self.writeMessage(c.MGMSG_MOD_SET_CHANENABLESTATE,channelID,c.CHAN_ENABLE_STATE_DISABLED,destAddress)
 
+class _AptLink(object):
+    """ The FTDI handle of an APT controller, together with a background thread which reads and decodes every incoming message into a queue for each
+    (messageID,sourceID), so that unsolicited messages aren't lost and queries only wait for their own response. This is kept separate from AptDevice 
+    so that the reader thread doesn't hold a reference to the device object, whose destructor would then never be called """
+    def __init__(self,device):
+        self.device=device
+        self.error=None             # exception which stopped the reader thread
+        self._queues={}             # deque of (sequence number,message) for each (messageID,sourceID)
+        self._expected=[]           # (messageID,sourceID,channelID,future) for responses which are waited for, in the order they were expected
+        self.statusMessageIDs=set() # messageIDs of status updates, which are kept as the latest status for each channel rather than queued
+        self._status={}             # (sequence number,message) of the latest status update for each (sourceID,channelID)
+        self._staleAfter={}         # sequence number after which status updates are up to date, for each (sourceID,channelID)
+        self._keepAlive=None
+        self._sequenceNumber=0
+        self._condition=threading.Condition()
+        self._writeLock=threading.Lock()
+        self._running=True
+        self._thread=threading.Thread(target=self._readLoop,name="AptReader-"+str(device.serial))
+        self._thread.daemon=True
+        self._thread.start()
+
+    def write(self,message):
+        """ Write a raw message to the device """
+        with self._writeLock:
+            return self.device.write(message)
+
+    def close(self):
+        """ Stop the reader thread and close the device """
+        self.stopKeepAlive()
+        self._running=False
+        if self._thread is not threading.current_thread():
+            self._thread.join(2*c.READ_TIMEOUT/1000)
+        self.device.close()
+
+    def waitForMessage(self,messageID=None,sourceID=None,channelID=None,timeout=c.READ_TIMEOUT/1000):
+        """ Remove and return the oldest received message matching messageID, sourceID and channelID (any if None), waiting up to timeout seconds for it """
+        _checkNotReaderThread()
+        deadline=time.time()+timeout
+        with self._condition:
+            while True:
+                message=self._popMessage(messageID,sourceID,channelID)
+                if message is not None:
+                    return message
+                if self.error is not None:
+                    raise MessageReceiptError, "Reading from the device failed with " + repr(self.error)
+                remaining=deadline-time.time()
+                if remaining<=0:
+                    expected="any message" if messageID==None else "messageID " + hex(messageID)
+                    raise MessageReceiptError, "Timeout waiting for " + expected + " from the device"
+                self._condition.wait(remaining)
+
+    def startKeepAlive(self,messages,interval=c.KEEPALIVE_INTERVAL/1000):
+        """ Start a background thread which writes each of the raw messages every interval seconds, until stopKeepAlive() """
+        self.stopKeepAlive()
+        stop=threading.Event()
+        def keepAlive():
+            while not stop.wait(interval):
+                for message in messages:
+                    self.write(message)
+        self._keepAlive=(threading.Thread(target=keepAlive,name="AptKeepAlive-"+str(self.device.serial)),stop)
+        self._keepAlive[0].daemon=True
+        self._keepAlive[0].start()
+
+    def stopKeepAlive(self):
+        if self._keepAlive is not None:
+            thread,stop=self._keepAlive
+            self._keepAlive=None
+            stop.set()
+            if thread is not threading.current_thread():
+                thread.join()
+
+    def markStale(self,sourceID,channelID):
+        """ Make waitForStatus() ignore the status updates from sourceID for channelID which have been received so far """
+        with self._condition:
+            self._staleAfter[(sourceID,channelID)]=self._sequenceNumber
+
+    def waitForStatus(self,sourceID,channelID,wait=False,timeout=c.REPLY_TIMEOUT/1000):
+        """ Return the latest status update message from sourceID for channelID, or the next one to be received if wait is True or if the latest one
+        is stale (see markStale()), waiting up to timeout seconds if there isn't one """
+        _checkNotReaderThread()
+        deadline=time.time()+timeout
+        key=(sourceID,channelID)
+        with self._condition:
+            last=self._status.get(key,(0,None))[0] if wait else self._staleAfter.get(key,0)
+            while self._status.get(key,(0,None))[0]<=last:
+                if self.error is not None:
+                    raise MessageReceiptError, "Reading from the device failed with " + repr(self.error)
+                remaining=deadline-time.time()
+                if remaining<=0:
+                    raise MessageReceiptError, "Timeout waiting for a status update for channel " + str(channelID) + " from the device"
+                self._condition.wait(remaining)
+            return self._status[key][1]
+
+    def expectMessage(self,messageID,sourceID=None,channelID=None):
+        """ Return a concurrent.futures.Future which resolves to the next message received matching messageID, sourceID and channelID (any if None).
+        The message is delivered to the future instead of being queued. Callbacks added to the future run on the reader thread, so they mustn't wait for messages """
+        future=Future()
+        with self._condition:
+            if self.error is None:
+                # Forget any futures which were cancelled (e.g. after timing out) before their message arrived
+                self._expected=[entry for entry in self._expected if not entry[3].cancelled()]
+                self._expected.append((messageID,sourceID,channelID,future))
+                return future
+        future.set_exception(MessageReceiptError("Reading from the device failed with " + repr(self.error)))
+        return future
+
+    def discardMessages(self,messageID,sourceID=None,channelID=None):
+        """ Remove all the received messages matching messageID, sourceID and channelID """
+        with self._condition:
+            while self._popMessage(messageID,sourceID,channelID) is not None:
+                pass
+
+    def _popMessage(self,messageID,sourceID,channelID):
+        """ Remove and return the oldest queued message matching the arguments, or None. Must be called with the condition held """
+        best=None
+        for (queueMessageID,queueSourceID),queue in self._queues.items():
+            if (messageID!=None and queueMessageID!=messageID) or (sourceID!=None and queueSourceID!=sourceID):
+                continue
+            for entry in queue:
+                if channelID==None or _messageChannel(entry[1])==channelID:
+                    if best is None or entry[0]<best[1][0]:
+                        best=(queue,entry)
+                    break
+        if best is None:
+            return None
+        best[0].remove(best[1])
+        return best[1][1]
+
+    def _readLoop(self):
+        _readerThread.active=True
+        while self._running:
+            try:
+                message=self._readMessage()
+            except Exception as e:
+                # The handle was closed or the stream can't be decoded, so stop and let any waiting queries report the error
+                with self._condition:
+                    self.error=e
+                    expected,self._expected=self._expected,[]
+                    self._condition.notify_all()
+                for messageID,sourceID,channelID,future in expected:
+                    if future.set_running_or_notify_cancel():
+                        future.set_exception(MessageReceiptError("Reading from the device failed with " + repr(e)))
+                return
+            if message is not None:
+                self._dispatch(message)
+
+    def _dispatch(self,message):
+        """ Deliver a received message to the first future expecting it, or otherwise add it to the queue for its messageID and source """
+        while True:
+            with self._condition:
+                future=None
+                for entry in self._expected:
+                    messageID,sourceID,channelID,entryFuture=entry
+                    if message[0]==messageID and (sourceID==None or message[4]==sourceID) and (channelID==None or _messageChannel(message)==channelID):
+                        self._expected.remove(entry)
+                        future=entryFuture
+                        break
+                self._sequenceNumber+=1
+                if message[0] in self.statusMessageIDs:
+                    self._status[(message[4],_messageChannel(message))]=(self._sequenceNumber,message)
+                    self._condition.notify_all()
+                    if future is None:
+                        return
+                else:
+                    # Other messages (e.g. move completed) mean that the channel's latest status update is out of date
+                    self._staleAfter[(message[4],_messageChannel(message))]=self._sequenceNumber
+                    if future is None:
+                        key=(message[0],message[4])
+                        if key not in self._queues:
+                            self._queues[key]=deque(maxlen=c.MESSAGE_QUEUE_LENGTH)
+                        self._queues[key].append((self._sequenceNumber,message))
+                        self._condition.notify_all()
+                        return
+            # Callbacks run when the result is set, so do it without holding the lock. A cancelled future passes the message on to the next one
+            if future.set_running_or_notify_cancel():
+                future.set_result(message)
+                return
+
+    def _read(self,numBytes):
+        """ Read numBytes from the device, or return "" if nothing arrives within the read timeout """
+        data=self.device.read(numBytes)
+        # Once a message has started arriving, wait for the rest of it
+        while data and len(data)<numBytes and self._running:
+            data+=self.device.read(numBytes-len(data))
+        return data
+
+    def _readMessage(self):
+        """ Read a single message from the device and return tuple of messageID, parameters 1 & 2, destination and sourceID ID, and data packet 
+        (if included), or None if no message was received within the read timeout """
+        # Read 6 byte header from device
+        headerRaw=self._read(c.NUM_HEADER_BYTES)
+        if len(headerRaw)<c.NUM_HEADER_BYTES: return None
+        # Check if a data packet is attached (i.e. get the 5th byte and check if the MSB is set)
+        isDataPacket=ord(headerRaw[4])>>7
+        # Read data packet if it exists, and interpret the message accordingly
+        if isDataPacket:
+            header=c.HEADER_STRUCT_WITH_DATA.unpack(headerRaw)
+            messageID=header[0]
+            dataPacketLength=header[1]
+            param1=None
+            param2=None
+            destID=header[2]
+            sourceID=header[3]
+            destID=destID&0x7F
+            dataPacketRaw=self._read(dataPacketLength)
+            if DEBUG_MODE: print("RX:  " + str([hex(ord(ch)) for ch in headerRaw+dataPacketRaw]))
+            try:
+                dataPacket=c.getPacketCodec(messageID).unpack(dataPacketRaw)
+            except Exception:
+                # The packet structure is missing or incorrect in aptconsts, so keep the raw data packet rather than stopping the reader
+                dataPacket=dataPacketRaw
+        else:
+            if DEBUG_MODE: print("RX:  " + str([hex(ord(ch)) for ch in headerRaw]))
+            header=c.HEADER_STRUCT_WITHOUT_DATA.unpack(headerRaw)
+            messageID=header[0]
+            param1=header[1]
+            param2=header[2]
+            destID=header[3]
+            sourceID=header[4]
+            dataPacket=None
+        # Return tuple containing all the message parameters
+        return (messageID,param1,param2,destID,sourceID,dataPacket)
+
+def waitForResponses(futures,timeout=c.QUERY_TIMEOUT/1000):
+    """ Wait for all the futures returned by queryAsync() (or the Move...Async methods) to resolve, and return the list of response messages.
+    MessageReceiptError is raised if they don't all resolve within timeout seconds, in which case the outstanding futures are cancelled.
+    This can't be called from a future's callback, since callbacks run on the reader thread which receives the responses """
+    _checkNotReaderThread()
+    deadline=time.time()+timeout
+    responses=[]
+    for future in futures:
+        try:
+            responses.append(future.result(max(0,deadline-time.time())))
+        except TimeoutError:
+            for outstanding in futures:
+                outstanding.cancel()
+            request=" when sending messageID " + hex(future.request) if hasattr(future,"request") else ""
+            raise MessageReceiptError, "Error querying apt device" + request + ".... Timeout waiting for the response from the device"
+    return responses
+
+def _checkNotReaderThread():
+    """ Raise RuntimeError if called on a reader thread, where waiting for a message would block the thread that receives it """
+    if getattr(_readerThread,"active",False):
+        raise RuntimeError, "Can't wait for messages from the APT reader thread (e.g. in a future's callback), since it receives them"
+
+def _messageChannel(message):
+    """ Return the channel ID of a message, which is param1 for messages without a data packet and otherwise the first value of the data packet """
+    return message[1] if message[5] is None else message[5][0]
+
 class _AptMotor(AptDevice):
     """ Wrapper around the messages of the APT protocol specified for motor controller. The method names (and case) are set the same as in the Thor Labs ActiveX control for compatibility
 
@@ -224,39 +501,71 @@ class _AptMotor(AptDevice):
         return super(_AptMotor, self).__del__()
 
     def MoveHome(self,channel=0,wait=True):
-        """ Home the specified channel and wait for the homed return message to be returned """
+        """ Home the specified channel and wait for the homed return message to be returned. If wait is False the future from MoveHomeAsync() is returned instead """
+        future=self.MoveHomeAsync(channel)
+        if not wait:
+            return future
+        waitForResponses([future],c.QUERY_TIMEOUT/1000)
+
+    def MoveHomeAsync(self,channel=0):
+        """ Start homing the specified channel, and return a concurrent.futures.Future which resolves to the homed message """
         channelID,destAddress=self.channelAddresses[channel]
-        waitTime=c.QUERY_TIMEOUT if wait else None
-        response=self.query(c.MGMSG_MOT_MOVE_HOME,c.MGMSG_MOT_MOVE_HOMED,channelID,destID=destAddress,waitTime=waitTime)
+        return self.queryAsync(c.MGMSG_MOT_MOVE_HOME,c.MGMSG_MOT_MOVE_HOMED,channelID,destID=destAddress,channelID=channelID)
 
     def MoveJog(self,channel=0,direction=c.MOTOR_JOG_FORWARD):
         """ Jog the specified channel in the specified direction and wait for the move completed message to be returned """
+        waitForResponses([self.MoveJogAsync(channel,direction)],c.REPLY_TIMEOUT/1000)
+
+    def MoveJogAsync(self,channel=0,direction=c.MOTOR_JOG_FORWARD):
+        """ Start jogging the specified channel, and return a concurrent.futures.Future which resolves to the move completed message """
         channelID,destAddress=self.channelAddresses[channel]
-        response=self.query(c.MGMSG_MOT_MOVE_JOG,c.MGMSG_MOT_MOVE_COMPLETED,channelID,direction,destID=destAddress)
+        return self.queryAsync(c.MGMSG_MOT_MOVE_JOG,c.MGMSG_MOT_MOVE_COMPLETED,channelID,direction,destID=destAddress,channelID=channelID)
     
     def GetPosition(self,channel=0):
-        """ Get the position in mm """
+        """ Get the position in mm, from the latest status update if they have been started with startUpdates() """
+        if self.updatesEnabled:
+            return self._encToPosition(self.getStatusUpdate(channel)[1])
         channelID,destAddress=self.channelAddresses[channel]
-        response=self.query(c.MGMSG_MOT_REQ_POSCOUNTER,c.MGMSG_MOT_GET_POSCOUNTER,channelID,destID=destAddress)
+        response=self.query(c.MGMSG_MOT_REQ_POSCOUNTER,c.MGMSG_MOT_GET_POSCOUNTER,channelID,destID=destAddress,channelID=channelID)
         posParam=response[-1][-1]
         return self._encToPosition(posParam)
 
     def MoveAbsoluteEnc(self,channel=0,positionCh1=0.0,positionCh2=0,waitTime=c.QUERY_TIMEOUT,wait=True):
-        """ Move the specified channel to the specified absolute position and wait for the move completed message to be returned """
+        """ Move the specified channel to the specified absolute position and wait for the move completed message to be returned.
+        If wait is False the future from MoveAbsoluteEncAsync() is returned instead """
+        future=self.MoveAbsoluteEncAsync(channel,positionCh1)
+        if not wait:
+            return future
+        waitForResponses([future],waitTime/1000)
+
+    def MoveAbsoluteEncAsync(self,channel=0,position=0.0):
+        """ Start moving the specified channel to the specified absolute position, and return a concurrent.futures.Future which resolves to the move completed message.
+        e.g. to move all channels of several controllers together: waitForResponses([m.MoveAbsoluteEncAsync(ch,x) for m in motors for ch in range(len(m.channelAddresses))]) """
         channelID,destAddress=self.channelAddresses[channel]
-        position=positionCh1
-        waitTimeParam=waitTime if wait else None
         posParam=self._positionToEnc(position)
-        response=self.query(c.MGMSG_MOT_MOVE_ABSOLUTE,c.MGMSG_MOT_MOVE_COMPLETED,0x06,destID=destAddress,dataPacket=(channelID,posParam),waitTime=waitTimeParam)
+        return self.queryAsync(c.MGMSG_MOT_MOVE_ABSOLUTE,c.MGMSG_MOT_MOVE_COMPLETED,0x06,destID=destAddress,dataPacket=(channelID,posParam),channelID=channelID)
 
     def MoveAbsoluteEx(self,channel=0,positionCh1=0.0,positionCh2=0,wait=True):
         """ Wrapper for MoveAbsoluteEx """
-        self.MoveAbsoluteEnc(channel,positionCh1,positionCh2,wait=wait)
+        return self.MoveAbsoluteEnc(channel,positionCh1,positionCh2,wait=wait)
+
+    def SetVelParams(self,channel=0,maxVelocity=1.0,acceleration=1.0,minVelocity=0.0):
+        """ Set the maximum velocity in mm/s and acceleration in mm/s/s (or degrees where applicable) used for moves of the specified channel """
+        channelID,destAddress=self.channelAddresses[channel]
+        dataPacket=(channelID,int(self._velocityToEnc(minVelocity)),int(self._accelerationToEnc(acceleration)),int(self._velocityToEnc(maxVelocity)))
+        self.writeMessage(c.MGMSG_MOT_SET_VELPARAMS,destID=destAddress,dataPacket=dataPacket)
+
+    def GetVelParams(self,channel=0):
+        """ Get the (maxVelocity,acceleration,minVelocity) in mm/s and mm/s/s (or degrees where applicable) used for moves of the specified channel """
+        channelID,destAddress=self.channelAddresses[channel]
+        response=self.query(c.MGMSG_MOT_REQ_VELPARAMS,c.MGMSG_MOT_GET_VELPARAMS,channelID,destID=destAddress,channelID=channelID)
+        _,minVelocity,acceleration,maxVelocity=response[-1]
+        return (self._encToVelocity(maxVelocity),self._encToAcceleration(acceleration),self._encToVelocity(minVelocity))
 
     def GetStageAxisInfo(self,channel=0):
         """ Get the stage axis info... doesn't seem to be working right now """
         channelID,destAddress=self.channelAddresses[channel]
-        response=self.query(c.MGMSG_MOT_REQ_PMDSTAGEAXISPARAMS,c.MGMSG_MOT_GET_PMDSTAGEAXISPARAMS,channelID,destID=destAddress)
+        response=self.query(c.MGMSG_MOT_REQ_PMDSTAGEAXISPARAMS,c.MGMSG_MOT_GET_PMDSTAGEAXISPARAMS,channelID,destID=destAddress,channelID=channelID)
         dataPacket=response[-1]
         return dataPacket
 
@@ -267,6 +576,10 @@ class _AptMotor(AptDevice):
         self.writeMessage(c.MGMSG_MOT_MOVE_STOP,channelID,destID=destAddress)
         pass
 
+    def statusUpdateMessages(self):
+        """ Stepper motor controllers send MGMSG_MOT_GET_STATUSUPDATE and DC servo controllers send MGMSG_MOT_GET_DCSTATUSUPDATE """
+        return [c.MGMSG_MOT_GET_STATUSUPDATE,c.MGMSG_MOT_GET_DCSTATUSUPDATE]
+
     def _positionToEnc(self,position):
         """ convert between position in mm (or angle in degrees where applicable) and appropriate encoder units"""
         return round(position*c.getMotorScalingFactors(self.controllerType,self.stageType)["position"])
@@ -283,6 +596,14 @@ class _AptMotor(AptDevice):
         """ convert between acceleration in mm/s/s (angular in degrees/s/s where applicable) and appropriate encoder units"""
         return round(acceleration*c.getMotorScalingFactors(self.controllerType,self.stageType)["acceleration"])
 
+    def _encToVelocity(self,enc):
+        """ convert between velocity in mm/s (angular in degrees/s where applicable) and appropriate encoder units"""
+        return enc/c.getMotorScalingFactors(self.controllerType,self.stageType)["velocity"]
+
+    def _encToAcceleration(self,enc):
+        """ convert between acceleration in mm/s/s (angular in degrees/s/s where applicable) and appropriate encoder units"""
+        return enc/c.getMotorScalingFactors(self.controllerType,self.stageType)["acceleration"]
+
 class _AptPiezo(AptDevice):
     """ Wrapper around the messages of the APT protocol specified for piezo controller. The method names (and case) are set the same as in the Thor Labs ActiveX control for compatibility
 
@@ -296,9 +617,7 @@ class _AptPiezo(AptDevice):
             self.SetControlMode(ch)
             self.SetVoltOutput(ch)
             self.initializeConstants(ch)
-            # If we wanna receive status update messages then we need to send MGMSG_HW_START_UPDATEMSGS
-            # We would additionally need to send server alive messages every 1s, e.g. MGMSG_PZ_ACK_PZSTATUSUPDATE for Piezo
-            # However if we don't need broadcasting of the position etc we can just fetch the status via GET_STATUTSUPDATES
+            # Position and status can be pushed by the controller instead of polled by calling startUpdates()
         
     def initializeConstants(self,channel=0):
         """ Hack to initialize the pieze controller with constants defined explicitly in aptconsts.
@@ -319,7 +638,7 @@ class _AptPiezo(AptDevice):
 
     def GetControlMode(self,channel=0):
         """ Get the control mode of the APT Piezo device"""
-        response=self.query(c.MGMSG_PZ_REQ_POSCONTROLMODE,c.MGMSG_PZ_GET_POSCONTROLMODE,channelID,destID=destAddress)
+        response=self.query(c.MGMSG_PZ_REQ_POSCONTROLMODE,c.MGMSG_PZ_GET_POSCONTROLMODE,channelID,destID=destAddress,channelID=channelID)
         assert response[1]==channelID, "inconsistent channel in response message from piezocontroller"
         return response[2]
         
@@ -333,7 +652,7 @@ class _AptPiezo(AptDevice):
     def GetVoltOutput(self,channel=0):
         """ Get the output voltage of the APT Piezo device. Only applicable when in open-loop mode """
         channelID,destAddress=self.channelAddresses[channel]
-        response=self.query(c.MGMSG_PZ_REQ_OUTPUTVOLTS,c.MGMSG_PZ_GET_OUTPUTVOLTS,channelID,destID=destAddress)
+        response=self.query(c.MGMSG_PZ_REQ_OUTPUTVOLTS,c.MGMSG_PZ_GET_OUTPUTVOLTS,channelID,destID=destAddress,channelID=channelID)
         dataPacket=response[-1]
         assert dataPacket[0]==channelID, "inconsistent channel in response message from piezocontroller"
         return self._fractionAsVoltage(dataPacket[1])
@@ -349,7 +668,7 @@ class _AptPiezo(AptDevice):
     def GetPosOutput(self,channel=0):
         """ Get the current position of the APT Piezo device. Only applicable when in closed-loop mode"""
         channelID,destAddress=self.channelAddresses[channel]
-        response=self.query(c.MGMSG_PZ_REQ_OUTPUTPOS,c.MGMSG_PZ_GET_OUTPUTPOS,channelID,destID=destAddress)
+        response=self.query(c.MGMSG_PZ_REQ_OUTPUTPOS,c.MGMSG_PZ_GET_OUTPUTPOS,channelID,destID=destAddress,channelID=channelID)
         dataPacket=response[-1]
         assert dataPacket[0]==channelID, "inconsistent channel in response message from piezocontroller"
         return self._fractionAsPosition(dataPacket[1])
@@ -367,7 +686,7 @@ class _AptPiezo(AptDevice):
         This function retrieves the maximum travel for the piezo actuator associated with the channel specified by the Chan Ident parameter, 
         and returns a value (in microns) in the Travel parameter."""
         channelID,destAddress=self.channelAddresses[channel]
-        response=self.query(c.MGMSG_PZ_REQ_MAXTRAVEL,c.MGMSG_PZ_GET_MAXTRAVEL,channelID,destID=destAddress)
+        response=self.query(c.MGMSG_PZ_REQ_MAXTRAVEL,c.MGMSG_PZ_GET_MAXTRAVEL,channelID,destID=destAddress,channelID=channelID)
         dataPacket=response[-1]
         assert dataPacket[0]==channelID, "inconsistent channel in response message from piezocontroller"
         return dataPacket[1]*c.PIEZO_TRAVEL_STEP
@@ -376,7 +695,7 @@ class _AptPiezo(AptDevice):
         """ The piezo actuator connected to the unit has a specific maximum operating voltage range: 75, 100 or 150 V. 
         This function gets the maximum voltage for the piezo actuator associated with the specified channel."""
         channelID,destAddress=self.channelAddresses[channel]
-        response=self.query(c.MGMSG_PZ_REQ_OUTPUTMAXVOLTS,c.MGMSG_PZ_GET_OUTPUTMAXVOLTS,channelID,destID=destAddress)
+        response=self.query(c.MGMSG_PZ_REQ_OUTPUTMAXVOLTS,c.MGMSG_PZ_GET_OUTPUTMAXVOLTS,channelID,destID=destAddress,channelID=channelID)
         dataPacket=response[-1]
         assert dataPacket[0]==channelID, "inconsistent channel in response message from piezocontroller"
         return dataPacket[1]*c.PIEZO_VOLTAGE_STEP
@@ -386,11 +705,14 @@ class _AptPiezo(AptDevice):
         These flags are returned in a single 32 bit integer parameter and can provide additional useful status information for client application development. 
         The individual bits (flags) of the 32 bit integer value are described in the main documentaton."""
         channelID,destAddress=self.channelAddresses[channel]
-        response=self.query(c.MGMSG_PZ_REQ_PZSTATUSBITS,c.MGMSG_PZ_GET_PZSTATUSBITS,channelID,destID=destAddress)
+        response=self.query(c.MGMSG_PZ_REQ_PZSTATUSBITS,c.MGMSG_PZ_GET_PZSTATUSBITS,channelID,destID=destAddress,channelID=channelID)
         dataPacket=response[-1]
         assert dataPacket[0]==channelID, "inconsistent channel in response message from piezocontroller"
         return dataPacket[1]
 
+    def statusUpdateMessages(self):
+        return [c.MGMSG_PZ_GET_PZSTATUSUPDATE]
+
     # Helper methods for the above main methods. Change to mixed case since no need for compatibility with ActiveX control
     def _voltageAsFraction(self,voltage):
         """ specify voltage as short representing fraction of max voltage"""
@@ -421,6 +743,85 @@ class AptMotor(_AptMotor):
     def zero(self,channel=0):
         self.MoveHome(channel)
         
+class Trajectory(object):
+    """ Coordinated moves of several motor axes through a list of waypoints. Each axis is a (motor,channel) tuple, and the motors can be different controllers.
+    e.g. for a raster scan over two stages: Trajectory([(xStage,0),(yStage,0)],velocity=2.0).run([(x,y) for y in ys for x in xs]) """
+    def __init__(self,axes,velocity=None,acceleration=None):
+        """ If velocity (and acceleration) is given then it's loaded into each axis once when the trajectory is run, rather than for every move.
+        If only velocity is given then each axis keeps its current acceleration """
+        self.axes=list(axes)
+        self.velocity=velocity
+        self.acceleration=acceleration
+
+    def run(self,waypoints,synchronize=True,onWaypoint=None,timeout=c.QUERY_TIMEOUT/1000):
+        """ Move through waypoints, where each waypoint is a sequence of positions in the order of self.axes (None leaves the axis where it is).
+        The moves of all the axes are issued concurrently. If synchronize is True then every axis reaches each waypoint before any axis moves on,
+        otherwise each axis is sent its next position as soon as it reports completion of the last one, except that no axis is allowed to get more
+        than one waypoint ahead of the slowest axis (so an axis can be moving to waypoint index+1 while another is still moving to waypoint index, 
+        but waits there until that axis has arrived before it goes on to index+2). onWaypoint(index) is called when every
+        axis has reached waypoint index. MessageReceiptError is raised if an axis doesn't complete a move within timeout seconds """
+        waypoints=list(waypoints)
+        if self.velocity!=None:
+            for motor,channel in self.axes:
+                acceleration=self.acceleration if self.acceleration!=None else motor.GetVelParams(channel)[1]
+                motor.SetVelParams(channel,self.velocity,acceleration)
+        if synchronize:
+            for index,waypoint in enumerate(waypoints):
+                waitForResponses([self._move(axis,index,waypoints) for axis in range(len(self.axes)) if waypoint[axis]!=None],timeout)
+                if onWaypoint!=None: onWaypoint(index)
+            return
+        nextIndex=[0]*len(self.axes)         # index of the next waypoint for each axis
+        remaining=[len(self.axes)]*len(waypoints)   # number of axes which haven't reached each waypoint yet
+        pending={}  # axis for each outstanding move
+        blocked=set(range(len(self.axes)))  # axes which are waiting for the slowest axis to catch up
+        self._advanceBlocked(waypoints,nextIndex,remaining,pending,blocked,onWaypoint)
+        while pending:
+            done,notDone=wait(pending.keys(),timeout,return_when=FIRST_COMPLETED)
+            if not done:
+                waitForResponses(pending.keys(),0)  # cancels the outstanding moves and raises the timeout error
+            for future in done:
+                axis=pending.pop(future)
+                future.result()
+                self._reached(axis,waypoints,nextIndex,remaining,onWaypoint)
+                blocked.add(axis)
+            self._advanceBlocked(waypoints,nextIndex,remaining,pending,blocked,onWaypoint)
+
+    def _move(self,axis,index,waypoints):
+        """ Start moving axis to its position in waypoints[index], and return the future for its completion """
+        motor,channel=self.axes[axis]
+        return motor.MoveAbsoluteEncAsync(channel,waypoints[index][axis])
+
+    def _advanceBlocked(self,waypoints,nextIndex,remaining,pending,blocked,onWaypoint):
+        """ Advance each of the blocked axes which are allowed to move on, until none of them can. An axis skipping waypoints where it doesn't move
+        can unblock another one, so this is repeated until nothing changes """
+        while True:
+            state=(list(nextIndex),len(pending))
+            for axis in sorted(blocked):
+                self._advance(axis,waypoints,nextIndex,remaining,pending,blocked,onWaypoint)
+            if (nextIndex,len(pending))==state:
+                return
+
+    def _advance(self,axis,waypoints,nextIndex,remaining,pending,blocked,onWaypoint):
+        """ Start the move of axis to its next waypoint, skipping any waypoints where it doesn't move. If that would put it more than one waypoint 
+        ahead of the slowest axis then it's added to blocked instead """
+        blocked.discard(axis)
+        while nextIndex[axis]<len(waypoints):
+            if nextIndex[axis]>min(nextIndex)+1:
+                blocked.add(axis)
+                return
+            if waypoints[nextIndex[axis]][axis]!=None:
+                pending[self._move(axis,nextIndex[axis],waypoints)]=axis
+                return
+            self._reached(axis,waypoints,nextIndex,remaining,onWaypoint)
+
+    def _reached(self,axis,waypoints,nextIndex,remaining,onWaypoint):
+        """ Record that axis has reached its next waypoint """
+        index=nextIndex[axis]
+        nextIndex[axis]+=1
+        remaining[index]-=1
+        if remaining[index]==0 and onWaypoint!=None:
+            onWaypoint(index)
+
 class AptPiezo(_AptPiezo):
     """ This class contains higher level methods not provided in the Thor Labs ActiveX control, but are very useful nonetheless """
 
@@ -436,7 +837,10 @@ class AptPiezo(_AptPiezo):
     
     def isZeroing(self,channel):
         """ Check to see if the piezo controller is in the middle of zeroing (6th bit True)"""
-        StatusBits=self.LLGetStatusBits(channel)
+        if self.updatesEnabled:
+            StatusBits=self.getStatusUpdate(channel)[3]
+        else:
+            StatusBits=self.LLGetStatusBits(channel)
         return (StatusBits>>5) & 1
 
     def setPosition(self,channel,position):
@@ -444,17 +848,29 @@ class AptPiezo(_AptPiezo):
         if position>=0 and position <= self.maxExtension:
             self.SetPosOutput(channel,position)
             t0=time.time()
-            while abs(position-self.GetPosOutput(channel))>1.01*c.PIEZO_POSITION_ACCURACY:
+            while abs(position-self.getPosition(channel))>1.01*c.PIEZO_POSITION_ACCURACY:
                 if (time.time()-t0)>c.PIEZO_MOVE_TIMEOUT:
                     print("Timeout error moving to "+str(position)+ 'um on channel '+str(channel))
                     break 
                 else:
-                    time.sleep(10e-3)
+                    self._waitForUpdate(channel,10e-3)
 
     def getPosition(self,channel):
-        """ Get the position of the piezo. This is simply a wrapper for GetPosOutput using mixedCase """
+        """ Get the position of the piezo, from the latest status update if they have been started with startUpdates() and otherwise using GetPosOutput """
+        if self.updatesEnabled:
+            return self._fractionAsPosition(self.getStatusUpdate(channel)[2])
         return self.GetPosOutput(channel)
 
+    def _waitForUpdate(self,channel,pollInterval):
+        """ Wait for the next status update if they have been started, or otherwise for pollInterval seconds before polling the device again """
+        if self.updatesEnabled:
+            try:
+                self.getStatusUpdate(channel,wait=True,timeout=pollInterval+c.KEEPALIVE_INTERVAL/1000)
+            except MessageReceiptError:
+                pass    # the caller checks its own timeout
+        else:
+            time.sleep(pollInterval)
+
     def zero(self,channel):
         """ Call the zero method and wait for it to finish """       
         self.ZeroPosition(channel)
@@ -464,7 +880,7 @@ class AptPiezo(_AptPiezo):
                 print("Timeout error zeroing channel "+str(channel))
                 break 
             else:
-                time.sleep(500e-3)
+                self._waitForUpdate(channel,500e-3)
 
     def moveToCenter(self,channel):
         """ Moves the specified channel to half of its maximum extension"""
@@ -0,0 +1,135 @@
+""" Micro-benchmark of encoding and decoding APT messages (header plus data packet), cycling through every messageID with a fixed structure.
+Compares the precompiled Structs in aptconsts against the original approach of calling struct.pack/struct.unpack with the format string
+looked up by a chain of if/elif membership tests (chainedPacketStruct, a copy of the original getPacketStruct()).
+Run from this directory with: python benchmark.py [numMessages] """
+from __future__ import division
+import sys,time,struct
+import aptconsts as c
+
+def chainedPacketStruct(msgID):
+    """ given msgID return the packet format string using the if/elif chain which aptconsts.getPacketStruct() used before the precompiled Structs.
+    This copy is kept here as the baseline for the comparison, and isn't used by the drivers """
+    # 1 word
+    if msgID in [0x07D1,0x07D3,0x07E8,0x07EA,0x0875]:
+        return '<H'
+    # 2 words
+    elif msgID in [0x042C,0x04B3,0x04B5,0x04FB,0x04FD,0x0643,0x0645,0x0646,0x0648,0x0652,0x0654,0x07D0,0x0651,0x0609,0x0611,0x07E7]:
+        return '<HH'
+    # 3 words
+    elif msgID in [0x0655,0x0657,0x0700,0x0702,0x04B9,0x0680,0x0682,0x0683,0x0685,0x07DE]:
+        return '<HHH'
+    # 5 words
+    elif msgID in [0x0426,0x0428,0x07D4,0x07D6,0x0670,0x0672]:
+        return '<HHHHH'
+    # 6 words
+    elif msgID in [0x04E0,0x04E2,0x0618,0x0620]:
+        return '<HHHHHH'
+    # 7 words
+    elif msgID in [0x07DA,0x07DC,0x04DA,0x04DC,0x04E0,0x04E2]:
+        return '<HHHHHHH'
+    # 9 words
+    elif msgID in [0x04E9,0x04EB]:
+        return '<HHHHHHHHH'
+    # 1 word + 1 long
+    elif msgID in [0x0410,0x0412,0x0409,0x040B,0x0453]:
+        return "<Hl"
+    # 1 word + 3 longs
+    elif msgID in [0x043A,0x043C,0x0445,0x0447,0x0450,0x0452,0x0448,0x0413,0x0415]:
+        return "<Hlll"
+    elif msgID in [0x0481,0x0466,0x0464]:
+        return "<HllI"
+    elif msgID in [0x04E6,0x04E8]:
+        return "<HllllH"
+    elif msgID in [0x0703,0x0705,0x04C3,0x04C5]:
+        return "<HHHllllHlH"
+    elif msgID in [0x04A0,0x04A2,0x042A]:
+        return "<HlllH"
+    elif msgID in [0x065C,0x063F]:
+        return "<HI"
+    elif msgID in [0x0440,0x0442]:
+        return "<HHHll"
+    elif msgID in [0x0416,0x0418]:
+        return "<HHllllH"
+    elif msgID in [0x0423,0x0425]:
+        return "<HHHllH"
+    elif msgID in [0x04B0,0x04B2]:
+        return "<HHlHlHlHl"
+    elif msgID in [0x04B6,0x04B8]:
+        return "<HHllHH"
+    elif msgID in [0x04E3,0x04E5]:
+        return "<HHIHH"
+    elif msgID in [0x04D7,0x04D9]:
+        return "<HHHIHHHHHIHH"
+    elif msgID in [0x04F0,0x04F2]:
+        return "<HH16sIIlllllHHHHIIII"
+    elif msgID in [0x0606,0x0608]:
+        return "<f"
+    elif msgID in [0x0621,0x0623]:
+        return "<"+("H"*32)
+    elif msgID in [0x0626,0x0628]:
+        return "<Hhh"
+    elif msgID in [0x0630,0x0632]:
+        return "<HhhhHH"
+    elif msgID in [0x0633,0x0635]:
+        return "<Hh"
+    elif msgID in [0x0636,0x0638]:
+        return "<l"
+    elif msgID in [0x07EB,0x07ED]:
+        return "<hh4x"
+    elif msgID==0x0661:
+        return "<HhhI"
+    elif msgID==0x0081:
+        return "<HH64s"
+    elif msgID==0x0006:
+        return '<l8sHI48s12xHHH'
+    elif msgID==0x0227:
+        return "<I"
+    elif msgID==0x0491:
+        return "<HlHHI"
+    elif msgID ==0x0614:
+        return "<HHfHHH"
+    elif msgID ==0x063A:
+        return "<fHH"
+    elif msgID ==0x0665:
+        return "<HHHfHHHIhhh"
+    elif msgID ==0x0821:
+        return "<HHI"
+    elif msgID ==0x0881:
+        return "<hhHhhI"
+    elif msgID in [0x0800,0x0802,0x0870,0x0872]:
+        raise Exception, "Message " + hex(msgID) + " has a variable data packet structure due to the use of submessages, which hasn't been implemented yet"
+    else:
+        raise Exception, "Message " + hex(msgID) + " does not have a packet structure specified. Please check the documentation for this messageID"
+
+def makeMessages(numMessages):
+    """ return a list of numMessages (msgID,codec,values) tuples cycling through every messageID in PACKET_STRUCTS """
+    messages=[(msgID,codec,codec.unpack("\0"*codec.size)) for msgID,codec in sorted(c.PACKET_STRUCTS.items())]
+    return (messages*(numMessages//len(messages)+1))[:numMessages]
+
+def timePrecompiled(messages):
+    """ return the mean (encode,decode) time per message in microseconds using the precompiled header and packet Structs """
+    t0=time.time()
+    raw=[c.HEADER_STRUCT_WITH_DATA.pack(msgID,codec.size,c.GENERIC_USB_ID|0x80,c.HOST_CONTROLLER_ID)+c.getPacketCodec(msgID).pack(*values) for msgID,codec,values in messages]
+    t1=time.time()
+    for message in raw:
+        header=c.HEADER_STRUCT_WITH_DATA.unpack(message[:c.NUM_HEADER_BYTES])
+        c.getPacketCodec(header[0]).unpack(message[c.NUM_HEADER_BYTES:])
+    t2=time.time()
+    return ((t1-t0)/len(messages)*1e6,(t2-t1)/len(messages)*1e6)
+
+def timeFormatStrings(messages):
+    """ return the mean (encode,decode) time per message in microseconds using struct.pack/struct.unpack with the format strings from chainedPacketStruct() """
+    t0=time.time()
+    raw=[struct.pack(c.HEADER_FORMAT_WITH_DATA,msgID,codec.size,c.GENERIC_USB_ID|0x80,c.HOST_CONTROLLER_ID)+struct.pack(chainedPacketStruct(msgID),*values) for msgID,codec,values in messages]
+    t1=time.time()
+    for message in raw:
+        header=struct.unpack(c.HEADER_FORMAT_WITH_DATA,message[:c.NUM_HEADER_BYTES])
+        struct.unpack(chainedPacketStruct(header[0]),message[c.NUM_HEADER_BYTES:])
+    t2=time.time()
+    return ((t1-t0)/len(messages)*1e6,(t2-t1)/len(messages)*1e6)
+
+if __name__=="__main__":
+    numMessages=int(sys.argv[1]) if len(sys.argv)>1 else 100000
+    messages=makeMessages(numMessages)
+    for name,function in [("if/elif chain + struct.pack",timeFormatStrings),("precompiled Structs",timePrecompiled)]:
+        print "%-34s encode %.2f us, decode %.2f us" % ((name+":",)+function(messages))
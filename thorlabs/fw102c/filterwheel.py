@@ -1,5 +1,6 @@
 from __future__ import division
 import ctypes,time,string,numpy, os
+from drivepy import transport
 DLL_NAME=os.path.join(os.path.dirname(__file__),"uart_library.dll")
 BAUD_RATE=115200
 READ_BUFFER_SIZE=256
@@ -61,7 +62,7 @@ class USBConnection(object):
         """ Open the USB connection """
         self.readBufferSize=READ_BUFFER_SIZE
         try:
-            self.lib=ctypes.CDLL(DLL_NAME)
+            self.lib=transport.loadLibrary(DLL_NAME)
         except Exception as e:
             raise LibraryError,"Could not load the library " + DLL_NAME + ". \n" + str(e.args)
         # If the port number was not specified then look for available ports
@@ -0,0 +1,359 @@
+""" Pluggable transport layer used by the drivers to reach the instruments. The "hardware" backend talks to real instruments
+through VISA, the vendor USB libraries and the ftd2xx driver, while the "simulator" backend emulates the same interfaces in-process,
+so that drivers can be run and benchmarked without hardware (e.g. on Linux). The backend is selected with setBackend(), or by the
+DRIVEPY_TRANSPORT environment variable, before the instrument objects are created.
+
+Example:
+    from drivepy import transport
+    sim=transport.SimulatorTransport(latency=0.001,throughput=1e6)
+    sim.addVisaInstrument("GPIB::10",{"*IDN?":"SIMULATED,OSA","ODN?":"3","OSD1":"1550,1551,1552","OSD0":"-10,-3,-10"})
+    transport.registerBackend("simulator",sim)
+    transport.setBackend("simulator") """
+from __future__ import division
+import ctypes,os,re,threading,time
+
+BACKEND_ENV_VAR="DRIVEPY_TRANSPORT"
+DEFAULT_BACKEND="hardware"
+NEWPORT_LIBRARY_NAME="usbdll.dll"
+UART_LIBRARY_NAME="uart_library.dll"
+SRQ_STATUS_BIT=0x40
+UART_UNDEFINED_COMMAND=0xEA
+
+_backends={}
+_activeBackend=None
+
+class Transport(object):
+    """ Interface implemented by each transport backend """
+    def openVisaResource(self,addr):
+        """ Return an open pyvisa-like resource for addr, raising IOError if there is no instrument at the address """
+        raise NotImplementedError
+    def loadLibrary(self,path,stdcall=False):
+        """ Return the ctypes-like vendor library at path (loaded with the stdcall calling convention if stdcall is True) """
+        raise NotImplementedError
+    def getFtdiModule(self):
+        """ Return the ftd2xx-like module used to enumerate and open FTDI devices """
+        raise NotImplementedError
+
+class HardwareTransport(Transport):
+    """ Transport to real instruments via VISA, the vendor DLLs and the ftd2xx driver. The driver modules are only imported when first used """
+    def __init__(self):
+        self._resourceManager=None
+    def getResourceManager(self):
+        """ Return the process-wide VISA resource manager, creating it on first use """
+        if self._resourceManager is None:
+            import visa
+            self._resourceManager=visa.ResourceManager()
+        return self._resourceManager
+    def openVisaResource(self,addr):
+        import visa
+        resource=self.getResourceManager().open_resource(addr)
+        # Check if the device exists; if not then VisaIOError will be thrown
+        try:
+            resource.write("")
+        except visa.VisaIOError,e:
+            resource.close()
+            raise IOError,"Could not create visa connection at GPIB::"+addr+". \n "+e.args[0]
+        return resource
+    def loadLibrary(self,path,stdcall=False):
+        return ctypes.WinDLL(path) if stdcall else ctypes.CDLL(path)
+    def getFtdiModule(self):
+        from drivepy.thorlabs.aptlib import ftd2xx
+        return ftd2xx
+
+class SimulatorTransport(Transport):
+    """ In-process transport which emulates the instrument interfaces used by the drivers. Each simulated instrument is scripted by a responder,
+    which is either a callable taking the command (or raw message for FTDI devices) and returning the reply, or a dictionary mapping commands to replies.
+    Dictionary keys are matched exactly, or else by the longest key which is a prefix of the command, and the values may be strings or callables.
+    A reply of None means that the command has no response. Every transfer costs latency seconds plus the number of bytes divided by throughput (bytes/s),
+    and transactionCount and byteCount record the traffic for benchmarking """
+    def __init__(self,latency=0,throughput=None):
+        self.latency=latency
+        self.throughput=throughput
+        self.transactionCount=0
+        self.byteCount=0
+        self.visaInstruments={}     # SimulatedDevice for each VISA address
+        self.newportDevices={}      # (pid,SimulatedDevice) for each Newport device ID
+        self.uartDevices={}         # SimulatedDevice for each UART port number
+        self.ftdiDevices=[]         # SimulatedDevice for each FTDI device, in enumeration order
+        self._libraries={}
+        self._statsLock=threading.Lock()
+    def addVisaInstrument(self,addr,responder):
+        """ Add a simulated VISA instrument at addr, and return the SimulatedDevice """
+        self.visaInstruments[addr]=device=SimulatedDevice(self,responder)
+        return device
+    def addNewportDevice(self,deviceId,description,responder,pid=0xcec7):
+        """ Add a simulated Newport USB device. The serial number should be included in the description string """
+        device=SimulatedDevice(self,responder,terminator="\r\n",description=description)
+        self.newportDevices[deviceId]=(pid,device)
+        return device
+    def addUartDevice(self,port,responder):
+        """ Add a simulated device on the Thor Labs UART library at port number port """
+        self.uartDevices[port]=device=SimulatedDevice(self,responder)
+        return device
+    def addFtdiDevice(self,serial,description,responder):
+        """ Add a simulated FTDI device (e.g. an APT controller) with the given serial number string and description """
+        device=SimulatedDevice(self,responder,serial=serial,description=description)
+        self.ftdiDevices.append(device)
+        return device
+    def openVisaResource(self,addr):
+        if addr not in self.visaInstruments:
+            raise IOError,"Could not create visa connection at "+addr+". \n No simulated instrument at this address"
+        return _SimulatedVisaResource(self.visaInstruments[addr])
+    def loadLibrary(self,path,stdcall=False):
+        name=os.path.basename(path).lower()
+        if name not in self._libraries:
+            if name==NEWPORT_LIBRARY_NAME:
+                self._libraries[name]=_SimulatedNewportLibrary(self)
+            elif name==UART_LIBRARY_NAME:
+                self._libraries[name]=_SimulatedUartLibrary(self)
+            else:
+                raise OSError,"No simulation available for library "+name
+        return self._libraries[name]
+    def getFtdiModule(self):
+        return _SimulatedFtdiModule(self)
+    def transfer(self,numBytes):
+        """ Account for one transaction of numBytes bytes and wait for the time it would take """
+        with self._statsLock:
+            self.transactionCount+=1
+            self.byteCount+=numBytes
+        delay=self.latency+(numBytes/self.throughput if self.throughput else 0)
+        if delay>0:
+            time.sleep(delay)
+    def resetStatistics(self):
+        self.transactionCount=0
+        self.byteCount=0
+
+class SimulatedDevice(object):
+    """ A scripted instrument. Replies to the commands sent to it are queued in an output buffer until read, and unsolicited messages can be
+    queued with push(). All written commands are recorded in the written list """
+    def __init__(self,transport,responder,terminator="",serial="",description=""):
+        self.transport=transport
+        self.responder=responder
+        self.terminator=terminator
+        self.serial=serial
+        self.description=description
+        self.written=[]
+        self.statusByte=SRQ_STATUS_BIT   # simulated operations complete instantly, so service is always requested
+        self._output=""
+        self._condition=threading.Condition()
+    def send(self,data):
+        """ Write data to the device and queue its reply. Returns the reply, or None if the command has no response """
+        self.transport.transfer(len(data))
+        self.written.append(data)
+        reply=self._respond(data)
+        if reply is not None:
+            self.push(reply+self.terminator)
+        return reply
+    def push(self,data):
+        """ Queue data to be read from the device """
+        with self._condition:
+            self._output+=data
+            self._condition.notify_all()
+    def receive(self,n=None,timeout=0):
+        """ Read up to n bytes (or everything if None) from the device, waiting up to timeout seconds for n bytes to be available """
+        deadline=time.time()+timeout
+        with self._condition:
+            while n!=None and len(self._output)<n and time.time()<deadline:
+                self._condition.wait(deadline-time.time())
+            data,self._output=(self._output,"") if n==None else (self._output[:n],self._output[n:])
+        if data:
+            self.transport.transfer(len(data))
+        return data
+    def pending(self):
+        """ Return the number of bytes waiting to be read """
+        return len(self._output)
+    def _respond(self,data):
+        if callable(self.responder):
+            return self.responder(data)
+        command=data.strip()
+        if command in self.responder:
+            reply=self.responder[command]
+        else:
+            prefixes=[key for key in self.responder if command.startswith(key)]
+            if not prefixes:
+                return None
+            reply=self.responder[max(prefixes,key=len)]
+        return reply(command) if callable(reply) else reply
+
+class _SimulatedVisaResource(object):
+    """ Emulation of the parts of a pyvisa resource used by visaconnection """
+    def __init__(self,device):
+        self.device=device
+        self.timeout=2000   # ms
+    def write(self,writeString):
+        if writeString:
+            self.device.send(writeString)
+    def read_raw(self):
+        if not self.device.pending():
+            raise IOError,"Timeout reading from simulated instrument"
+        return self.device.receive()
+    def read(self):
+        return self.read_raw().rstrip("\r\n")
+    def read_values(self):
+        return [float(value) for value in re.split(r"[,\s]+",self.read()) if value]
+    def query(self,queryString):
+        self.write(queryString)
+        return self.read()
+    ask=query
+    def read_stb(self):
+        self.device.transport.transfer(1)
+        return self.device.statusByte
+    def wait_for_srq(self,timeout=None):
+        self.device.transport.transfer(0)
+    def close(self):
+        pass
+
+class _SimulatedNewportLibrary(object):
+    """ Emulation of the Newport USB driver library usbdll.dll """
+    def __init__(self,transport):
+        self.transport=transport
+        self.pids=set()
+    def newp_usb_open_devices(self,pid,useUSBAddress,numDevices):
+        devices=[i for i,(devicePid,device) in self.transport.newportDevices.items() if devicePid==pid]
+        _setByRef(numDevices,len(devices))
+        if devices:
+            self.pids.add(pid)
+        return 0 if devices else -1
+    def newp_usb_get_device_info(self,readBuffer):
+        # Like the real library, the devices of every product id opened since initialization are listed
+        info="".join(str(i)+","+device.description+";" for i,(pid,device) in sorted(self.transport.newportDevices.items()) if pid in self.pids)
+        ctypes.memmove(readBuffer,info+"\0",len(info)+1)
+        return 0
+    def newp_usb_send_ascii(self,deviceId,writeString,length):
+        if deviceId not in self.transport.newportDevices:
+            return -1
+        self.transport.newportDevices[deviceId][1].send(writeString[:length])
+        return 0
+    def newp_usb_get_ascii(self,deviceId,readBuffer,size,numBytesRead):
+        if deviceId not in self.transport.newportDevices:
+            return -1
+        data=self.transport.newportDevices[deviceId][1].receive(size)
+        ctypes.memmove(readBuffer,data,len(data))
+        _setByRef(numBytesRead,len(data))
+        return 0 if data else -1
+    def newp_usb_uninit_system(self):
+        self.pids.clear()
+        return 0
+
+class _SimulatedUartLibrary(object):
+    """ Emulation of the Thor Labs UART library uart_library.dll """
+    def __init__(self,transport):
+        self.transport=transport
+        self.device=None
+    def fnUART_LIBRARY_list(self,readBuffer,size):
+        ports=",".join(str(port) for port in sorted(self.transport.uartDevices))
+        ctypes.memmove(readBuffer,ports[:size-1]+"\0",min(len(ports)+1,size))
+        return len(self.transport.uartDevices)
+    def fnUART_LIBRARY_open(self,port,baudRate):
+        self.device=self.transport.uartDevices.get(port)
+        return 0 if self.device is not None else -1
+    def fnUART_LIBRARY_close(self):
+        self.device=None
+        return 0
+    def fnUART_LIBRARY_Set(self,writeString,length):
+        if self.device is None:
+            return -1
+        self.device.send(writeString[:length])
+        return 0
+    def fnUART_LIBRARY_read(self,readBuffer,size):
+        if self.device is None:
+            return -1
+        data=self.device.receive(size-1)
+        ctypes.memmove(readBuffer,data+"\0",len(data)+1)
+        return len(data)
+    def fnUART_LIBRARY_Get(self,queryString,readBuffer):
+        if self.device is None:
+            return -1
+        command=queryString.strip()
+        reply=self.device.send(queryString)
+        if reply is None:
+            return UART_UNDEFINED_COMMAND
+        # The device echoes the command, followed by the response and the prompt
+        response=command+"\r"+self.device.receive()+"\r>"
+        ctypes.memmove(readBuffer,response+"\0",len(response)+1)
+        return 0
+
+class _SimulatedFtdiDefines(object):
+    """ The ftd2xx.defines constants used by the drivers """
+    BAUD_115200=115200
+    BITS_8=8
+    STOP_BITS_1=0
+    PARITY_NONE=0
+    FLOW_RTS_CTS=0x0100
+
+class _SimulatedFtdiModule(object):
+    """ Emulation of the ftd2xx module functions used to enumerate and open devices """
+    defines=_SimulatedFtdiDefines
+    def __init__(self,transport):
+        self.transport=transport
+    def createDeviceInfoList(self):
+        return len(self.transport.ftdiDevices)
+    def getDeviceInfoDetail(self,devnum=0):
+        device=self.transport.ftdiDevices[devnum]
+        return {"index":devnum,"flags":0,"type":0,"id":0,"location":0,"serial":device.serial,"description":device.description,"handle":None}
+    def open(self,dev=0):
+        return _SimulatedFtdiHandle(self.transport.ftdiDevices[dev])
+    def openEx(self,serial,flags=None):
+        for device in self.transport.ftdiDevices:
+            if device.serial==serial:
+                return _SimulatedFtdiHandle(device)
+        raise IOError,"No simulated FTDI device with serial number "+str(serial)
+
+class _SimulatedFtdiHandle(object):
+    """ Emulation of an open ftd2xx device handle """
+    def __init__(self,device):
+        self.device=device
+        self.serial=device.serial
+        self.description=device.description
+        self.readTimeout=0
+    def read(self,nchars,raw=True):
+        # Like the real driver, wait until nchars are available or the read timeout expires
+        return self.device.receive(nchars,self.readTimeout)
+    def write(self,data):
+        self.device.send(data)
+        return len(data)
+    def getQueueStatus(self):
+        return self.device.pending()
+    def setTimeouts(self,read,write):
+        self.readTimeout=read/1000
+    def purge(self,mask=0):
+        self.device.receive()
+    def close(self): pass
+    def setBaudRate(self,baud): pass
+    def setDataCharacteristics(self,wordlen,stopbits,parity): pass
+    def setFlowControl(self,flowcontrol,xon=-1,xoff=-1): pass
+    def resetDevice(self): pass
+    def setLatencyTimer(self,latency): pass
+
+def _setByRef(ref,value):
+    """ Set the value of a ctypes object passed by ctypes.byref() """
+    getattr(ref,"_obj",ref).value=value
+
+def registerBackend(name,backend):
+    """ Make a Transport instance available under name for setBackend() """
+    _backends[name]=backend
+
+def setBackend(name):
+    """ Select the registered transport backend used by instrument objects created from now on """
+    global _activeBackend
+    if name not in _backends:
+        raise ValueError, "Unknown transport backend "+str(name)+". Registered backends are "+str(_backends.keys())
+    _activeBackend=_backends[name]
+
+def getBackend():
+    """ Return the active transport backend, which defaults to the one named by the DRIVEPY_TRANSPORT environment variable """
+    if _activeBackend is None:
+        setBackend(os.environ.get(BACKEND_ENV_VAR,DEFAULT_BACKEND))
+    return _activeBackend
+
+def openVisaResource(addr):
+    return getBackend().openVisaResource(addr)
+
+def loadLibrary(path,stdcall=False):
+    return getBackend().loadLibrary(path,stdcall)
+
+def getFtdiModule():
+    return getBackend().getFtdiModule()
+
+registerBackend("hardware",HardwareTransport())
+registerBackend("simulator",SimulatorTransport())
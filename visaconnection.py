@@ -1,27 +1,269 @@
 ﻿from __future__ import division
-import visa
+from drivepy import transport
+import numpy
+import threading,re
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# The open sessions are shared by all instrument objects in the process
+_sessions={}
+_sessionsLock=threading.Lock()
+# Default size in bytes of instrument input buffer, which limits the length of batched messages
+INPUT_BUFFER_SIZE=256
+# Commands after which the instrument settings are no longer known, so the settings cache is cleared
+RESET_COMMANDS=("*RST","*RCL","SYST:PRES","CONF")
+# Header nodes which are never cached: outputs can be switched off by the instrument itself (e.g. by an interlock), and list loads are actions
+UNCACHEABLE_NODES=("OUTP","LIST")
 
 class VisaConnection(object):
     """ Abstraction of the VISA connection for consistency between implementation of instrument classes """
-    def __init__(self,addr):
-        rm = visa.ResourceManager()
-        self.lib=rm.open_resource(addr)
-        # Check if the device exists; if not then VisaIOError will be thrown
-        try:
-            self.lib.write("") 
-        except visa.VisaIOError,e:
-            raise IOError,"Could not create visa connection at GPIB::"+addr+". \n "+e.args[0]
+    def __init__(self,addr,timeout=None):
+        self._session=None
+        self._session=acquireSession(addr)
+        self.lib=self._session.lib
+        # Lock held by every transfer, so that write/read sequences from different threads (including the worker thread) don't interleave
+        self.lock=self._session.lock
+        # The timeout (in s) belongs to this connection, and is applied to the shared session for each transfer made through it
+        self.timeout=timeout
+        self.inputBufferSize=INPUT_BUFFER_SIZE
+        self.cachedSettings=set()   # canonical headers whose redundant writes are skipped, see cacheSettings()
+    def __del__(self):
+        self.close()
+    def close(self):
+        """ Release this connection's reference to the shared session, which is closed when the last reference is released """
+        if self._session is not None:
+            releaseSession(self._session)
+            self._session=None
+    def isLastReference(self):
+        """ Return True if no other connection object shares the session. Subclasses use this to only restore the instrument state on the final release """
+        return self._session is not None and self._session.refCount==1
     def write(self,writeString):
-        self.lib.write(writeString)
-    def readQuery(self,queryString):
-        return self.lib.query(queryString)
+        with self.locked() as lib:
+            batch=self._session.batch
+            updates={}
+            if self.cachedSettings or self._session.settings:
+                writeString,updates=self._removeRedundantSettings(writeString,[pendingUpdates for _,pendingUpdates in batch.pending])
+                if not writeString:
+                    return
+            if batch.depth:
+                batch.pending.append((writeString,updates))
+            else:
+                lib.write(writeString)
+                self._session.settings.update(updates)
+    def cacheSettings(self,headers):
+        """ Skip writes which set any of the SCPI headers to the value it was last set to. Only headers whose setting is idempotent and isn't changed
+        by the instrument itself should be cached. Output and list commands can't be cached """
+        for header in headers:
+            header=_canonicalHeader(header)
+            if header.startswith("*") or any(node in UNCACHEABLE_NODES for node in header.split(":")):
+                raise ValueError, "The setting "+header+" can't be cached"
+            self.cachedSettings.add(header)
+    def invalidateSettings(self,header=None):
+        """ Forget the cached value of header (or of all settings if None), e.g. after the setting was changed from the front panel or by the instrument itself """
+        if header==None:
+            self._session.settings.clear()
+        else:
+            self._session.settings.pop(_canonicalHeader(header),None)
+    def _removeRedundantSettings(self,writeString,pendingUpdates):
+        """ Return writeString with the commands removed which set a cached header to its current value, and the values to cache once it has been written.
+        Writing a header forgets the cached values coupled to it, both in the cache and in the pendingUpdates of commands queued before it """
+        settings=self._session.settings
+        commands=[command.strip() for command in writeString.split(";")]
+        keep=[]
+        updates={}
+        for i,command in enumerate(commands):
+            header,_,value=command.partition(" ")
+            header=_canonicalHeader(header)
+            if header.startswith(RESET_COMMANDS) or (i>0 and not command.startswith((":","*"))):
+                # the state is unknown after a reset, and relative headers can't be identified, so send everything
+                for cache in [settings]+pendingUpdates:
+                    cache.clear()
+                return writeString,{}
+            value=value.strip()
+            if "?" not in header:
+                if value and header in self.cachedSettings and settings.get(header)==value:
+                    continue
+                # the value isn't known until the write has returned
+                for cache in [settings,updates]+pendingUpdates:
+                    _forgetCoupledSettings(cache,header)
+                if value and header in self.cachedSettings:
+                    updates[header]=value
+            keep.append(command)
+        return ";".join(keep),updates
+    def readQuery(self,queryString,timeout=None):
+        """ Send queryString and return the response, optionally overriding the VISA timeout (in s) for slow operations """
+        self.flush()
+        with self.locked(timeout) as lib:
+            return lib.query(queryString)
+    @contextmanager
+    def locked(self,timeout=None):
+        """ Context manager which holds the session lock and returns the VISA resource, for subclasses which make several transfers that must not be interleaved with other threads.
+        The VISA timeout is set to timeout (in s) if given, or else to the timeout of this connection """
+        with self.lock:
+            self._session.setTimeout(timeout if timeout!=None else self.timeout)
+            yield self.lib
+    @contextmanager
+    def batch(self):
+        """ Context manager which coalesces the SCPI commands written inside it into semicolon joined messages of up to inputBufferSize bytes,
+        so that each message costs a single bus transaction. Pending commands are sent before the first query, and when the outermost batch exits.
+        Batches belong to the session and the calling thread, so commands written to the instrument by other threads are never swept into this one """
+        batch=self._session.batch
+        batch.depth+=1
+        try:
+            yield self
+        finally:
+            batch.depth-=1
+            if batch.depth==0:
+                self.flush()
+    def flush(self):
+        """ Send any commands queued by batch() on the calling thread """
+        batch=self._session.batch
+        if not batch.pending:
+            return
+        message=""
+        messageUpdates={}
+        with self.locked() as lib:
+            pending,batch.pending=batch.pending,[]
+            for command,updates in pending:
+                if message:
+                    # Commands following a semicolon are relative to the previous header, so make them absolute
+                    absolute=command if command.startswith((":","*")) else ":"+command
+                    if len(message)+1+len(absolute)>self.inputBufferSize:
+                        lib.write(message)
+                        self._session.settings.update(messageUpdates)
+                        message=""
+                        messageUpdates={}
+                    else:
+                        message+=";"+absolute
+                # The first command of a message is sent as written, so instruments without SCPI headers still understand a batch of one command
+                if not message:
+                    message=command
+                messageUpdates.update(updates)
+            if message:
+                lib.write(message)
+                self._session.settings.update(messageUpdates)
+    def submit(self,fn,*args,**kwargs):
+        """ Run fn(*args,**kwargs) on the dedicated worker thread for this instrument and return a concurrent.futures.Future for the result.
+        Calls submitted for the same instrument are queued and run one at a time, while different instruments are polled concurrently.
+        Each transfer holds the session lock, so the instrument can still be used from other threads while jobs are queued """
+        return self._session.submit(fn,*args,**kwargs)
     def wait(self,t):
-        self.lib.wait_for_srq(timeout=t)
+        self.flush()
+        with self.locked() as lib:
+            lib.wait_for_srq(timeout=t)
         # I want to read the status byte properly at some point, but for now I don't need it
         #status=vpp43.read_stb(self.vi)
         #if int(status)<0:
         #    raise CommError, "wait_for_srq() returned " + str(status) + " when talking to spectrum analyzer"
+    def serviceRequested(self):
+        """ Serial poll the instrument and return True if it is requesting service (RQS bit of the status byte). This doesn't block """
+        self.flush()
+        with self.locked() as lib:
+            return bool(lib.read_stb() & 0x40)
     def getFloatArray(self,request):
         """ retrieve an array of floats as specified by request string ("OSD0"|"OSD1") """
-        self.write(request)
-        data=self.lib.read_values()
\ No newline at end of file
+        with self.locked() as lib:
+            self.write(request)
+            self.flush()
+            data=lib.read_values()
+    def getBinaryArray(self,request,dtype):
+        """ retrieve an array of numbers sent by the instrument as an IEEE-488.2 definite length block in response to request string """
+        with self.locked() as lib:
+            self.write(request)
+            self.flush()
+            return parseBinaryBlock(lib.read_raw(),dtype)
+
+class _Session(object):
+    """ A VISA session shared by all connection objects with the same address, together with its worker queue and reference count """
+    def __init__(self,addr):
+        self.addr=addr
+        self.lib=transport.openVisaResource(addr)
+        self.defaultTimeout=self.lib.timeout  # ms, used by connections which don't specify a timeout
+        self._timeout=self.defaultTimeout
+        self.refCount=0
+        self.settings={}    # last value written for each SCPI header
+        self.batch=_BatchState()
+        self.lock=threading.RLock()
+        self._executor=None
+        self._executorLock=threading.Lock()
+        self._workerThread=None
+    def setTimeout(self,timeout):
+        """ Set the VISA timeout to timeout (in s), or to the default timeout of the resource if None. Called with the lock held """
+        timeout=self.defaultTimeout if timeout==None else timeout*1000
+        if timeout!=self._timeout:
+            self.lib.timeout=timeout
+            self._timeout=timeout
+    def getExecutor(self):
+        with self._executorLock:
+            if self._executor is None:
+                self._executor=ThreadPoolExecutor(max_workers=1)
+            return self._executor
+    def submit(self,fn,*args,**kwargs):
+        return self.getExecutor().submit(self._runJob,fn,args,kwargs)
+    def _runJob(self,fn,args,kwargs):
+        self._workerThread=threading.current_thread()
+        return fn(*args,**kwargs)
+    def close(self):
+        """ Close the VISA resource once the queued jobs have finished. If the last reference is released by a job on the worker
+        thread itself, that job is the last one to use the session, so the resource is closed without waiting for it """
+        if self._executor is not None:
+            self._executor.shutdown(wait=threading.current_thread() is not self._workerThread)
+        self.lib.close()
+
+class _BatchState(threading.local):
+    """ Nesting depth and queued commands of the batch() in progress on each thread """
+    def __init__(self):
+        self.depth=0
+        self.pending=[]
+
+def acquireSession(addr):
+    """ Return the open session for addr, opening it if this is the first connection to the instrument """
+    with _sessionsLock:
+        session=_sessions.get(addr)
+        if session is None:
+            # The transport raises IOError if the device doesn't exist
+            session=_Session(addr)
+            _sessions[addr]=session
+        session.refCount+=1
+        return session
+
+def releaseSession(session):
+    """ Release one reference to session, closing it when no connection objects are using it any more """
+    with _sessionsLock:
+        session.refCount-=1
+        if session.refCount>0:
+            return
+        del _sessions[session.addr]
+    # closed outside the lock because it waits for the queued jobs, which may open other sessions
+    session.close()
+
+def _canonicalHeader(header):
+    """ Convert a SCPI header to upper case short form so that e.g. ":SOUR:CURR:RANGE" and "SOURce:CURRent:RANG" are identified """
+    nodes=[]
+    for node in header.upper().lstrip(":").split(":"):
+        mnemonic,suffix=re.match(r"(\*?[A-Z]*)(.*)",node).groups()
+        if len(mnemonic)>4:
+            mnemonic=mnemonic[:3] if mnemonic[3] in "AEIOU" else mnemonic[:4]
+        nodes.append(mnemonic+suffix)
+    return ":".join(nodes)
+
+def _forgetCoupledSettings(settings,header):
+    """ Remove header from the settings dictionary, together with the headers whose value may change when it's written: its ancestors and
+    descendants (e.g. "SOUR:CURR" and "SOUR:CURR:RANG"), and its siblings if either is an AUTO node (e.g. "SENS:CURR:RANG:UPP" and "SENS:CURR:RANG:AUTO") """
+    parent,_,node=header.rpartition(":")
+    for key in settings.keys():
+        keyParent,_,keyNode=key.rpartition(":")
+        if key==header or key.startswith(header+":") or header.startswith(key+":") or (keyParent==parent and "AUTO" in (node,keyNode)):
+            del settings[key]
+
+def parseBinaryBlock(raw,dtype):
+    """ decode an IEEE-488.2 definite length block (#<n><length><data>) into a numpy array of the given dtype without parsing any ASCII """
+    start=raw.find("#")
+    if start<0:
+        raise IOError,"Binary block header not found in response from instrument"
+    numDigits=int(raw[start+1])
+    dataStart=start+2+numDigits
+    length=int(raw[start+2:dataStart])
+    if len(raw)<dataStart+length:
+        raise IOError,"Binary block truncated: expected "+str(length)+" bytes but received "+str(len(raw)-dataStart)
+    return numpy.frombuffer(raw,dtype=dtype,count=length//numpy.dtype(dtype).itemsize,offset=dataStart)